@@ -0,0 +1,377 @@
+#!/usr/bin/python2.7
+#-*- coding=utf-8 -*-
+
+
+"""类似WARC格式的response归档
+    每条记录单独gzip压缩后追加到segment文件中(多个gzip member拼接)，
+    segment超过一定大小后滚动到新的文件，
+    每个segment有一个同名的.idx索引文件，每条索引是定长的
+    (url的sha1, 偏移, 长度)，可以直接定位到记录，
+    记录的WARC头中保存了下载时task的callback和json编码的kwargs，
+    重新解析时按callback选择parser，并还原task的kwargs
+    ArchiveError: 归档相关的错误
+    ArchiveWriter: 在单独的线程中写入归档
+    ArchiveReader: 根据url读取归档，找不到时重新加载索引
+"""
+
+__authors__ = ['"wuyadong" <wuyadong@tigerknows.com>']
+
+import os
+import json
+import zlib
+import atexit
+import time
+import glob
+import Queue
+import struct
+import hashlib
+import logging
+import datetime
+import threading
+
+from core.util import load_object, get_project_path
+
+DEFAULT_ARCHIVE_SETTINGS = "settings.archivesettings"
+SEGMENT_SUFFIX = ".warc.gz"
+INDEX_SUFFIX = ".idx"
+INDEX_RECORD = struct.Struct("!20sQI")  # url sha1, offset, length
+DEFAULT_SEGMENT_SIZE = 256 * 1024 * 1024
+DEFAULT_QUEUE_SIZE = 1000
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_FLUSH_TIMEOUT = 30  # 关闭时等待队列写完的最长时间，单位秒
+# body已经被curl解压，这些header不再描述归档中的body
+SKIP_HEADERS = ("content-encoding", "content-length", "transfer-encoding")
+CALLBACK_HEADER = "WARC-Tigerspider-Callback"
+KWARGS_HEADER = "WARC-Tigerspider-Kwargs"
+
+logger = logging.getLogger(__name__)
+
+
+class ArchiveError(Exception):
+    """归档相关的错误
+    """
+
+
+def url_fingerprint(url):
+    """url的指纹
+        Args:
+            url: str, url
+        Returns:
+            fingerprint: str, 20字节的sha1
+    """
+    if isinstance(url, unicode):
+        url = url.encode("utf-8")
+    return hashlib.sha1(url).digest()
+
+
+def build_record(url, code, headers, body, callback=None, kwargs=None):
+    """生成一条WARC response记录
+        Args:
+            url: str, url
+            code: int, http code
+            headers: list, [(name, value)]
+            body: str, body
+            callback: str, task的callback，None表示不记录
+            kwargs: dict, task的kwargs，None或者不能json编码时不记录
+        Returns:
+            record: str, 记录
+    """
+    if isinstance(url, unicode):
+        url = url.encode("utf-8")
+    http_lines = ["HTTP/1.1 %d" % code]
+    for name, value in headers:
+        if name.lower() not in SKIP_HEADERS:
+            http_lines.append("%s: %s" % (name, value))
+    http_block = "\r\n".join(http_lines) + "\r\n\r\n" + body
+    warc_lines = ["WARC/1.0",
+                  "WARC-Type: response",
+                  "WARC-Target-URI: %s" % url,
+                  "WARC-Date: %s" % datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
+                  "Content-Type: application/http; msgtype=response",
+                  "Content-Length: %d" % len(http_block)]
+    if callback is not None:
+        warc_lines.append("%s: %s" % (CALLBACK_HEADER, callback))
+    if kwargs is not None:
+        try:
+            warc_lines.append("%s: %s" % (KWARGS_HEADER, json.dumps(kwargs)))
+        except (TypeError, ValueError), e:
+            logger.warn("skip kwargs of url:%s error:%s" % (url, e))
+    return "\r\n".join(warc_lines) + "\r\n\r\n" + http_block + "\r\n\r\n"
+
+
+def parse_record(record):
+    """解析一条WARC response记录
+        Args:
+            record: str, 记录
+        Returns:
+            url, code, headers, body, callback, kwargs: 元组，
+                没有记录callback和kwargs时为None
+        Raises:
+            ArchiveError: 格式错误
+    """
+    try:
+        warc_head, rest = record.split("\r\n\r\n", 1)
+        warc_headers = dict(line.split(": ", 1) for line in warc_head.split("\r\n")[1:])
+        http_block = rest[:int(warc_headers["Content-Length"])]
+        http_head, body = http_block.split("\r\n\r\n", 1)
+        http_lines = http_head.split("\r\n")
+        code = int(http_lines[0].split(" ")[1])
+        headers = [tuple(line.split(": ", 1)) for line in http_lines[1:]]
+        kwargs = warc_headers.get(KWARGS_HEADER)
+        if kwargs is not None:
+            kwargs = json.loads(kwargs)
+    except (ValueError, KeyError, IndexError), e:
+        raise ArchiveError("parse record error:%s" % e)
+    return (warc_headers["WARC-Target-URI"], code, headers, body,
+            warc_headers.get(CALLBACK_HEADER), kwargs)
+
+
+class ArchiveWriter(object):
+    """在单独的线程中写入归档，不阻塞IOLoop
+        append只是放入队列，队列满的时候丢弃记录，
+        写入线程是daemon线程，进程正常退出时自动close，写完队列中的记录，
+        flush和close会阻塞，不能在IOLoop中调用
+    """
+    _lock = threading.Lock()
+
+    def __init__(self, directory, segment_size=DEFAULT_SEGMENT_SIZE,
+                 queue_size=DEFAULT_QUEUE_SIZE, batch_size=DEFAULT_BATCH_SIZE):
+        """初始化，启动写入线程
+            Args:
+                directory: str, 归档目录
+                segment_size: int, segment文件的最大长度
+                queue_size: int, 等待写入的最大记录数
+                batch_size: int, 每批写入的最大记录数，每批写完flush一次
+        """
+        self._directory = directory
+        self._segment_size = segment_size
+        self._batch_size = batch_size
+        self._queue = Queue.Queue(queue_size)
+        self._segment_file = None
+        self._index_file = None
+        self._segment_index = 0
+        self.dropped_count = 0
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self._is_closed = False
+        self._thread = threading.Thread(target=self._run, name="archive-writer")
+        self._thread.daemon = True
+        self._thread.start()
+        atexit.register(self.close)
+
+    @staticmethod
+    def instance():
+        """获取归档写入者
+            单例模式，从settings.archivesettings加载配置，没有配置目录时返回None
+            Returns:
+                writer: ArchiveWriter 实例或None
+        """
+        if not hasattr(ArchiveWriter, "_instance"):
+            with ArchiveWriter._lock:
+                writer = None
+                try:
+                    path = load_object(DEFAULT_ARCHIVE_SETTINGS + ".path")
+                    if path:
+                        writer = ArchiveWriter(get_project_path() + path,
+                                               load_object(DEFAULT_ARCHIVE_SETTINGS + ".segment_size"))
+                except Exception, e:
+                    logger.error("init archive writer failed error:%s" % e)
+                setattr(ArchiveWriter, "_instance", writer)
+        return getattr(ArchiveWriter, "_instance")
+
+    def append(self, url, code, headers, body, callback=None, kwargs=None):
+        """追加一个response
+            Args:
+                url: str, url
+                code: int, http code
+                headers: list, [(name, value)]
+                body: str, body
+                callback: str, task的callback
+                kwargs: dict, task的kwargs，在写入线程中编码，这里复制一份
+        """
+        if self._is_closed:
+            logger.warn("archive writer is closed, drop url:%s" % url)
+            return
+        if kwargs is not None:
+            kwargs = dict(kwargs)
+        try:
+            self._queue.put_nowait((url, code, headers, body, callback, kwargs))
+        except Queue.Full:
+            self.dropped_count += 1
+            logger.warn("archive queue is full, drop url:%s" % url)
+
+    def flush(self, timeout=DEFAULT_FLUSH_TIMEOUT):
+        """等待队列中的记录全部写入文件
+            Args:
+                timeout: float, 最长等待时间，单位秒
+            Returns:
+                is_flushed: bool, 超时返回False
+        """
+        end_time = time.time() + timeout
+        with self._queue.all_tasks_done:
+            while self._queue.unfinished_tasks:
+                remaining = end_time - time.time()
+                if remaining <= 0:
+                    logger.warn("flush archive timeout, %s records left" %
+                                self._queue.unfinished_tasks)
+                    return False
+                self._queue.all_tasks_done.wait(remaining)
+        return True
+
+    def close(self, timeout=DEFAULT_FLUSH_TIMEOUT):
+        """写完队列中的记录，结束写入线程并关闭文件，不会重复关闭
+            Args:
+                timeout: float, 最长等待时间，单位秒
+        """
+        if self._is_closed:
+            return
+        self.flush(timeout)
+        self._is_closed = True
+        self._queue.put(None)
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            logger.warn("archive writer thread is still alive")
+        else:
+            self._close_segment()
+
+    def _open_segment(self):
+        """打开一个新的segment
+        """
+        self._close_segment()
+        # 多进程模式下每个子进程有自己的writer，文件名中加上pid避免冲突
+        name = "archive-%s-%d-%05d" % (time.strftime("%Y%m%d%H%M%S"), os.getpid(),
+                                       self._segment_index)
+        self._segment_index += 1
+        base_path = os.path.join(self._directory, name)
+        self._segment_file = open(base_path + SEGMENT_SUFFIX, "ab")
+        self._index_file = open(base_path + INDEX_SUFFIX, "ab")
+
+    def _close_segment(self):
+        if self._segment_file is not None:
+            self._segment_file.close()
+            self._index_file.close()
+            self._segment_file, self._index_file = None, None
+
+    def _write(self, url, code, headers, body, callback, kwargs):
+        """写入一条记录
+        """
+        if self._segment_file is None or self._segment_file.tell() >= self._segment_size:
+            self._open_segment()
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        data = compressor.compress(build_record(url, code, headers, body, callback, kwargs)) + \
+            compressor.flush()
+        offset = self._segment_file.tell()
+        self._segment_file.write(data)
+        self._index_file.write(INDEX_RECORD.pack(url_fingerprint(url), offset, len(data)))
+
+    def _run(self):
+        """写入线程，每次取出一批记录写入后flush，取到None时退出
+        """
+        is_closed = False
+        while not is_closed:
+            records = [self._queue.get()]
+            while len(records) < self._batch_size:
+                try:
+                    records.append(self._queue.get_nowait())
+                except Queue.Empty:
+                    break
+            try:
+                for record in records:
+                    if record is None:
+                        is_closed = True
+                    else:
+                        self._write(*record)
+                if self._segment_file is not None:
+                    self._segment_file.flush()
+                    self._index_file.flush()
+            except Exception, e:
+                logger.error("write archive error:%s" % e)
+            finally:
+                for _ in records:
+                    self._queue.task_done()
+
+
+class ArchiveReader(object):
+    """根据url读取归档
+        归档可能还在写入，找不到url时重新加载新增的索引
+    """
+
+    def __init__(self, directory):
+        """加载目录下所有segment的索引
+            Args:
+                directory: str, 归档目录
+        """
+        self._directory = directory
+        self._index = {}
+        self._index_path2size = {}  # 索引文件到已经加载的长度
+        self.refresh()
+
+    def refresh(self):
+        """加载新的segment的索引，以及已有索引文件中新追加的部分
+        """
+        for index_path in sorted(glob.glob(os.path.join(self._directory, "*" + INDEX_SUFFIX))):
+            segment_path = index_path[:-len(INDEX_SUFFIX)] + SEGMENT_SUFFIX
+            loaded_size = self._index_path2size.get(index_path, 0)
+            with open(index_path, "rb") as index_file:
+                index_file.seek(loaded_size)
+                data = index_file.read()
+            # 写入中断或者正在写入时最后一条索引可能不完整，下次再加载
+            number = len(data) // INDEX_RECORD.size
+            for start in xrange(0, number * INDEX_RECORD.size, INDEX_RECORD.size):
+                fingerprint, offset, length = INDEX_RECORD.unpack_from(data, start)
+                self._index[fingerprint] = (segment_path, offset, length)
+            self._index_path2size[index_path] = loaded_size + number * INDEX_RECORD.size
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, url):
+        return url_fingerprint(url) in self._index
+
+    def iter_locations(self):
+        """遍历所有记录的位置
+            Yields:
+                location: tuple, (segment路径, 偏移, 长度)
+        """
+        return self._index.itervalues()
+
+    def read(self, url):
+        """读取url对应的记录
+            Args:
+                url: str, url
+            Returns:
+                url, code, headers, body, callback, kwargs: 元组
+            Raises:
+                ArchiveError: 不存在或者读取失败
+        """
+        fingerprint = url_fingerprint(url)
+        if fingerprint not in self._index:
+            try:
+                self.refresh()
+            except IOError, e:
+                raise ArchiveError("refresh archive index error:%s" % e)
+        location = self._index.get(fingerprint)
+        if location is None:
+            raise ArchiveError("not in archive url:%s" % url)
+        return read_record(*location)
+
+
+def read_record(segment_path, offset, length):
+    """读取某个位置的记录
+        Args:
+            segment_path: str, segment路径
+            offset: int, 偏移
+            length: int, 长度
+        Returns:
+            url, code, headers, body, callback, kwargs: 元组
+        Raises:
+            ArchiveError: 读取失败
+    """
+    try:
+        with open(segment_path, "rb") as segment_file:
+            segment_file.seek(offset)
+            data = segment_file.read(length)
+        record = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+    except (IOError, zlib.error), e:
+        raise ArchiveError("read archive %s error:%s" % (segment_path, e))
+    return parse_record(record)
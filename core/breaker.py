@@ -0,0 +1,192 @@
+#!/usr/bin/python2.7
+#-*- coding=utf-8 -*-
+
+
+"""按host熔断的模块
+    CircuitOpenError: 熔断打开时，请求不会发出，返回这个错误
+    CircuitBreaker: 一个host的熔断器
+    BreakerManager: 管理所有host的熔断器
+"""
+
+__authors__ = ['"wuyadong" <wuyadong@tigerknows.com>']
+
+import time
+import logging
+import threading
+from collections import deque
+
+STATE_CLOSED = "closed"
+STATE_OPEN = "open"
+STATE_HALF_OPEN = "half-open"
+
+DEFAULT_WINDOW_SIZE = 20  # 统计错误率的最近请求个数
+DEFAULT_MIN_REQUESTS = 10  # 至少有这么多请求才会计算错误率
+DEFAULT_ERROR_RATE = 0.5  # 错误率达到此值时打开
+DEFAULT_OPEN_SECONDS = 30  # 打开状态持续的时间
+DEFAULT_HALF_OPEN_REQUESTS = 1  # 半开状态下允许同时试探的请求个数
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitOpenError(Exception):
+    """熔断打开，请求没有发出
+    """
+
+
+class CircuitBreaker(object):
+    """一个host的熔断器
+        closed: 正常请求，记录最近请求的结果，错误率过高时打开
+        open: 所有请求直接拒绝，持续open_seconds后进入half-open
+        half-open: 只放过少量试探请求，成功则关闭，失败则重新打开
+    """
+
+    def __init__(self, window_size=DEFAULT_WINDOW_SIZE, min_requests=DEFAULT_MIN_REQUESTS,
+                 error_rate=DEFAULT_ERROR_RATE, open_seconds=DEFAULT_OPEN_SECONDS,
+                 half_open_requests=DEFAULT_HALF_OPEN_REQUESTS):
+        self._results = deque(maxlen=window_size)
+        self._min_requests = min_requests
+        self._error_rate = error_rate
+        self._open_seconds = open_seconds
+        self._half_open_requests = half_open_requests
+        self._state = STATE_CLOSED
+        self._opened_time = 0
+        self._probing_number = 0
+
+    @property
+    def state(self):
+        if self._state == STATE_OPEN and \
+                time.time() - self._opened_time >= self._open_seconds:
+            self._state = STATE_HALF_OPEN
+            self._probing_number = 0
+        return self._state
+
+    @property
+    def retry_after(self):
+        """距离进入half-open还有多少秒，不是open状态时为0
+        """
+        if self.state != STATE_OPEN:
+            return 0
+        return max(self._opened_time + self._open_seconds - time.time(), 0)
+
+    @property
+    def error_rate(self):
+        if len(self._results) == 0:
+            return 0.0
+        return float(self._results.count(False)) / len(self._results)
+
+    def allow_request(self):
+        """是否允许发出请求
+            Returns:
+                is_allowed: bool
+        """
+        state = self.state
+        if state == STATE_CLOSED:
+            return True
+        elif state == STATE_HALF_OPEN and self._probing_number < self._half_open_requests:
+            self._probing_number += 1
+            return True
+        else:
+            return False
+
+    def cancel_request(self):
+        """allow_request允许的请求最后没有发出，归还半开状态的试探名额
+        """
+        if self._state == STATE_HALF_OPEN:
+            self._probing_number = max(self._probing_number - 1, 0)
+
+    def record(self, is_success):
+        """记录一次请求的结果
+            Args:
+                is_success: bool, 请求是否成功
+        """
+        if self._state == STATE_HALF_OPEN:
+            self._probing_number = max(self._probing_number - 1, 0)
+            if is_success:
+                self._state = STATE_CLOSED
+                self._results.clear()
+            else:
+                self._open()
+            return
+        elif self._state == STATE_OPEN:
+            # 打开之前发出的请求
+            return
+
+        self._results.append(is_success)
+        if self._state == STATE_CLOSED and len(self._results) >= self._min_requests \
+                and self.error_rate >= self._error_rate:
+            self._open()
+
+    def _open(self):
+        self._state = STATE_OPEN
+        self._opened_time = time.time()
+        self._results.clear()
+
+    def to_dict(self):
+        return {"state": self.state, "error_rate": self.error_rate,
+                "requests": len(self._results)}
+
+
+class BreakerManager(object):
+    """管理所有host的熔断器
+    """
+    _lock = threading.Lock()
+
+    def __init__(self, **kwargs):
+        """初始化
+            Args:
+                kwargs: dict, 创建CircuitBreaker的参数
+        """
+        self._breakers = {}
+        self._kwargs = kwargs
+
+    @staticmethod
+    def instance():
+        """获取熔断器管理者
+            单例模式
+            Returns:
+                manager: BreakerManager 实例
+        """
+        if not hasattr(BreakerManager, "_instance"):
+            with BreakerManager._lock:
+                setattr(BreakerManager, "_instance", BreakerManager())
+        return getattr(BreakerManager, "_instance")
+
+    def get_breaker(self, host):
+        """获取host对应的熔断器，不存在就创建
+            Args:
+                host: str, host
+            Returns:
+                breaker: CircuitBreaker
+        """
+        if not self._breakers.has_key(host):
+            self._breakers[host] = CircuitBreaker(**self._kwargs)
+        return self._breakers[host]
+
+    def allow_request(self, host):
+        return self.get_breaker(host).allow_request()
+
+    def cancel_request(self, host):
+        self.get_breaker(host).cancel_request()
+
+    def get_retry_after(self, host):
+        """获取host的熔断器距离进入half-open的秒数
+            Args:
+                host: str, host
+            Returns:
+                seconds: float, 不是open状态时为0
+        """
+        return self.get_breaker(host).retry_after
+
+    def record(self, host, is_success):
+        breaker = self.get_breaker(host)
+        old_state = breaker.state
+        breaker.record(is_success)
+        if breaker.state != old_state:
+            logger.warn("breaker of host:%s from %s to %s" % (host, old_state, breaker.state))
+
+    def get_status(self):
+        """获取所有熔断器的状态
+            Returns:
+                status: dict, host到状态的字典
+        """
+        return dict((host, breaker.to_dict()) for host, breaker in self._breakers.iteritems())
@@ -10,10 +10,20 @@ class HttpTask(object):
     task 中有三类参数：
     一类：request，表明http请求时的参数
     一类: 用于控制流程的控制标签
+    后来增加的控制标签在类上有默认值，升级之前放入redis的task反序列化后没有这些属性
     """
+    stream_need = False
+    max_body_size = None
+    proxy_need = False
+    hedge_percentile = None
+    adaptive_timeout = False
+    robots_need = False
+
     def __init__(self, request, callback, fail_count=0, reason=None,
                  cookie_host=None, cookie_count=20, dns_need=False,
-                max_fail_count=2, kwargs=None):
+                max_fail_count=2, kwargs=None, stream_need=False, max_body_size=None,
+                 proxy_need=False, hedge_percentile=None, adaptive_timeout=False,
+                 robots_need=False):
         if kwargs == None:
             self.kwargs = dict()
         else:
@@ -27,13 +37,21 @@ class HttpTask(object):
         self.cookie_count = cookie_count
         self.max_fail_count = max_fail_count
         self.dns_need = dns_need
+        self.stream_need = stream_need
+        self.max_body_size = max_body_size
+        self.proxy_need = proxy_need
+        self.hedge_percentile = hedge_percentile
+        self.adaptive_timeout = adaptive_timeout
+        self.robots_need = robots_need
 
 
 class FileTask(object):
     """file task
     """
+    archive_url = None
+
     def __init__(self, file_path, callback, fail_count=0,
-                 reason=None, max_fail_count=2, kwargs=None):
+                 reason=None, max_fail_count=2, kwargs=None, archive_url=None):
         """初始化函数
             Args:
                 input_file: File, 文件对象
@@ -42,6 +60,7 @@ class FileTask(object):
                 reason: str, 错误原因
                 max_fail_count: int, 最大失败次数
                 kwargs: dict, 参数字典
+                archive_url: str, 不为None时file_path是归档目录，从归档中读取这个url的body
         """
         if kwargs == None:
             self.kwargs = dict()
@@ -53,6 +72,7 @@ class FileTask(object):
         self.fail_count = fail_count
         self.reason = reason
         self.max_fail_count = max_fail_count
+        self.archive_url = archive_url
 
 
 class Item(object):
@@ -4,13 +4,45 @@
 
 """用于操作数据库的类
     DBError: exception, 关于db的错误类
+    ConnectionPool: 按连接参数共享的连接池
     DB: 关于db操作的类
+    AsyncDB: 在单独的线程中执行db操作，返回Future，不阻塞IOLoop
+    KnownKeyIndex: 已经写入数据库的key的索引
+    content_digest(): 计算内容的摘要
+    row_digest(): 计算一行中多列的摘要
+    digest_sql(): 在数据库中计算与row_digest相同的摘要的SQL表达式
+    BatchUpserter: 缓存多行数据，按个数或者时间批量写入
 """
 
 __authors__ = ['"wuyadong" <wuyadong@tigerknows.com>']
 
+import re
+import time
+import uuid
+import datetime
+import struct
+import hashlib
+import Queue
+import logging
+import cStringIO
+import threading
+import functools
+
 import psycopg2
 import psycopg2.extras
+import psycopg2.extensions
+from tornado import ioloop
+from tornado.concurrent import Future
+
+DEFAULT_POOL_SIZE = 5  # 每个连接参数的最大连接数
+DEFAULT_POOL_TIMEOUT = 10  # 等待空闲连接的最长时间，单位秒
+HEALTH_CHECK_INTERVAL = 30  # 空闲超过这个时间的连接取出时检查是否可用，单位秒
+DEFAULT_FETCH_SIZE = 1000  # 流式查询每次从服务器取的行数
+# 多列的摘要: 每列转换为与数据库中col::text相同的文本，NULL为chr(1)，用chr(31)连接后计算md5
+DIGEST_NULL = "\x01"
+DIGEST_SEPARATOR = "\x1f"
+
+logger = logging.getLogger(__name__)
 
 
 class DBError(Exception):
@@ -19,52 +51,746 @@ class DBError(Exception):
     """
 
 
+class PooledConnection(object):
+    """连接池中的一个连接，带有这个连接上已经预处理的语句
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.statements = {}  # sql到(语句名, 参数名列表)的字典
+        self.staging_tables = set()
+        self.last_used_time = time.time()
+
+
+class ConnectionPool(object):
+    """按连接参数(DSN)共享的连接池
+        同一个进程中连接参数相同的DB共享连接，连接数不超过max_size，
+        空闲超过HEALTH_CHECK_INTERVAL的连接取出时先检查是否可用
+    """
+    _lock = threading.Lock()
+    _pools = {}
+
+    def __init__(self, max_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_POOL_TIMEOUT, **kwargs):
+        """初始化
+            Args:
+                max_size: int, 最大连接数
+                timeout: float, 没有空闲连接时等待的最长时间，单位秒
+                kwargs: dict, psycopg2.connect的参数
+        """
+        self._kwargs = kwargs
+        self._max_size = max_size
+        self._timeout = timeout
+        self._size = 0
+        self._idle_connections = []
+        self._condition = threading.Condition()
+
+    @staticmethod
+    def get_pool(max_size=None, **kwargs):
+        """获取连接参数对应的连接池，第一次获取时创建
+            Args:
+                max_size: int, 创建时的最大连接数，None表示默认值
+                kwargs: dict, psycopg2.connect的参数
+            Returns:
+                pool: ConnectionPool
+        """
+        key = tuple(sorted(kwargs.iteritems()))
+        with ConnectionPool._lock:
+            if not ConnectionPool._pools.has_key(key):
+                ConnectionPool._pools[key] = ConnectionPool(max_size or DEFAULT_POOL_SIZE, **kwargs)
+            return ConnectionPool._pools[key]
+
+    @staticmethod
+    def get_all_status():
+        """获取所有连接池的状态
+            Returns:
+                status: list, [{"dsn", "size", "idle", "max_size"}]
+        """
+        with ConnectionPool._lock:
+            pools = ConnectionPool._pools.values()
+        return [pool.get_status() for pool in pools]
+
+    def get_connection(self):
+        """取出一个可用的连接
+            Returns:
+                connection: PooledConnection
+            Raise:
+                DBError: 连接失败，或者等待超时
+        """
+        deadline = time.time() + self._timeout
+        with self._condition:
+            while True:
+                while self._idle_connections:
+                    connection = self._idle_connections.pop()
+                    if _is_healthy(connection):
+                        return connection
+                    self._size -= 1
+                    _close_quietly(connection)
+                if self._size < self._max_size:
+                    self._size += 1
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise DBError("connection pool of %s is exhausted" % self._kwargs.get("host"))
+                self._condition.wait(remaining)
+
+        try:
+            return PooledConnection(psycopg2.connect(**self._kwargs))
+        except psycopg2.Error, e:
+            with self._condition:
+                self._size -= 1
+                self._condition.notify()
+            raise DBError, e
+
+    def put_connection(self, connection, is_broken=False):
+        """归还连接，未结束的事务会被回滚
+            Args:
+                connection: PooledConnection, 连接
+                is_broken: bool, 连接是否已经不可用
+        """
+        if not is_broken and not connection.conn.closed:
+            try:
+                if connection.conn.get_transaction_status() != \
+                        psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    connection.conn.rollback()
+            except psycopg2.Error:
+                is_broken = True
+        with self._condition:
+            if is_broken or connection.conn.closed:
+                self._size -= 1
+                _close_quietly(connection)
+            else:
+                connection.last_used_time = time.time()
+                self._idle_connections.append(connection)
+            self._condition.notify()
+
+    def get_status(self):
+        return {"dsn": "%s:%s/%s" % (self._kwargs.get("host"), self._kwargs.get("port"),
+                                     self._kwargs.get("database")),
+                "size": self._size, "idle": len(self._idle_connections),
+                "max_size": self._max_size}
+
+
+def _is_healthy(connection):
+    """检查连接是否可用，最近用过的连接不检查
+    """
+    if connection.conn.closed:
+        return False
+    if time.time() - connection.last_used_time < HEALTH_CHECK_INTERVAL:
+        return True
+    try:
+        cur = connection.conn.cursor()
+        cur.execute("SELECT 1")
+        cur.close()
+        connection.conn.rollback()
+    except psycopg2.Error:
+        return False
+    return True
+
+
+def _close_quietly(connection):
+    try:
+        connection.conn.close()
+    except psycopg2.Error:
+        pass
+
+
+_PARAMETER_PATTERN = re.compile(r"%\((\w+)\)s|%s|%%")
+
+
+def _convert_to_prepare(sql):
+    """把psycopg2格式的sql转换为PREPARE使用的$n格式
+        Args:
+            sql: str, 使用%(name)s或者%s参数的sql
+        Returns:
+            prepare_sql, parameter_names: 转换后的sql, 每个$n对应的参数名(位置参数为下标)
+    """
+    parameter_names = []
+
+    def replace(match):
+        if match.group(0) == "%%":
+            return "%"
+        name = match.group(1)
+        if name is None:
+            name = len(parameter_names)
+        elif name in parameter_names:
+            return "$%d" % (parameter_names.index(name) + 1)
+        parameter_names.append(name)
+        return "$%d" % len(parameter_names)
+    return _PARAMETER_PATTERN.sub(replace, sql), parameter_names
+
+
+def _execute(connection, cur, sql, parameters=None, prepare=False):
+    """执行sql，prepare为True时每个连接上只预处理一次，之后使用EXECUTE
+    """
+    if not prepare:
+        cur.execute(sql, parameters)
+        return
+
+    if not connection.statements.has_key(sql):
+        name = "stmt_%d" % len(connection.statements)
+        prepare_sql, parameter_names = _convert_to_prepare(sql)
+        cur.execute("PREPARE %s AS %s" % (name, prepare_sql))
+        connection.statements[sql] = (name, parameter_names)
+    name, parameter_names = connection.statements[sql]
+    if parameter_names:
+        cur.execute("EXECUTE %s (%s)" % (name, ", ".join(["%s"] * len(parameter_names))),
+                    [parameters[parameter_name] for parameter_name in parameter_names])
+    else:
+        cur.execute("EXECUTE %s" % name)
+
+
 class DB(object):
-    def __init__(self, **kwargs):
+    """数据库操作
+        每次操作从连接池中取出连接，操作完成后归还，多个DB共享同一个连接池
+    """
+
+    def __init__(self, pool_size=None, **kwargs):
+        """初始化
+            Args:
+                pool_size: int, 连接池的最大连接数，只在第一次创建连接池时生效
+                kwargs: dict, psycopg2.connect的参数
+            Raise:
+                DBError: 连接失败
+        """
+        self._pool = ConnectionPool.get_pool(pool_size, **kwargs)
+        # 连接参数错误时在初始化时就报错
+        self._pool.put_connection(self._pool.get_connection())
+
+    def _run(self, operation):
+        """从连接池中取出连接执行操作
+            Args:
+                operation: function, operation(connection, cur)
+            Returns:
+                result: operation的返回值
+            Raise:
+                DBError: 错误，这时事务已经回滚
+        """
+        connection = self._pool.get_connection()
+        statement_count = len(connection.statements)
+        is_broken = False
         try:
-            self.conn = psycopg2.connect(**kwargs)
-            self.cur = self.conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+            cur = connection.conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+            try:
+                return operation(connection, cur)
+            finally:
+                cur.close()
         except psycopg2.Error, e:
+            # 失败的事务中预处理的语句是否还存在不确定，直接丢弃这个连接
+            is_broken = isinstance(e, psycopg2.OperationalError) or connection.conn.closed or \
+                len(connection.statements) != statement_count
+            if not is_broken:
+                try:
+                    connection.conn.rollback()
+                except psycopg2.Error:
+                    is_broken = True
             raise DBError, e
+        finally:
+            self._pool.put_connection(connection, is_broken)
 
-    def execute_query(self, sql, parameters=None):
+    def execute_query(self, sql, parameters=None, prepare=False):
         """执行查询操作
             Args:
                 sql: str, sql 语句
                 parameters: str, 参数语句
+                prepare: bool, 是否使用预处理语句，频繁执行的语句每个连接只解析一次
+            Raise:
+                DBError: Exception, 错误
+        """
+        def query(connection, cur):
+            _execute(connection, cur, sql, parameters, prepare)
+            return cur.fetchall()
+        return self._run(query)
+
+    def iter_query(self, sql, parameters=None, fetch_size=DEFAULT_FETCH_SIZE):
+        """流式查询，使用服务器端的命名游标，每次取fetch_size行
+            适合扫描大表，内存占用与结果的行数无关，遍历结束或者生成器关闭时归还连接
+            Args:
+                sql: str, sql 语句
+                parameters: str, 参数语句
+                fetch_size: int, 每次从服务器取的行数
+            Returns:
+                rows: generator, 逐行返回结果
             Raise:
                 DBError: Exception, 错误
         """
+        connection = self._pool.get_connection()
+        is_broken = False
         try:
-            self.cur.execute(sql, parameters)
+            cur = connection.conn.cursor("stream_%s" % uuid.uuid4().hex,
+                                         cursor_factory=psycopg2.extras.DictCursor)
+            try:
+                cur.execute(sql, parameters)
+                while True:
+                    rows = cur.fetchmany(fetch_size)
+                    if not rows:
+                        break
+                    for row in rows:
+                        yield row
+            finally:
+                try:
+                    cur.close()
+                except psycopg2.Error:
+                    pass
         except psycopg2.Error, e:
+            is_broken = isinstance(e, psycopg2.OperationalError) or connection.conn.closed
             raise DBError, e
-        else:
-            items = self.cur.fetchall()
-            return items
+        finally:
+            # 归还时回滚查询所在的事务
+            self._pool.put_connection(connection, is_broken)
 
-    def execute_update(self, sql, parameters=None):
+    def execute_update(self, sql, parameters=None, prepare=False):
         """执行更新操作
             Args:
                 sql: str, sql语句
                 parameters: str, 参数
+                prepare: bool, 是否使用预处理语句
 
             Raise:
                 DBError:Exception, 错误
         """
-        try:
-            self.cur.execute(sql, parameters)
-        except psycopg2.Error, e:
-            self.conn.rollback()
-            raise DBError, e
-        else:
-            self.conn.commit()
+        def update(connection, cur):
+            _execute(connection, cur, sql, parameters, prepare)
+            connection.conn.commit()
+        self._run(update)
+
+    def upsert_many(self, table, columns, key_columns, update_columns, rows, is_known=None):
+        """批量写入多行数据，已经存在的行更新，不存在的插入，只提交一次
+            先用COPY写入临时表，再与目标表合并，不依赖目标表上的唯一约束，
+            知道行都不存在时先插入，插入的行数不足时再更新(插入只处理临时表中的行，行数可以比较)，
+            其它情况先更新再插入不存在的行，目标表中同一个key可能有多行，更新的行数不能说明
+            临时表中的行都已经存在
+            Args:
+                table: str, 目标表
+                columns: list, 写入的所有列
+                key_columns: list, 判断行是否存在的列
+                update_columns: list, 行已经存在时更新的列
+                rows: list, 每一行是列名到值的字典
+                is_known: bool, True表示这些行已经存在，False表示不存在，None表示不知道
+            Raise:
+                DBError: Exception, 错误，这时所有行都没有写入
+        """
+        if not rows:
+            return
+        staging_table = "%s_staging" % table
+        column_sql = ", ".join(columns)
+        key_sql = " AND ".join("t.%s=s.%s" % (column, column) for column in key_columns)
+        update_sql = ", ".join("%s=s.%s" % (column, column) for column in update_columns)
+
+        def update(connection, cur):
+            if not update_sql:
+                return 0
+            _execute(connection, cur, "UPDATE %s t SET %s FROM %s s WHERE %s" %
+                     (table, update_sql, staging_table, key_sql), prepare=True)
+            return cur.rowcount
+
+        def insert(connection, cur):
+            _execute(connection, cur, "INSERT INTO %s (%s) SELECT %s FROM %s s WHERE NOT EXISTS "
+                     "(SELECT 1 FROM %s t WHERE %s)" %
+                     (table, column_sql, column_sql, staging_table, table, key_sql), prepare=True)
+            return cur.rowcount
+
+        def upsert(connection, cur):
+            if staging_table not in connection.staging_tables:
+                cur.execute("CREATE TEMP TABLE IF NOT EXISTS %s (LIKE %s INCLUDING DEFAULTS)"
+                            " ON COMMIT DELETE ROWS" % (staging_table, table))
+            cur.copy_expert("COPY %s (%s) FROM STDIN WITH CSV" % (staging_table, column_sql),
+                            _build_csv(columns, rows))
+            if is_known is False:
+                if insert(connection, cur) < len(rows):
+                    update(connection, cur)
+            else:
+                update(connection, cur)
+                insert(connection, cur)
+            connection.conn.commit()
+            # 回滚时临时表也会被删除，提交后再记录
+            connection.staging_tables.add(staging_table)
+        self._run(upsert)
 
     def close(self):
         """关闭，释放资源
+            连接属于共享的连接池，不需要关闭
+        """
+        pass
+
 
+class AsyncDB(object):
+    """在单独的线程中执行db操作
+        操作按顺序放入有界队列，由线程依次执行，结果通过IOLoop设置到Future中，
+        pipeline可以yield返回的Future，db的延迟不再阻塞下载
+    """
+
+    def __init__(self, max_queue_size=1000, **kwargs):
+        """初始化
+            Args:
+                max_queue_size: int, 等待执行的操作的最大个数
+                kwargs: dict, DB的参数
+            Raise:
+                DBError: 连接失败
+        """
+        self._db = DB(**kwargs)
+        self._io_loop = ioloop.IOLoop.instance()
+        self._queue = Queue.Queue(max_queue_size)
+        self._thread = threading.Thread(target=self._run, name="async-db")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _submit(self, method, *args):
+        """放入一个操作
+            Returns:
+                future: Future, 队列已满时设置为DBError
+        """
+        future = Future()
+        try:
+            self._queue.put_nowait((future, method, args))
+        except Queue.Full:
+            future.set_exception(DBError("db queue is full"))
+        return future
+
+    def _run(self):
+        while True:
+            operation = self._queue.get()
+            if operation is None:
+                break
+            future, method, args = operation
+            try:
+                result = method(*args)
+            except Exception, e:
+                self._io_loop.add_callback(future.set_exception, e)
+            else:
+                self._io_loop.add_callback(future.set_result, result)
+
+    @property
+    def queue_size(self):
+        return self._queue.qsize()
+
+    def execute_query(self, sql, parameters=None):
+        """见DB.execute_query
+            Returns:
+                future: Future, 结果是查询到的所有行
+        """
+        return self._submit(self._db.execute_query, sql, parameters)
+
+    def execute_update(self, sql, parameters=None):
+        """见DB.execute_update
+            Returns:
+                future: Future
+        """
+        return self._submit(self._db.execute_update, sql, parameters)
+
+    def upsert_many(self, table, columns, key_columns, update_columns, rows, is_known=None):
+        """见DB.upsert_many
+            Returns:
+                future: Future
+        """
+        return self._submit(self._db.upsert_many, table, columns, key_columns,
+                            update_columns, rows, is_known)
+
+    def iter_query(self, sql, parameters=None, fetch_size=DEFAULT_FETCH_SIZE):
+        """见DB.iter_query
+            在调用者的线程中同步执行，用于初始化时的加载
+        """
+        return self._db.iter_query(sql, parameters, fetch_size)
+
+    def close(self):
+        """等待队列中的操作执行完，关闭连接
+        """
+        self._queue.put(None)
+        self._thread.join()
+        self._db.close()
+
+
+def _csv_value(value):
+    """转换为COPY CSV格式的值，None为NULL，其它值都加引号(空字符串不会变成NULL)
+    """
+    if value is None:
+        return ""
+    if isinstance(value, unicode):
+        value = value.encode("utf-8")
+    elif not isinstance(value, str):
+        value = str(value)
+    return '"%s"' % value.replace('"', '""')
+
+
+def _build_csv(columns, rows):
+    """把多行数据转换为COPY使用的CSV文件对象
+    """
+    csv_file = cStringIO.StringIO()
+    for row in rows:
+        csv_file.write(",".join(_csv_value(row.get(column)) for column in columns))
+        csv_file.write("\n")
+    csv_file.seek(0)
+    return csv_file
+
+
+class KnownKeyIndex(object):
+    """已经写入数据库的key的索引
+        只保存key的64位指纹和内容的64位摘要，用于不查询数据库就判断一行是否已经存在、内容是否变化，
+        指纹冲突时会被当作已经存在，upsert_many对已经存在的行也会插入不存在的部分，不会丢失数据
+    """
+
+    def __init__(self):
+        self._key2digest = {}  # key的指纹到内容的摘要，没有摘要时为None
+
+    def __len__(self):
+        return len(self._key2digest)
+
+    def __contains__(self, key):
+        return _key_fingerprint(key) in self._key2digest
+
+    def add(self, key, digest=None):
+        """加入一个key
+            Args:
+                key: tuple, key列的值
+                digest: int, 内容的摘要，None表示不知道内容
+        """
+        self._key2digest[_key_fingerprint(key)] = digest
+
+    def get_digest(self, key):
+        """获取key对应内容的摘要
+            Args:
+                key: tuple, key列的值
+            Returns:
+                digest: int, 不存在或者不知道内容时返回None
+        """
+        return self._key2digest.get(_key_fingerprint(key))
+
+    def load(self, rows, key_columns, digest_column=None):
+        """从查询结果中加载，通常使用DB.iter_query流式加载
+            Args:
+                rows: iterable, 查询结果的行
+                key_columns: list, key的列
+                digest_column: str, 内容md5的列，用digest_sql计算，None表示不加载摘要
+            Returns:
+                count: int, 加载的行数
+        """
+        count = 0
+        for row in rows:
+            digest = None
+            if digest_column is not None and row[digest_column]:
+                digest = int(row[digest_column][:16], 16)
+            self.add(tuple(row[column] for column in key_columns), digest)
+            count += 1
+        return count
+
+
+def _key_fingerprint(key):
+    """计算key的64位指纹
+    """
+    key = tuple(value.encode("utf-8") if isinstance(value, unicode) else value for value in key)
+    return struct.unpack("<q", hashlib.md5(repr(key)).digest()[:8])[0]
+
+
+def content_digest(value):
+    """计算内容的64位摘要，与数据库中md5(value)的前16位一致
+        Args:
+            value: str or unicode, 内容
+        Returns:
+            digest: int
+    """
+    if isinstance(value, unicode):
+        value = value.encode("utf-8")
+    return int(hashlib.md5(value).hexdigest()[:16], 16)
+
+
+def _digest_text(value):
+    """转换为与数据库中value::text相同的文本
+        支持文本、整数、不带时区的时间和json(不支持jsonb，jsonb会重新格式化)，
+        其它类型的文本可能不一致，只会导致内容没有变化的行也被写入
+    """
+    if value is None:
+        return DIGEST_NULL
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, datetime.datetime):
+        # 数据库中的时间去掉小数秒末尾的0
+        text = value.strftime("%Y-%m-%d %H:%M:%S")
+        if value.microsecond:
+            text += (".%06d" % value.microsecond).rstrip("0")
+        return text
+    return str(value)
+
+
+def row_digest(row, columns):
+    """计算一行中多列的64位摘要，与数据库中digest_sql(columns)的前16位一致
+        Args:
+            row: dict, 列名到值的字典
+            columns: list, 计算摘要的列
+        Returns:
+            digest: int
+    """
+    return content_digest(DIGEST_SEPARATOR.join(_digest_text(row.get(column))
+                                                 for column in columns))
+
+
+def digest_sql(columns):
+    """在数据库中计算与row_digest相同的摘要的SQL表达式
+        Args:
+            columns: list, 计算摘要的列
+        Returns:
+            sql: str, 例如md5(concat_ws(chr(31), coalesce(a::text, chr(1)), ...))
+    """
+    return "md5(concat_ws(chr(31), %s))" % ", ".join("coalesce(%s::text, chr(1))" % column
+                                                     for column in columns)
+
+
+class BatchUpserter(object):
+    """缓存多行数据，个数达到flush_size或者最早的数据等待超过flush_interval时批量写入
+        同一个key的多行数据只保留最后一行，
+        设置了digest_columns时，这些列与上次写入相同的行不再写入，
+        每一行返回一个Future，所在的批写入完成后设置，失败时设置为DBError，
+        pipeline返回这个Future，写入失败的item由worker按失败的task处理
+    """
+
+    def __init__(self, db, table, columns, key_columns, update_columns,
+                 flush_size=500, flush_interval=1.0, key_index=None, digest_columns=None):
+        """初始化
+            Args:
+                db: DB or AsyncDB, 数据库
+                table: str, 目标表
+                columns: list, 写入的所有列
+                key_columns: list, 判断行是否存在的列
+                update_columns: list, 行已经存在时更新的列
+                flush_size: int, 缓存的最大行数
+                flush_interval: float, 缓存的最长时间，单位秒
+                key_index: KnownKeyIndex, 已经写入的key，写入时按已存在和不存在分开写，
+                    写入成功后加入索引
+                digest_columns: list, 比较内容的列，需要key_index，这些列都没有变化的行跳过，
+                    通常是除了更新时间之外的所有更新列，预热key_index时用digest_sql计算摘要
+        """
+        self._db = db
+        self._table = table
+        self._columns = columns
+        self._key_columns = key_columns
+        self._update_columns = update_columns
+        self._flush_size = flush_size
+        self._flush_interval = flush_interval
+        self._key_index = key_index
+        self._digest_columns = digest_columns if key_index is not None else None
+        self._key2row = {}
+        self._key2futures = {}  # 等待写入的行对应的Future，同一个key的多行共用一次写入
+        self._first_add_time = None
+        self.flushed_count = 0
+        self.failed_count = 0
+        self.skipped_count = 0
+        self._flush_callback = ioloop.PeriodicCallback(
+            self._flush_timeout, flush_interval * 1000, io_loop=ioloop.IOLoop.instance())
+        self._flush_callback.start()
+
+    def __len__(self):
+        return len(self._key2row)
+
+    def add(self, row):
+        """加入一行数据，缓存满时写入
+            Args:
+                row: dict, 列名到值的字典
+            Returns:
+                future: Future, 写入完成后结果为True，内容没有变化跳过时已经设置为False，
+                    写入失败时设置为DBError
+        """
+        future = Future()
+        key = tuple(row[column] for column in self._key_columns)
+        if self._digest_columns is not None and key not in self._key2row:
+            digest = self._key_index.get_digest(key)
+            if digest is not None and digest == row_digest(row, self._digest_columns):
+                self.skipped_count += 1
+                future.set_result(False)
+                return future
+        if not self._key2row:
+            self._first_add_time = time.time()
+        self._key2row[key] = row
+        self._key2futures.setdefault(key, []).append(future)
+        if len(self._key2row) >= self._flush_size:
+            try:
+                self.flush()
+            except DBError, e:
+                logger.error("flush %s error:%s" % (self._table, e))
+        return future
+
+    def _flush_timeout(self):
+        if self._key2row and time.time() - self._first_add_time >= self._flush_interval:
+            try:
+                self.flush()
+            except DBError, e:
+                logger.error("flush %s error:%s" % (self._table, e))
+
+    def flush(self):
+        """写入所有缓存的数据，失败时这批数据不再保留，行对应的Future设置为DBError
+            db是AsyncDB时不等待写入完成，结果通过Future通知
+            Raise:
+                DBError: 写入失败
+        """
+        if not self._key2row:
+            return
+        key2row, self._key2row = self._key2row, {}
+        key2futures, self._key2futures = self._key2futures, {}
+        if self._key_index is None:
+            self._upsert(key2row, None, key2futures)
+        else:
+            known_key2row, new_key2row = {}, {}
+            for key, row in key2row.iteritems():
+                if key in self._key_index:
+                    known_key2row[key] = row
+                else:
+                    new_key2row[key] = row
+            try:
+                self._upsert(known_key2row, True, key2futures)
+            finally:
+                self._upsert(new_key2row, False, key2futures)
+
+    def _upsert(self, key2row, is_known, key2futures):
+        if not key2row:
+            return
+        if self._digest_columns is not None:
+            # 写入前记录摘要，写入过程中再加入的相同内容直接跳过，失败时清除
+            for key, row in key2row.iteritems():
+                self._key_index.add(key, row_digest(row, self._digest_columns))
+        try:
+            result = self._db.upsert_many(self._table, self._columns, self._key_columns,
+                                          self._update_columns, key2row.values(), is_known)
+        except DBError, e:
+            self._handle_failed(key2row, key2futures, e)
+            raise
+        if isinstance(result, Future):
+            result.add_done_callback(functools.partial(self._handle_flush_result, key2row,
+                                                       key2futures))
+        else:
+            self._handle_flushed(key2row, key2futures)
+
+    def _handle_flushed(self, key2row, key2futures):
+        self.flushed_count += len(key2row)
+        if self._key_index is not None and self._digest_columns is None:
+            for key in key2row.iterkeys():
+                self._key_index.add(key)
+        for key in key2row.iterkeys():
+            for future in key2futures.get(key, ()):
+                future.set_result(True)
+
+    def _handle_failed(self, key2row, key2futures, error):
+        self.failed_count += len(key2row)
+        if self._digest_columns is not None:
+            for key in key2row.iterkeys():
+                self._key_index.add(key, None)
+        if not isinstance(error, DBError):
+            error = DBError("flush %s error:%s" % (self._table, error))
+        for key in key2row.iterkeys():
+            for future in key2futures.get(key, ()):
+                future.set_exception(error)
+
+    def _handle_flush_result(self, key2row, key2futures, future):
+        """AsyncDB写入完成后的回调，队列已满时也会设置为DBError
+        """
+        if future.exception() is not None:
+            logger.error("flush %s error:%s" % (self._table, future.exception()))
+            self._handle_failed(key2row, key2futures, future.exception())
+        else:
+            self._handle_flushed(key2row, key2futures)
+
+    def close(self):
+        """写入剩余的数据，停止定时写入
+            Raise:
+                DBError: 写入失败
         """
-        if self.cur:
-            self.cur.close()
-        if self.conn:
-            self.conn.close()
\ No newline at end of file
+        self._flush_callback.stop()
+        self.flush()
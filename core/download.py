@@ -8,16 +8,31 @@
 
 __authors__ = ['"wuyadong" <wuyadong@tigerknows.com>']
 
+import time
+import hashlib
 import socket
+import urlparse
 import logging
 
+import pycurl
 from tornado import gen, httpclient
 from tornado.httpclient import HTTPRequest
+from tornado.ioloop import IOLoop
+from tornado.concurrent import Future
 
 from core.datastruct import HttpTask
 from core.resolver import DNSResolver, ResolveError
-
-httpclient.AsyncHTTPClient.configure("tornado.curl_httpclient.CurlAsyncHTTPClient", max_clients=50)
+from core.proxy import ProxyPool
+from core.breaker import BreakerManager, CircuitOpenError
+from core.latency import LatencyTracker
+from core.hedge import hedged_fetch
+from core.httpcache import HttpCache, HttpCacheError, TeeStream
+from core.fetcher import FetcherSettings, HostLimiter, SlotArbiter, get_client, \
+    set_curl_progress
+from core.robots import RobotsCache, RobotsDisallowedError, CrawlDelayError
+from core.archive import ArchiveWriter
+
+FetcherSettings.instance().configure_client()
 
 _host_cookies = {"http://www.meituan.com": r"SID=id05a52uecv601av123577nmr3; ci=1; "
                  r"abt=1378729480.0%7CBDF; rvct=1; rvd=8190998;"
@@ -31,6 +46,7 @@ _host_cookies = {"http://www.meituan.com": r"SID=id05a52uecv601av123577nmr3; ci=
 _cookie_used_counts = {"http://www.meituan.com": 0}
 _cookie_is_buildings = set()
 _host_ip_cache = {}
+_inflight_fetches = {}  # 正在下载的请求，指纹到Future的字典
 
 logger = logging.getLogger(__name__)
 
@@ -39,6 +55,18 @@ DEFAULT_USER_AGENT = r"Mozilla/5.0 (Windows NT 5.1) AppleWebKit/537.36 (KHTML,"
 DEFAULT_ACCEPT_ENCODING = r"gzip,deflate,sdch"
 DEFAULT_ACCEPT = r"text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8"
 
+# 代理请求返回这些code时，认为代理不可用(599:连接失败或超时, 403/407:被封或者认证失败)
+PROXY_FAIL_CODES = (403, 407, 599)
+
+# 自适应超时: 超时时间 = 延迟的p99 * 系数，并限制在上下限之间，单位秒
+ADAPTIVE_TIMEOUT_PERCENTILE = 99
+ADAPTIVE_TIMEOUT_FACTOR = 2
+MIN_ADAPTIVE_TIMEOUT = 3
+MAX_ADAPTIVE_TIMEOUT = 120
+
+# 这些方法的相同请求在下载过程中会合并
+COALESCE_METHODS = ("GET", "HEAD")
+
 
 class GetPageError(Exception):
     """
@@ -47,16 +75,185 @@ class GetPageError(Exception):
 
 
 @gen.coroutine
-def fetch(http_task):
+def fetch(http_task, stream=None, slot_owner=None, slot_weight=1, progress_callback=None):
     """根据任务要求进行下载
         注意这个操作时异步的
+        相同url的GET请求正在下载时，不会重复发出，而是等待并共享同一个结果
+        Args:
+            http_task:http_task , 任务描述
+            stream: BaseStream, 如果不为None，body会分块写入stream，resp.body为空
+            slot_owner: str, 向SlotArbiter申请名额的owner，None表示不申请
+            slot_weight: float, owner的权重
+            progress_callback: function, progress_callback(download_total, downloaded)，
+                接收body的过程中调用，download_total是Content-Length，不知道时为0，
+                等待共享结果和回放缓存时不调用
+        Returns:
+            resp:Response, 下载的HTTP结果，resp.queue_time是发出请求之前等待的秒数
+                (Crawl-delay、host限制和名额)，resp.slot_wait是其中等待名额的秒数
+    """
+    # 流式接收的结果写在各自的stream中，只有写到同一个地方的才能共享
+    if (stream is not None and stream.share_key is None) or \
+            http_task.request.method not in COALESCE_METHODS:
+        resp = yield _fetch_and_finish(http_task, stream, slot_owner, slot_weight,
+                                       progress_callback)
+        raise gen.Return(resp)
+
+    fingerprint = request_fingerprint(http_task.request,
+                                      None if stream is None else stream.share_key)
+    if _inflight_fetches.has_key(fingerprint):
+        logger.debug("coalesce request url:%s" % http_task.request.url)
+        resp = yield _inflight_fetches[fingerprint]
+        raise gen.Return(resp)
+
+    future = Future()
+    _inflight_fetches[fingerprint] = future
+    try:
+        resp = yield _fetch_and_finish(http_task, stream, slot_owner, slot_weight,
+                                       progress_callback)
+    except Exception, e:
+        resp = e
+    finally:
+        _inflight_fetches.pop(fingerprint, None)
+    future.set_result(resp)
+    raise gen.Return(resp)
+
+
+def request_fingerprint(http_request, share_key=None):
+    """计算request的指纹
+        Args:
+            http_request: HttpRequest, request
+            share_key: str, stream的share_key
+        Returns:
+            fingerprint: str, 指纹
+    """
+    url = http_request.url if not isinstance(http_request.url, unicode) \
+        else http_request.url.encode("utf-8")
+    if isinstance(share_key, unicode):
+        share_key = share_key.encode("utf-8")
+    sha1 = hashlib.sha1("%s %s %s" % (http_request.method, url, share_key))
+    if http_request.body:
+        sha1.update(http_request.body)
+    return sha1.hexdigest()
+
+
+@gen.coroutine
+def _fetch_and_finish(http_task, stream, slot_owner=None, slot_weight=1, progress_callback=None):
+    """下载，成功后结束stream的写入，配置了归档时把结果追加到归档中
+        在返回结果之前结束，保证等待同一个请求的task拿到结果时stream已经完整，
+        归档或者录制时流式接收的body同时复制一份，两者共用一个TeeStream
         Args:
             http_task:http_task , 任务描述
+            stream: BaseStream, 接收body的stream
+            slot_owner: str, 向SlotArbiter申请名额的owner
+            slot_weight: float, owner的权重
+            progress_callback: function, 接收body的过程中调用
         Returns:
             resp:Response, 下载的HTTP结果
     """
+    archive_writer = ArchiveWriter.instance()
+    # 在dns解析修改url之前记录
+    url = http_task.request.url
+    cache = HttpCache.instance()
+    fetch_stream = stream
+    if stream is not None and (archive_writer is not None or cache.is_recording):
+        fetch_stream = TeeStream(stream)
+    if cache.is_replaying:
+        resp = cache.replay(request_fingerprint(http_task.request), http_task.request,
+                            fetch_stream)
+    elif cache.is_recording:
+        resp = yield _fetch_and_record(cache, http_task, fetch_stream, slot_owner, slot_weight,
+                                       progress_callback)
+    else:
+        resp = yield _fetch(http_task, fetch_stream, slot_owner, slot_weight, progress_callback)
+
+    if not isinstance(resp, Exception) and resp.code == 200 and resp.error is None:
+        if stream is not None:
+            stream.finish()
+        if archive_writer is not None:
+            if stream is None:
+                archive_response(archive_writer, url, http_task.callback, resp, resp.body,
+                                 http_task.kwargs)
+            elif not fetch_stream.is_overflowed:
+                archive_response(archive_writer, url, http_task.callback, resp,
+                                 fetch_stream.body, http_task.kwargs)
+    raise gen.Return(resp)
+
+
+def archive_response(archive_writer, url, callback, resp, body, kwargs=None):
+    """将response追加到归档中，记录callback和kwargs供重新解析时选择parser、还原task
+        Args:
+            archive_writer: ArchiveWriter, 归档写入者
+            url: str, 请求的url
+            callback: str, task的callback
+            resp: HTTPResponse, 结果
+            body: str, body，流式接收时是复制的body
+            kwargs: dict, task的kwargs
+    """
+    headers = list(resp.headers.get_all()) if resp.headers else []
+    archive_writer.append(url, resp.code, headers, body, callback, kwargs)
+
+
+@gen.coroutine
+def _fetch_and_record(cache, http_task, stream, slot_owner=None, slot_weight=1,
+                      progress_callback=None):
+    """下载，并将结果录制到缓存中
+        连接失败和超时的结果不录制
+        Args:
+            cache: HttpCache, 缓存
+            http_task:http_task , 任务描述
+            stream: TeeStream, 接收body并保留一份的stream，超过最大长度时不录制
+            slot_owner: str, 向SlotArbiter申请名额的owner
+            slot_weight: float, owner的权重
+            progress_callback: function, 接收body的过程中调用
+        Returns:
+            resp:Response, 下载的HTTP结果
+    """
+    # 在dns解析修改url之前计算指纹
+    fingerprint = request_fingerprint(http_task.request)
+    url = http_task.request.url
+    resp = yield _fetch(http_task, stream, slot_owner, slot_weight, progress_callback)
+    if not isinstance(resp, Exception) and resp.code != 599 and \
+            (stream is None or not stream.is_overflowed):
+        try:
+            cache.record(fingerprint, url, resp, resp.body if stream is None else stream.body)
+        except HttpCacheError, e:
+            logger.warn("record http cache error:%s" % e)
+    raise gen.Return(resp)
+
+
+@gen.coroutine
+def _fetch(http_task, stream=None, slot_owner=None, slot_weight=1, progress_callback=None):
+    """实际的下载过程
+        等待Crawl-delay、host的名额之后才申请SlotArbiter的名额，排队时不占用client的名额
+        Args:
+            http_task:http_task , 任务描述
+            stream: BaseStream, 接收body的stream
+            slot_owner: str, 向SlotArbiter申请名额的owner，None表示不申请
+            slot_weight: float, owner的权重
+            progress_callback: function, 接收body的过程中调用
+        Returns:
+            resp:Response, 下载的HTTP结果
+    """
+    http_request = http_task.request
+    host = urlparse.urlsplit(http_request.url).netloc
     try:
-        http_request = http_task.request
+        # 放入队列之后才下载到的robots.txt，在这里再检查一次，
+        # 要在dns解析修改url之前，熔断检查之前(不能占用半开状态的探测名额)
+        if http_task.robots_need:
+            check_robots_for_request(http_request)
+
+        # host熔断时不发出请求
+        if not BreakerManager.instance().allow_request(host):
+            raise CircuitOpenError("circuit of host:%s is open" % host)
+
+        # 确定会发出请求之后才按照Crawl-delay预约时间
+        crawl_delay_wait = 0
+        if http_task.robots_need:
+            try:
+                crawl_delay_wait = reserve_crawl_delay_for_request(http_request)
+            except CrawlDelayError:
+                BreakerManager.instance().cancel_request(host)
+                raise
 
         # get cookie if needed
         if http_task.cookie_host:
@@ -70,16 +267,224 @@ def fetch(http_task):
         if http_task.dns_need:
             resovle_dns_for_request(http_request)
 
+        # 从代理池中选择代理
+        proxy = None
+        if http_task.proxy_need:
+            proxy = set_proxy_for_request(http_request)
+
+        # 根据延迟分布设置超时时间
+        static_timeouts = None
+        if http_task.adaptive_timeout:
+            static_timeouts = set_adaptive_timeout_for_request(http_request,
+                                                               http_task.callback, host)
+
+    except (CircuitOpenError, RobotsDisallowedError, CrawlDelayError), e:
+        resp = e
+        logger.debug("fetch method skipped:%s" % e)
     except Exception, e:
         resp = e
+        BreakerManager.instance().record(host, False)
         logger.error("fetch method error:%s" % e)
     else:
-        client = httpclient.AsyncHTTPClient()
-        resp = yield gen.Task(client.fetch, http_request)
+        # 流式接收, task会被重新放回redis，所以回调不能留在request上
+        if stream is not None:
+            set_stream_for_request(http_request, stream)
+        set_curl_options_for_request(http_request,
+                                     None if stream is None else stream.max_body_size,
+                                     progress_callback)
+        queue_start_time = time.time()
+        if crawl_delay_wait > 0:
+            yield gen.Task(IOLoop.instance().add_timeout, time.time() + crawl_delay_wait)
+        yield HostLimiter.instance().acquire(host)
+        slot_start_time = time.time()
+        if slot_owner is not None:
+            yield SlotArbiter.instance().acquire(slot_owner, slot_weight)
+        try:
+            fetch_start_time = time.time()
+            client = get_client()
+            hedge_delay = None if stream is not None else get_hedge_delay(http_task)
+            if hedge_delay is None:
+                resp = yield gen.Task(client.fetch, http_request)
+            else:
+                resp = yield hedged_fetch(client, http_request, hedge_delay, host,
+                                          slot_owner, slot_weight, progress_callback)
+            fetch_interval = time.time() - fetch_start_time
+            if _is_host_success(resp):
+                LatencyTracker.instance().add(http_task.callback, fetch_interval)
+            # 超时的请求也要记录，否则网络变差时超时时间不会增长
+            LatencyTracker.instance().add((http_task.callback, host), fetch_interval)
+            BreakerManager.instance().record(host, _is_host_success(resp))
+            if proxy is not None:
+                ProxyPool.instance().report(proxy, _is_proxy_success(resp),
+                                            time.time() - fetch_start_time)
+            if not isinstance(resp, Exception):
+                resp.queue_time = fetch_start_time - queue_start_time
+                resp.slot_wait = fetch_start_time - slot_start_time
+        finally:
+            if slot_owner is not None:
+                SlotArbiter.instance().release(slot_owner)
+            HostLimiter.instance().release(host)
+            http_request.prepare_curl_callback = None
+            if stream is not None:
+                http_request.streaming_callback = None
+            if proxy is not None:
+                clear_proxy_for_request(http_request)
+            if static_timeouts is not None:
+                http_request.connect_timeout, http_request.request_timeout = static_timeouts
 
     raise gen.Return(resp)
 
 
+def check_robots_for_request(http_request):
+    """按照robots.txt检查request
+        Args:
+            http_request: HttpRequest, request
+        Raises:
+            RobotsDisallowedError: url被robots.txt禁止
+    """
+    if not RobotsCache.instance().is_allowed(http_request.url):
+        raise RobotsDisallowedError("url:%s disallowed by robots" % http_request.url)
+
+
+def reserve_crawl_delay_for_request(http_request):
+    """按照Crawl-delay为request预约抓取时间
+        Args:
+            http_request: HttpRequest, request
+        Returns:
+            wait: float, 需要等待的秒数
+        Raises:
+            CrawlDelayError: 需要等待的时间太长，task应该在retry_after秒之后再抓取
+    """
+    robots_cache = RobotsCache.instance()
+    wait = robots_cache.reserve(http_request.url)
+    if wait is None:
+        raise CrawlDelayError("crawl delay of url:%s" % http_request.url,
+                              robots_cache.get_retry_after(http_request.url))
+    return wait
+
+
+def set_adaptive_timeout_for_request(http_request, callback, host):
+    """根据callback和host的延迟分布设置request的超时时间
+        超时时间为分位数乘以系数，并限制在上下限之间，
+        callback和host的样本不足时使用callback的分布，都不足时保持原来的超时
+        Args:
+            http_request: HttpRequest, request
+            callback: str, task的callback
+            host: str, 请求的host
+        Returns:
+            static_timeouts: tuple, 原来的(connect_timeout, request_timeout)，
+                没有修改时返回None
+    """
+    tracker = LatencyTracker.instance()
+    latency = tracker.percentile((callback, host), ADAPTIVE_TIMEOUT_PERCENTILE)
+    if latency is None:
+        latency = tracker.percentile(callback, ADAPTIVE_TIMEOUT_PERCENTILE)
+    if latency is None:
+        return None
+
+    static_timeouts = (http_request.connect_timeout, http_request.request_timeout)
+    request_timeout = min(max(latency * ADAPTIVE_TIMEOUT_FACTOR, MIN_ADAPTIVE_TIMEOUT),
+                          MAX_ADAPTIVE_TIMEOUT)
+    http_request.request_timeout = request_timeout
+    if http_request.connect_timeout is None or http_request.connect_timeout > request_timeout:
+        http_request.connect_timeout = request_timeout
+    return static_timeouts
+
+
+def get_hedge_delay(http_task):
+    """根据callback的延迟分布计算发出对冲请求的时间
+        Args:
+            http_task: HttpTask, 任务
+        Returns:
+            hedge_delay: float, 单位秒，不需要对冲或者样本不足时返回None
+    """
+    if http_task.hedge_percentile is None:
+        return None
+    return LatencyTracker.instance().percentile(http_task.callback,
+                                                http_task.hedge_percentile)
+
+
+def set_proxy_for_request(http_request):
+    """set proxy for request, 代理从代理池中按健康状况选择
+        Args:
+            http_request: HttpRequest, request
+        Returns:
+            proxy: Proxy, 使用的代理, 没有可用代理时返回None，直接访问
+    """
+    proxy = ProxyPool.instance().choose()
+    if proxy is None:
+        logger.warn("no available proxy, url:%s" % http_request.url)
+    else:
+        http_request.proxy_host = proxy.host
+        http_request.proxy_port = proxy.port
+        http_request.proxy_username = proxy.username
+        http_request.proxy_password = proxy.password
+    return proxy
+
+
+def clear_proxy_for_request(http_request):
+    """clear proxy for request, 重试时重新选择代理
+        Args:
+            http_request: HttpRequest, request
+    """
+    http_request.proxy_host = None
+    http_request.proxy_port = None
+    http_request.proxy_username = None
+    http_request.proxy_password = None
+
+
+def _is_host_success(resp):
+    """判断host是否正常响应，连接失败、超时和5xx算作失败
+        Args:
+            resp: HTTPResponse, 结果
+        Returns:
+            is_success: bool
+    """
+    if isinstance(resp, Exception):
+        return False
+    return resp.code < 500
+
+
+def _is_proxy_success(resp):
+    """判断通过代理的请求是否成功
+        Args:
+            resp: HTTPResponse, 结果
+        Returns:
+            is_success: bool
+    """
+    if isinstance(resp, Exception):
+        return False
+    return resp.code not in PROXY_FAIL_CODES
+
+
+def set_stream_for_request(http_request, stream):
+    """set streaming callback for request
+        Args:
+            http_request: HttpRequest, request
+            stream: BaseStream, 接收body的stream
+    """
+    http_request.streaming_callback = stream.write
+
+
+def set_curl_options_for_request(http_request, max_body_size=None, progress_callback=None):
+    """set curl options for request
+        连接复用等选项来自FetcherSettings，
+        body大小超过限制时，如果服务器给出了Content-Length，curl会直接放弃,
+        curl handle会被复用，所以每次都要重新设置MAXFILESIZE(0表示不限制)和进度回调
+        Args:
+            http_request: HttpRequest, request
+            max_body_size: int, 最大的body长度
+            progress_callback: function, progress_callback(download_total, downloaded)
+    """
+    fetcher_settings = FetcherSettings.instance()
+
+    def prepare_curl(curl):
+        fetcher_settings.prepare_curl(curl)
+        curl.setopt(pycurl.MAXFILESIZE, max_body_size or 0)
+        set_curl_progress(curl, progress_callback)
+    http_request.prepare_curl_callback = prepare_curl
+
+
 def add_cookie_for_request(http_request, cookie_host, cookie_count):
     """add cookie for request
         Args:
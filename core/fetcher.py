@@ -0,0 +1,352 @@
+#!/usr/bin/python2.7
+#-*- coding=utf-8 -*-
+
+
+"""下载器的配置和按host的并发限制
+    FetcherSettings: 下载器的配置，从settings.fetchersettings加载
+    HostLimiter: 限制每个host同时处理的请求数
+    SlotArbiter: 在同一个进程的所有worker之间按权重分配client的请求名额
+    get_client(): 获取当前IOLoop的AsyncHTTPClient
+    set_curl_progress(): 设置curl的进度回调
+"""
+
+__authors__ = ['"wuyadong" <wuyadong@tigerknows.com>']
+
+import logging
+import threading
+from collections import deque
+
+import pycurl
+from tornado import httpclient
+from tornado.concurrent import Future
+
+from core.util import load_object
+
+DEFAULT_FETCHER_SETTINGS = "settings.fetchersettings"
+CURL_CLIENT_CLASS = "tornado.curl_httpclient.CurlAsyncHTTPClient"
+
+logger = logging.getLogger(__name__)
+
+
+class FetcherSettings(object):
+    """下载器的配置
+    """
+    _lock = threading.Lock()
+
+    def __init__(self):
+        self.max_clients = 50
+        self.max_host_connections = None
+        self.host_connections = {}
+        self.tcp_keepalive = True
+        self.tcp_keepidle = 60
+        self.tcp_keepintvl = 30
+        self.max_connects = 50
+        self.dns_cache_timeout = 600
+        self.spider_weights = {}
+
+    @staticmethod
+    def instance():
+        """获取下载器的配置
+            单例模式，第一次获取时从settings.fetchersettings加载
+            Returns:
+                settings: FetcherSettings 实例
+        """
+        if not hasattr(FetcherSettings, "_instance"):
+            with FetcherSettings._lock:
+                fetcher_settings = FetcherSettings()
+                try:
+                    fetcher_settings.load_settings()
+                except Exception, e:
+                    logger.error("load fetcher settings failed error:%s" % e)
+                setattr(FetcherSettings, "_instance", fetcher_settings)
+        return getattr(FetcherSettings, "_instance")
+
+    def load_settings(self, path=DEFAULT_FETCHER_SETTINGS):
+        """从配置文件中加载
+            Args:
+                path: str, 配置模块的路径
+        """
+        for name in self.to_dict().iterkeys():
+            setattr(self, name, load_object("%s.%s" % (path, name)))
+
+    def configure_client(self):
+        """配置AsyncHTTPClient
+            只对之后创建的client生效
+        """
+        httpclient.AsyncHTTPClient.configure(CURL_CLIENT_CLASS, max_clients=self.max_clients)
+
+    def get_host_connections(self, host):
+        """获取host的最大请求数
+            Args:
+                host: str, host
+            Returns:
+                max_connections: int, None表示不限制
+        """
+        return self.host_connections.get(host, self.max_host_connections)
+
+    def get_spider_weight(self, spider_name):
+        """获取spider分配请求名额的权重
+            Args:
+                spider_name: str, spider的类名
+            Returns:
+                weight: float, 默认为1
+        """
+        return self.spider_weights.get(spider_name, 1)
+
+    def prepare_multi(self, multi):
+        """设置multi handle的连接缓存
+            easy handle加入multi之后使用multi的连接缓存，easy handle上的MAXCONNECTS不生效，
+            同一个host的连接数由HostLimiter限制，这里只是兜底，
+            旧版本的libcurl没有这个选项或者不限制host的请求数时跳过
+            Args:
+                multi: pycurl.CurlMulti, multi handle
+        """
+        multi.setopt(pycurl.M_MAXCONNECTS, self.max_connects)
+        if hasattr(pycurl, "M_MAX_HOST_CONNECTIONS") and self.max_host_connections is not None:
+            multi.setopt(pycurl.M_MAX_HOST_CONNECTIONS,
+                         max([self.max_host_connections] + self.host_connections.values()))
+
+    def prepare_curl(self, curl):
+        """设置curl handle的连接复用相关的选项
+            旧版本的libcurl没有keep-alive选项时跳过
+            Args:
+                curl: pycurl.Curl, curl handle
+        """
+        curl.setopt(pycurl.DNS_CACHE_TIMEOUT, self.dns_cache_timeout)
+        if hasattr(pycurl, "TCP_KEEPALIVE"):
+            curl.setopt(pycurl.TCP_KEEPALIVE, 1 if self.tcp_keepalive else 0)
+            if self.tcp_keepalive:
+                curl.setopt(pycurl.TCP_KEEPIDLE, self.tcp_keepidle)
+                curl.setopt(pycurl.TCP_KEEPINTVL, self.tcp_keepintvl)
+
+    def to_dict(self):
+        return {"max_clients": self.max_clients,
+                "max_host_connections": self.max_host_connections,
+                "host_connections": self.host_connections,
+                "tcp_keepalive": self.tcp_keepalive,
+                "tcp_keepidle": self.tcp_keepidle,
+                "tcp_keepintvl": self.tcp_keepintvl,
+                "max_connects": self.max_connects,
+                "dns_cache_timeout": self.dns_cache_timeout,
+                "spider_weights": self.spider_weights}
+
+
+class HostLimiter(object):
+    """限制每个host同时处理的请求数
+        超过限制的请求在本地按先后顺序排队，不占用client的连接
+    """
+    _lock = threading.Lock()
+
+    def __init__(self, fetcher_settings):
+        """初始化
+            Args:
+                fetcher_settings: FetcherSettings, 下载器配置
+        """
+        self._fetcher_settings = fetcher_settings
+        self._host2number = {}
+        self._host2waiters = {}
+
+    @staticmethod
+    def instance():
+        """获取HostLimiter
+            单例模式
+            Returns:
+                limiter: HostLimiter 实例
+        """
+        if not hasattr(HostLimiter, "_instance"):
+            with HostLimiter._lock:
+                setattr(HostLimiter, "_instance", HostLimiter(FetcherSettings.instance()))
+        return getattr(HostLimiter, "_instance")
+
+    def acquire(self, host):
+        """申请host的一个请求名额
+            Args:
+                host: str, host
+            Returns:
+                future: Future, 得到名额时完成
+        """
+        future = Future()
+        if not self._is_full(host):
+            self._host2number[host] = self._host2number.get(host, 0) + 1
+            future.set_result(None)
+        else:
+            self._host2waiters.setdefault(host, deque()).append(future)
+        return future
+
+    def try_acquire(self, host):
+        """不排队地申请host的一个请求名额
+            Args:
+                host: str, host
+            Returns:
+                is_acquired: bool, 名额已满或者有请求在排队时返回False
+        """
+        if self._host2waiters.get(host) or self._is_full(host):
+            return False
+        self._host2number[host] = self._host2number.get(host, 0) + 1
+        return True
+
+    def _is_full(self, host):
+        max_connections = self._fetcher_settings.get_host_connections(host)
+        return max_connections is not None and self._host2number.get(host, 0) >= max_connections
+
+    def release(self, host):
+        """释放host的一个请求名额，有排队的请求时直接交给它
+            Args:
+                host: str, host
+        """
+        waiters = self._host2waiters.get(host)
+        if waiters:
+            waiters.popleft().set_result(None)
+            if not waiters:
+                del self._host2waiters[host]
+        else:
+            self._host2number[host] = self._host2number.get(host, 1) - 1
+            if self._host2number[host] <= 0:
+                del self._host2number[host]
+
+    def get_status(self):
+        """获取每个host正在处理和排队的请求数
+            Returns:
+                status: dict, host到{"processing", "waiting"}的字典
+        """
+        status = {}
+        for host, number in self._host2number.iteritems():
+            status[host] = {"processing": number,
+                            "waiting": len(self._host2waiters.get(host, ()))}
+        return status
+
+
+class SlotArbiter(object):
+    """在同一个进程的所有worker之间分配client的请求名额
+        所有worker共享一个AsyncHTTPClient，名额总数是max_clients，
+        没有空闲名额时请求在本地排队，名额释放后交给已用名额/权重最小的worker，
+        这样请求不会在curl内部排队，下载时间的统计也不包含排队时间
+    """
+    _lock = threading.Lock()
+
+    def __init__(self, fetcher_settings):
+        """初始化
+            Args:
+                fetcher_settings: FetcherSettings, 下载器配置
+        """
+        self._fetcher_settings = fetcher_settings
+        self._used_number = 0
+        self._owner2number = {}
+        self._owner2weight = {}
+        self._owner2waiters = {}
+
+    @staticmethod
+    def instance():
+        """获取SlotArbiter
+            单例模式
+            Returns:
+                arbiter: SlotArbiter 实例
+        """
+        if not hasattr(SlotArbiter, "_instance"):
+            with SlotArbiter._lock:
+                setattr(SlotArbiter, "_instance", SlotArbiter(FetcherSettings.instance()))
+        return getattr(SlotArbiter, "_instance")
+
+    def acquire(self, owner, weight=1):
+        """为owner申请一个请求名额
+            Args:
+                owner: str, 名额的所有者，通常是worker的名字
+                weight: float, owner的权重
+            Returns:
+                future: Future, 得到名额时完成
+        """
+        future = Future()
+        self._owner2weight[owner] = weight
+        self._owner2waiters.setdefault(owner, deque()).append(future)
+        self._dispatch()
+        return future
+
+    def try_acquire(self, owner, weight=1):
+        """不排队地为owner申请一个请求名额
+            Args:
+                owner: str, 名额的所有者
+                weight: float, owner的权重
+            Returns:
+                is_acquired: bool, 没有空闲名额或者有请求在排队时返回False
+        """
+        if self._owner2waiters or self._used_number >= self._fetcher_settings.max_clients:
+            return False
+        self._owner2weight[owner] = weight
+        self._used_number += 1
+        self._owner2number[owner] = self._owner2number.get(owner, 0) + 1
+        return True
+
+    def release(self, owner):
+        """释放owner的一个请求名额
+            Args:
+                owner: str, 名额的所有者
+        """
+        self._used_number -= 1
+        self._owner2number[owner] = self._owner2number.get(owner, 1) - 1
+        if self._owner2number[owner] <= 0:
+            del self._owner2number[owner]
+            if not self._owner2waiters.has_key(owner):
+                self._owner2weight.pop(owner, None)
+        self._dispatch()
+
+    def _dispatch(self):
+        """把空闲的名额按已用名额/权重从小到大交给排队的owner
+        """
+        while self._used_number < self._fetcher_settings.max_clients and self._owner2waiters:
+            owner = min(self._owner2waiters.iterkeys(),
+                        key=lambda name: self._owner2number.get(name, 0) /
+                        float(self._owner2weight[name]))
+            waiters = self._owner2waiters[owner]
+            future = waiters.popleft()
+            if not waiters:
+                del self._owner2waiters[owner]
+            self._used_number += 1
+            self._owner2number[owner] = self._owner2number.get(owner, 0) + 1
+            future.set_result(None)
+
+    def get_status(self):
+        """获取每个owner使用和排队的名额数
+            Returns:
+                status: dict, owner到{"weight", "processing", "waiting"}的字典
+        """
+        status = {}
+        for owner, weight in self._owner2weight.iteritems():
+            status[owner] = {"weight": weight,
+                             "processing": self._owner2number.get(owner, 0),
+                             "waiting": len(self._owner2waiters.get(owner, ()))}
+        return status
+
+
+def get_client():
+    """获取当前IOLoop的AsyncHTTPClient
+        第一次获取时设置multi handle的连接缓存
+        Returns:
+            client: AsyncHTTPClient
+    """
+    client = httpclient.AsyncHTTPClient()
+    if not getattr(client, "_is_multi_prepared", False):
+        FetcherSettings.instance().prepare_multi(client._multi)
+        client._is_multi_prepared = True
+    return client
+
+
+def set_curl_progress(curl, progress_callback, is_cancelled=None):
+    """设置curl的进度回调
+        Args:
+            curl: pycurl.Curl, curl handle
+            progress_callback: function, progress_callback(download_total, downloaded)
+            is_cancelled: function, 返回True时中止传输，结果为599
+    """
+    if progress_callback is None and is_cancelled is None:
+        curl.setopt(pycurl.NOPROGRESS, 1)
+        return
+
+    def progress(download_total, downloaded, upload_total, uploaded):
+        if is_cancelled is not None and is_cancelled():
+            return 1
+        if progress_callback is not None:
+            progress_callback(download_total, downloaded)
+        return 0
+    curl.setopt(pycurl.NOPROGRESS, 0)
+    curl.setopt(pycurl.PROGRESSFUNCTION, progress)
+
@@ -0,0 +1,172 @@
+#!/usr/bin/python2.7
+#-*- coding=utf-8 -*-
+
+
+"""对冲请求模块
+    请求在一定时间内没有返回时，再发出一个相同的请求，先返回的结果生效，
+    对冲请求同样占用host和client的名额，没有空闲名额时不对冲，另一个请求被取消
+    HedgeBudget: 全局的对冲预算，限制额外发出的请求数
+    hedged_fetch: 以对冲的方式下载
+"""
+
+__authors__ = ['"wuyadong" <wuyadong@tigerknows.com>']
+
+import copy
+import time
+import logging
+import threading
+
+from tornado import gen, ioloop
+from tornado.concurrent import Future
+
+from core.fetcher import HostLimiter, SlotArbiter, set_curl_progress
+
+DEFAULT_BUDGET_RATIO = 0.05  # 每个普通请求积累的对冲额度，即最多多发5%的请求
+DEFAULT_MAX_TOKENS = 10  # 最多积累的对冲额度
+
+logger = logging.getLogger(__name__)
+
+
+class HedgeBudget(object):
+    """全局的对冲预算
+        每个请求积累ratio个额度，每次对冲消耗一个额度，
+        保证对冲产生的额外请求不超过请求总数的ratio
+    """
+    _lock = threading.Lock()
+
+    def __init__(self, ratio=DEFAULT_BUDGET_RATIO, max_tokens=DEFAULT_MAX_TOKENS):
+        self._ratio = ratio
+        self._max_tokens = max_tokens
+        self._tokens = 0.0
+        self.hedged_count = 0
+        self.hedge_won_count = 0
+        self.capped_count = 0  # 因为没有空闲名额没有对冲的次数
+
+    @staticmethod
+    def instance():
+        """获取全局的对冲预算
+            单例模式
+            Returns:
+                budget: HedgeBudget 实例
+        """
+        if not hasattr(HedgeBudget, "_instance"):
+            with HedgeBudget._lock:
+                setattr(HedgeBudget, "_instance", HedgeBudget())
+        return getattr(HedgeBudget, "_instance")
+
+    def deposit(self):
+        """发出一个普通请求时调用，积累额度
+        """
+        self._tokens = min(self._tokens + self._ratio, self._max_tokens)
+
+    def acquire(self):
+        """申请一次对冲
+            Returns:
+                is_acquired: bool, 额度不足时返回False
+        """
+        if self._tokens >= 1:
+            self._tokens -= 1
+            self.hedged_count += 1
+            return True
+        return False
+
+    def to_dict(self):
+        return {"tokens": self._tokens, "hedged_count": self.hedged_count,
+                "hedge_won_count": self.hedge_won_count, "capped_count": self.capped_count}
+
+
+def _is_final(resp):
+    """成功的结果直接生效，连接失败或者5xx时等待另一个请求
+    """
+    return resp.code < 500
+
+
+def _set_cancellable(http_request, state, progress_callback):
+    """让request可以被取消
+        state["cancelled"]为True时，curl的进度回调返回非0，传输中止，结果为599，
+        会覆盖原来的进度回调，所以同时调用progress_callback
+    """
+    prepare_curl_callback = http_request.prepare_curl_callback
+
+    def prepare_curl(curl):
+        if prepare_curl_callback is not None:
+            prepare_curl_callback(curl)
+        set_curl_progress(curl, progress_callback, lambda: state["cancelled"])
+    http_request.prepare_curl_callback = prepare_curl
+
+
+@gen.coroutine
+def hedged_fetch(client, http_request, hedge_delay, host, slot_owner=None, slot_weight=1,
+                 progress_callback=None):
+    """以对冲的方式下载
+        hedge_delay秒后请求还没有返回，host和client都有空闲名额并且预算充足时，
+        发出第二个相同的请求，先返回的成功结果生效，另一个请求被取消
+        Args:
+            client: AsyncHTTPClient, client
+            http_request: HTTPRequest, request, 不能带有streaming_callback，
+                调用者已经为它申请了host和client的名额
+            hedge_delay: float, 发出对冲请求的等待时间，单位秒
+            host: str, 请求的host
+            slot_owner: str, 向SlotArbiter申请名额的owner，None表示不申请
+            slot_weight: float, owner的权重
+            progress_callback: function, 两个请求接收body的过程中都会调用
+        Returns:
+            resp: HTTPResponse, 结果
+    """
+    budget = HedgeBudget.instance()
+    budget.deposit()
+    future = Future()
+    # 每个请求是否还在进行，以及是否已经被取消
+    states = [{"pending": True, "cancelled": False}]
+
+    def handle_response(index, resp):
+        states[index]["pending"] = False
+        # 被取消的请求结束后，curl handle会被复用，进度回调不能再中止传输
+        states[index]["cancelled"] = False
+        if future.done():
+            return
+        if _is_final(resp) or not any(state["pending"] for state in states):
+            if index > 0:
+                budget.hedge_won_count += 1
+            for state in states:
+                if state["pending"]:
+                    state["cancelled"] = True
+            future.set_result(resp)
+
+    def handle_hedge_response(resp):
+        if slot_owner is not None:
+            SlotArbiter.instance().release(slot_owner)
+        HostLimiter.instance().release(host)
+        handle_response(1, resp)
+
+    def hedge():
+        if future.done():
+            return
+        if not HostLimiter.instance().try_acquire(host):
+            budget.capped_count += 1
+            return
+        if slot_owner is not None and not SlotArbiter.instance().try_acquire(slot_owner,
+                                                                             slot_weight):
+            HostLimiter.instance().release(host)
+            budget.capped_count += 1
+            return
+        if not budget.acquire():
+            if slot_owner is not None:
+                SlotArbiter.instance().release(slot_owner)
+            HostLimiter.instance().release(host)
+            return
+        logger.debug("hedge request url:%s" % http_request.url)
+        states.append({"pending": True, "cancelled": False})
+        hedge_request = copy.copy(http_request)
+        _set_cancellable(hedge_request, states[1], progress_callback)
+        client.fetch(hedge_request, handle_hedge_response)
+
+    _set_cancellable(http_request, states[0], progress_callback)
+    client.fetch(http_request, lambda resp: handle_response(0, resp))
+    io_loop = ioloop.IOLoop.instance()
+    timeout = io_loop.add_timeout(time.time() + hedge_delay, hedge)
+    try:
+        resp = yield future
+    finally:
+        io_loop.remove_timeout(timeout)
+    raise gen.Return(resp)
@@ -0,0 +1,213 @@
+#!/usr/bin/python2.7
+#-*- coding=utf-8 -*-
+
+
+"""录制和回放http结果的缓存，用于离线开发和性能测试
+    body按内容的sha1保存在objects目录下，相同的body只存一份，
+    index文件每行是一条json记录，记录请求指纹对应的code, headers和body的sha1
+    HttpCacheError: 缓存相关的错误
+    TeeStream: 录制或归档时复制一份流式接收的body
+    HttpCache: 录制和回放http结果的缓存
+"""
+
+__authors__ = ['"wuyadong" <wuyadong@tigerknows.com>']
+
+import os
+import json
+import hashlib
+import logging
+import threading
+import cStringIO
+
+from tornado.httpclient import HTTPResponse, HTTPError
+from tornado.httputil import HTTPHeaders
+
+from core.util import load_object, get_project_path
+
+MODE_RECORD = "record"
+MODE_REPLAY = "replay"
+DEFAULT_CACHE_SETTINGS = "settings.httpcachesettings"
+INDEX_FILE_NAME = "index"
+OBJECTS_DIR_NAME = "objects"
+
+logger = logging.getLogger(__name__)
+
+
+class HttpCacheError(Exception):
+    """缓存相关的错误
+    """
+
+
+class TeeStream(object):
+    """录制或者归档流式下载时，在写入原stream的同时保留一份body
+        只在录制模式或者配置了归档时使用，body会保存在内存中，
+        超过原stream的最大长度后不再保留，is_overflowed为True，结果不能录制和归档
+    """
+
+    def __init__(self, stream):
+        self._stream = stream
+        self._chunks = []
+        self._size = 0
+        self._is_overflowed = False
+
+    @property
+    def max_body_size(self):
+        return self._stream.max_body_size
+
+    @property
+    def share_key(self):
+        return self._stream.share_key
+
+    @property
+    def memory_size(self):
+        return self._stream.memory_size + self._size
+
+    @property
+    def is_overflowed(self):
+        return self._is_overflowed or self._stream.is_overflowed
+
+    @property
+    def body(self):
+        return "".join(self._chunks)
+
+    def write(self, chunk):
+        self._stream.write(chunk)
+        if self._is_overflowed:
+            return
+        max_body_size = self._stream.max_body_size
+        if max_body_size is not None and self._size + len(chunk) > max_body_size:
+            self._is_overflowed = True
+            self._chunks = []
+            self._size = 0
+        else:
+            self._chunks.append(chunk)
+            self._size += len(chunk)
+        self._stream.copy_size = self._size
+
+
+class HttpCache(object):
+    """录制和回放http结果的缓存
+    """
+    _lock = threading.Lock()
+
+    def __init__(self, path, mode=None):
+        """初始化，加载已有的索引
+            Args:
+                path: str, 缓存目录
+                mode: str, None, MODE_RECORD或者MODE_REPLAY
+        """
+        self._path = path
+        self._mode = mode
+        self._index = {}
+        if mode is not None:
+            self.loads()
+
+    @staticmethod
+    def instance():
+        """获取缓存
+            单例模式，第一次获取时从settings.httpcachesettings加载配置
+            Returns:
+                cache: HttpCache 实例
+        """
+        if not hasattr(HttpCache, "_instance"):
+            with HttpCache._lock:
+                try:
+                    cache = HttpCache(get_project_path() +
+                                      load_object(DEFAULT_CACHE_SETTINGS + ".path"),
+                                      load_object(DEFAULT_CACHE_SETTINGS + ".mode"))
+                except Exception, e:
+                    logger.error("load http cache failed error:%s" % e)
+                    cache = HttpCache(None)
+                setattr(HttpCache, "_instance", cache)
+        return getattr(HttpCache, "_instance")
+
+    @property
+    def is_recording(self):
+        return self._mode == MODE_RECORD
+
+    @property
+    def is_replaying(self):
+        return self._mode == MODE_REPLAY
+
+    def loads(self):
+        """加载索引，后面的记录覆盖前面的记录
+        """
+        index_path = os.path.join(self._path, INDEX_FILE_NAME)
+        if not os.path.exists(index_path):
+            return
+        with open(index_path, "rb") as index_file:
+            for line in index_file:
+                try:
+                    entry = json.loads(line)
+                except ValueError, e:
+                    logger.warn("broken http cache index line:%s" % e)
+                else:
+                    self._index[entry['fingerprint']] = entry
+
+    def _object_path(self, digest):
+        return os.path.join(self._path, OBJECTS_DIR_NAME, digest[:2], digest)
+
+    def record(self, fingerprint, url, resp, body):
+        """录制一个结果
+            Args:
+                fingerprint: str, 请求的指纹
+                url: str, 请求的url
+                resp: HTTPResponse, 结果
+                body: str, body
+            Raises:
+                HttpCacheError: 写入失败
+        """
+        body = body or ""
+        digest = hashlib.sha1(body).hexdigest()
+        object_path = self._object_path(digest)
+        try:
+            if not os.path.exists(object_path):
+                directory = os.path.dirname(object_path)
+                if not os.path.exists(directory):
+                    os.makedirs(directory)
+                with open(object_path + ".tmp", "wb") as object_file:
+                    object_file.write(body)
+                os.rename(object_path + ".tmp", object_path)
+
+            entry = {"fingerprint": fingerprint, "url": url, "code": resp.code,
+                     "headers": list(resp.headers.get_all()) if resp.headers else [],
+                     "body": digest}
+            with open(os.path.join(self._path, INDEX_FILE_NAME), "ab") as index_file:
+                index_file.write(json.dumps(entry) + "\n")
+        except (IOError, OSError), e:
+            raise HttpCacheError("record %s error:%s" % (url, e))
+        self._index[fingerprint] = entry
+
+    def replay(self, fingerprint, http_request, stream=None):
+        """回放一个结果
+            Args:
+                fingerprint: str, 请求的指纹
+                http_request: HTTPRequest, request
+                stream: BaseStream, 如果不为None，body写入stream
+            Returns:
+                resp: HTTPResponse, 缓存中没有时返回code为599的结果
+        """
+        entry = self._index.get(fingerprint)
+        if entry is None:
+            return HTTPResponse(http_request, 599,
+                                error=HTTPError(599, "not in http cache"))
+
+        try:
+            with open(self._object_path(entry['body']), "rb") as object_file:
+                body = object_file.read()
+        except IOError, e:
+            return HTTPResponse(http_request, 599,
+                                error=HTTPError(599, "read http cache error:%s" % e))
+
+        headers = HTTPHeaders()
+        for name, value in entry['headers']:
+            headers.add(name, value)
+        code = entry['code']
+        error = None if code < 300 else HTTPError(code)
+        if stream is not None:
+            stream.write(body)
+            body = ""
+        return HTTPResponse(http_request, code, headers=headers,
+                            buffer=cStringIO.StringIO(body),
+                            effective_url=entry['url'], error=error,
+                            request_time=0, time_info={})
@@ -0,0 +1,93 @@
+#!/usr/bin/python2.7
+#-*- coding=utf-8 -*-
+
+
+"""记录下载延迟分布的模块
+    LatencyWindow: 最近若干次请求延迟的滑动窗口
+    LatencyTracker: 按key记录延迟的滑动窗口
+"""
+
+__authors__ = ['"wuyadong" <wuyadong@tigerknows.com>']
+
+import threading
+from collections import deque
+
+DEFAULT_WINDOW_SIZE = 200  # 每个key保留的最近延迟个数
+DEFAULT_MIN_SAMPLES = 20  # 样本少于这个数时不给出分位数
+
+
+class LatencyWindow(object):
+    """最近若干次请求延迟的滑动窗口
+    """
+
+    def __init__(self, size=DEFAULT_WINDOW_SIZE):
+        self._latencies = deque(maxlen=size)
+
+    def add(self, latency):
+        """增加一个延迟
+            Args:
+                latency: float, 延迟，单位秒
+        """
+        self._latencies.append(latency)
+
+    def __len__(self):
+        return len(self._latencies)
+
+    def percentile(self, percent):
+        """计算分位数
+            Args:
+                percent: float, 0-100
+            Returns:
+                latency: float, 对应的延迟，窗口为空时返回None
+        """
+        if len(self._latencies) == 0:
+            return None
+        latencies = sorted(self._latencies)
+        index = int(round(percent / 100.0 * (len(latencies) - 1)))
+        return latencies[min(max(index, 0), len(latencies) - 1)]
+
+
+class LatencyTracker(object):
+    """按key(比如callback)记录延迟的滑动窗口
+    """
+    _lock = threading.Lock()
+
+    def __init__(self, window_size=DEFAULT_WINDOW_SIZE):
+        self._window_size = window_size
+        self._windows = {}
+
+    @staticmethod
+    def instance():
+        """获取LatencyTracker
+            单例模式
+            Returns:
+                tracker: LatencyTracker 实例
+        """
+        if not hasattr(LatencyTracker, "_instance"):
+            with LatencyTracker._lock:
+                setattr(LatencyTracker, "_instance", LatencyTracker())
+        return getattr(LatencyTracker, "_instance")
+
+    def add(self, key, latency):
+        """记录key的一次延迟
+            Args:
+                key: str, key
+                latency: float, 延迟，单位秒
+        """
+        if not self._windows.has_key(key):
+            self._windows[key] = LatencyWindow(self._window_size)
+        self._windows[key].add(latency)
+
+    def percentile(self, key, percent, min_samples=DEFAULT_MIN_SAMPLES):
+        """获取key的延迟分位数
+            Args:
+                key: str, key
+                percent: float, 0-100
+                min_samples: int, 最少的样本数
+            Returns:
+                latency: float, 样本不足时返回None
+        """
+        window = self._windows.get(key)
+        if window is None or len(window) < min_samples:
+            return None
+        return window.percentile(percent)
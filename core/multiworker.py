@@ -0,0 +1,343 @@
+#!/usr/bin/python2.7
+#-*- coding=utf-8 -*-
+
+
+"""多进程模式的worker
+    supervisor fork出多个子进程，子进程从同一个redis schedule中获取任务，
+    并定时把统计信息发给supervisor，supervisor合并后作为整个worker的统计信息，
+    子进程空闲时不会自己退出，所有子进程都空闲时由supervisor停止，
+    子进程在停止之前退出时单独重启，schedule和pipeline由supervisor在所有子进程退出后清理
+    ChildWorker: 子进程中的worker
+    MultiProcessWorker: 管理子进程的worker
+    add_listening_sockets(): 登记子进程中需要关闭的监听socket
+    start_multi_process_worker(): 以多进程模式启动一个worker
+"""
+
+__authors__ = ['"wuyadong" <wuyadong@tigerknows.com>']
+
+import os
+import uuid
+import Queue
+import signal
+import datetime
+import multiprocessing
+
+from tornado import ioloop
+
+from core import download
+from core.util import get_class_path, load_object
+from core.worker import Worker, WorkerError
+from core.statistic import WorkerStatistic
+from core.archive import ArchiveWriter
+from core.fetcher import HostLimiter, SlotArbiter
+from core.robots import RobotsCache
+from core.db import ConnectionPool
+from core.spider.join import JoinBuffer
+
+STATISTIC_REPORT_INTERVAL = 5 * 1000  # 子进程发送统计信息的间隔，单位毫秒
+CHILD_CHECK_INTERVAL = 2 * 1000  # supervisor检查子进程的间隔，单位毫秒
+MAX_RESTART_COUNT = 5  # 每个子进程最多重启的次数
+IDLE_CHECK_COUNT = 2  # 连续这么多次检查时所有子进程都空闲，才停止worker
+
+_inherited_pools = []  # 从父进程继承的连接池，保留引用，避免回收时关闭父进程的连接
+_listening_sockets = []  # 父进程监听的socket，子进程中关闭
+
+
+class ChildWorker(Worker):
+    """子进程中的worker
+        schedule和pipeline是所有子进程共享的，停止时不清理，只发送最后的统计信息，
+        空闲时不停止，其他子进程还可能放入新的task，只把空闲状态发给supervisor
+    """
+
+    def __init__(self, spider, worker_name, statistic_queue):
+        """初始化
+            Args:
+                spider: BaseSpider, spider实例
+                worker_name: str, worker的名字
+                statistic_queue: multiprocessing.Queue, 发送统计信息的队列
+        """
+        Worker.__init__(self, spider, worker_name)
+        self._statistic_queue = statistic_queue
+        self._is_idle = False
+        self._report_callback = ioloop.PeriodicCallback(self.report_statistic,
+                                                        STATISTIC_REPORT_INTERVAL,
+                                                        io_loop=ioloop.IOLoop.instance())
+
+    def start(self):
+        """启动
+            种子任务已经由supervisor放入schedule，这里只开始循环
+        """
+        if self.is_started:
+            self.logger.warn("duplicate start")
+        else:
+            self.is_started = True
+            self.worker_statistic.start_time = datetime.datetime.now()
+            self._report_callback.start()
+            self.run()
+
+    def stop(self):
+        """停止，发送最后的统计信息后结束IOLoop，子进程随之退出
+        """
+        if not self.is_started:
+            self.logger.warn("duplicate stop")
+        else:
+            self.is_started = False
+            self.worker_statistic.end_time = datetime.datetime.now()
+            self._report_callback.stop()
+            self.close_item_batcher()
+            self.close_pipeline_executor()
+            # 写入pipeline中缓存的数据，schedule由所有子进程共享，不清除
+            self.spider.close_pipelines()
+            self.report_statistic()
+            ioloop.IOLoop.instance().stop()
+            self.logger.info("stop child worker")
+
+    def handle_idle(self):
+        """空闲时立即通知supervisor
+        """
+        if not self._is_idle:
+            self._is_idle = True
+            self.report_statistic()
+
+    def handle_busy(self):
+        """重新获取到task时立即通知supervisor
+        """
+        if self._is_idle:
+            self._is_idle = False
+            self.report_statistic()
+
+    def report_statistic(self):
+        """把统计信息和空闲状态发送给supervisor
+        """
+        try:
+            self._statistic_queue.put_nowait((os.getpid(), self.worker_statistic,
+                                              self._is_idle))
+        except Exception, e:
+            self.logger.warn("report statistic failed error:%s" % e)
+
+
+def add_listening_sockets(sockets):
+    """登记父进程监听的socket，fork之后在子进程中关闭
+        Args:
+            sockets: list, socket列表
+    """
+    _listening_sockets.extend(sockets)
+
+
+def _reset_after_fork():
+    """清理fork时从父进程继承的状态
+        IOLoop(包括web服务的socket)、正在下载的请求、归档线程、请求名额、
+    正在下载的robots.txt、数据库连接和关联缓存都属于父进程，
+    监听的socket只关闭子进程中的fd，不影响父进程
+    """
+    for sock in _listening_sockets:
+        sock.close()
+    del _listening_sockets[:]
+    for claz in (ioloop.IOLoop, ArchiveWriter, HostLimiter, SlotArbiter, RobotsCache):
+        if hasattr(claz, "_instance"):
+            delattr(claz, "_instance")
+    download._inflight_fetches.clear()
+    _inherited_pools.extend(ConnectionPool._pools.values())
+    ConnectionPool._pools = {}
+    JoinBuffer._buffers = {}
+    # 关联的两半可能由不同的子进程解析，先到的一半必须写入redis
+    JoinBuffer.force_write_through = True
+
+
+def _run_child(worker_name, spider_path, spider_kwargs, schedule_path, schedule_kwargs,
+               statistic_queue, process_number):
+    """子进程的入口
+        spider和schedule在子进程中重新创建，不共享父进程的连接，
+        Crawl-delay的预约只在子进程中有效，按子进程个数放大间隔
+    """
+    _reset_after_fork()
+    RobotsCache.crawl_delay_factor = process_number
+    io_loop = ioloop.IOLoop.instance()
+    # fork发生在父进程IOLoop的回调中，current还指向父进程的IOLoop
+    io_loop.make_current()
+    schedule = load_object(schedule_path)(**schedule_kwargs)
+    spider = load_object(spider_path)(schedule, **spider_kwargs)
+    worker = ChildWorker(spider, worker_name, statistic_queue)
+
+    for signum, method in ((signal.SIGTERM, worker.stop), (signal.SIGUSR1, worker.suspend),
+                           (signal.SIGUSR2, worker.rouse)):
+        signal.signal(signum, lambda _signum, _frame, method=method:
+                      io_loop.add_callback_from_signal(method))
+
+    worker.start()
+    io_loop.start()
+    # 子进程退出时不执行atexit，IOLoop结束之后写完归档并结束写入线程
+    archive_writer = ArchiveWriter.instance()
+    if archive_writer is not None:
+        archive_writer.close()
+
+
+class MultiProcessWorker(Worker):
+    """管理子进程的worker
+        自己不获取任务，只负责启动、重启子进程和合并统计信息
+    """
+
+    def __init__(self, spider, worker_name, process_number):
+        """初始化
+            Args:
+                spider: BaseSpider, spider实例，用于放入种子任务和最后的清理
+                worker_name: str, worker的名字
+                process_number: int, 子进程的个数
+        """
+        Worker.__init__(self, spider, worker_name)
+        self._process_number = process_number
+        self._statistic_queue = multiprocessing.Queue()
+        self._processes = {}  # 编号到子进程的字典
+        self._restart_counts = {}
+        self._pid2statistic = {}  # 每个子进程最后发送的统计信息
+        self._pid2idle = {}  # 每个子进程最后发送的空闲状态
+        self._idle_check_count = 0
+        self._exited_pids = set()
+        self._is_stopping = False
+        self._check_callback = ioloop.PeriodicCallback(self.check_children,
+                                                       CHILD_CHECK_INTERVAL,
+                                                       io_loop=ioloop.IOLoop.instance())
+
+    def run(self):
+        """启动所有子进程
+        """
+        for index in xrange(self._process_number):
+            self._start_child(index)
+        self._check_callback.start()
+        self.logger.info("start worker with %s processes" % self._process_number)
+
+    def _start_child(self, index):
+        process = multiprocessing.Process(
+            target=_run_child, name="%s-%s" % (self._worker_name, index),
+            args=("%s-%s" % (self._worker_name, index),
+                  get_class_path(self.spider.__class__), self.spider.spider_kwargs,
+                  get_class_path(self.spider.crawl_schedule.__class__),
+                  self.spider.crawl_schedule.schedule_kwargs, self._statistic_queue,
+                  self._process_number))
+        process.daemon = True
+        process.start()
+        self._processes[index] = process
+
+    def _send_signal(self, signum):
+        for process in self._processes.itervalues():
+            if process.is_alive():
+                try:
+                    os.kill(process.pid, signum)
+                except OSError, e:
+                    self.logger.warn("send signal to pid:%s error:%s" % (process.pid, e))
+
+    def stop(self):
+        """通知所有子进程停止，全部退出后再保存统计信息并清理
+        """
+        if not self.is_started or self._is_stopping:
+            self.logger.warn("duplicate stop")
+        else:
+            self._is_stopping = True
+            self._send_signal(signal.SIGTERM)
+
+    def suspend(self):
+        Worker.suspend(self)
+        if self.is_started:
+            self._send_signal(signal.SIGUSR1)
+
+    def rouse(self):
+        Worker.rouse(self)
+        if self.is_started:
+            self._send_signal(signal.SIGUSR2)
+
+    def check_children(self):
+        """接收统计信息，重启在停止之前退出的子进程，所有子进程都空闲时停止，
+        所有子进程退出后停止worker
+        """
+        self._receive_statistics()
+        for index, process in self._processes.items():
+            if process.is_alive():
+                continue
+            process.join()
+            self._exited_pids.add(process.pid)
+            if self._is_stopping:
+                del self._processes[index]
+            elif self._restart_counts.get(index, 0) >= MAX_RESTART_COUNT:
+                self.logger.error("child:%s exit code:%s, restart too many times" %
+                                  (index, process.exitcode))
+                del self._processes[index]
+            else:
+                self.logger.error("child:%s exit code:%s, restart" % (index, process.exitcode))
+                self._restart_counts[index] = self._restart_counts.get(index, 0) + 1
+                self._start_child(index)
+        # 退出之前发送的统计信息
+        self._receive_statistics()
+        self._merge_statistics()
+
+        if not self._is_stopping and self._processes and not self.is_suspended:
+            if self._is_all_idle():
+                self._idle_check_count += 1
+            else:
+                self._idle_check_count = 0
+            if self._idle_check_count >= IDLE_CHECK_COUNT:
+                self.logger.info("all children are idle, stop worker")
+                self.stop()
+
+        if not self._processes:
+            self._check_callback.stop()
+            self._is_stopping = False
+            Worker.stop(self)
+
+    def _is_all_idle(self):
+        """所有存活的子进程都空闲时，没有子进程会再放入task，队列也是空的
+        """
+        for process in self._processes.itervalues():
+            if not process.is_alive() or not self._pid2idle.get(process.pid, False):
+                return False
+        return True
+
+    def _receive_statistics(self):
+        while True:
+            try:
+                pid, statistic, is_idle = self._statistic_queue.get_nowait()
+            except Queue.Empty:
+                break
+            else:
+                self._pid2statistic[pid] = statistic
+                self._pid2idle[pid] = is_idle
+
+    def _merge_statistics(self):
+        """合并所有子进程的统计信息，包括已经退出的
+        """
+        start_time = self.worker_statistic.start_time
+        worker_statistic = WorkerStatistic()
+        for pid, statistic in self._pid2statistic.iteritems():
+            worker_statistic.merge(statistic, pid not in self._exited_pids)
+        worker_statistic.start_time = start_time
+        self.worker_statistic = worker_statistic
+
+    def get_status(self):
+        """获取子进程的状态
+            Returns:
+                status: dict, 编号到{"pid", "alive", "restart_count"}的字典
+        """
+        return dict((index, {"pid": process.pid, "alive": process.is_alive(),
+                             "restart_count": self._restart_counts.get(index, 0)})
+                    for index, process in self._processes.iteritems())
+
+
+def start_multi_process_worker(spider, process_number):
+    """以多进程模式启动一个worker
+        Args:
+            spider: 描述抓取流程，BaseSpider的实例
+            process_number: int, 子进程的个数
+        Raises:
+            WorkerError: 创建worker失败
+    """
+    worker_name = "worker-%d" % uuid.uuid4()
+    try:
+        worker = MultiProcessWorker(spider, worker_name, process_number)
+    except Exception, e:
+        raise WorkerError("init worker error:%s" % e)
+
+    try:
+        worker.start()
+    except Exception, e:
+        raise WorkerError("start worker error:%s" % e)
+    else:
+        Worker.workers[worker_name] = worker
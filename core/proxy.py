@@ -0,0 +1,214 @@
+#!/usr/bin/python2.7
+#-*- coding=utf-8 -*-
+
+
+"""代理池模块
+    ProxyError: 代理相关的错误
+    Proxy: 描述一个代理以及它的健康状况
+    ProxyPool: 代理池，按照健康状况加权选择代理，并隔离坏的代理
+"""
+
+__authors__ = ['"wuyadong" <wuyadong@tigerknows.com>']
+
+import time
+import random
+import logging
+import threading
+
+import redis
+
+from core.util import load_object
+
+DEFAULT_PROXY_SETTINGS = "settings.proxysettings"
+EWMA_ALPHA = 0.1  # 成功率和延迟的平滑系数
+MIN_SUCCESS_RATE = 0.3  # 成功率低于此值时隔离
+MAX_CONTINUOUS_FAIL = 3  # 连续失败次数达到此值时隔离
+RECOVER_SUCCESS_RATE = 0.5  # 隔离结束后的初始成功率
+
+logger = logging.getLogger(__name__)
+
+
+class ProxyError(Exception):
+    """代理相关的错误
+    """
+
+
+class Proxy(object):
+    """描述一个代理以及它的健康状况
+    """
+
+    def __init__(self, address):
+        """初始化
+            Args:
+                address: str, host:port或者user:password@host:port
+            Raises:
+                ProxyError: 当地址格式错误
+        """
+        self.address = address
+        self.username, self.password = None, None
+        try:
+            auth, _, host_port = address.rpartition("@")
+            if auth:
+                self.username, _, self.password = auth.partition(":")
+            self.host, port = host_port.rsplit(":", 1)
+            self.port = int(port)
+        except ValueError, e:
+            raise ProxyError("invalidate proxy address:%s, error:%s" % (address, e))
+
+        self.success_rate = 1.0
+        self.latency = 0.0
+        self.success_count = 0
+        self.fail_count = 0
+        self.continuous_fail_count = 0
+        self.quarantine_until = 0
+
+    @property
+    def weight(self):
+        """选择的权重，成功率越高，延迟越低，权重越大
+        """
+        return self.success_rate / (self.latency + 0.1)
+
+    def is_available(self, now):
+        return self.quarantine_until <= now
+
+    def to_dict(self):
+        return {"address": "%s:%s" % (self.host, self.port),
+                "success_rate": self.success_rate,
+                "latency": self.latency,
+                "success_count": self.success_count,
+                "fail_count": self.fail_count,
+                "quarantine_until": self.quarantine_until}
+
+
+class ProxyPool(object):
+    """代理池
+        每次请求结束后通过report汇报结果，代理的成功率和延迟采用指数加权平均，
+        连续失败或者成功率过低的代理会被隔离一段时间
+    """
+    _lock = threading.Lock()
+
+    def __init__(self, quarantine_seconds=300):
+        """初始化
+            Args:
+                quarantine_seconds: int, 隔离的时长
+        """
+        self._proxies = {}
+        self._quarantine_seconds = quarantine_seconds
+
+    @staticmethod
+    def instance():
+        """获取代理池
+            单例模式，第一次获取时从settings.proxysettings加载
+            Returns:
+                pool: ProxyPool, 代理池实例
+        """
+        if not hasattr(ProxyPool, "_instance"):
+            with ProxyPool._lock:
+                pool = ProxyPool()
+                try:
+                    pool.load_settings()
+                except Exception, e:
+                    logger.error("load proxy settings failed error:%s" % e)
+                setattr(ProxyPool, "_instance", pool)
+        return getattr(ProxyPool, "_instance")
+
+    def load_settings(self, path=DEFAULT_PROXY_SETTINGS):
+        """从配置文件中加载代理
+            Args:
+                path: str, 配置模块的路径
+        """
+        self._quarantine_seconds = load_object(path + ".quarantine_seconds")
+        self.add_proxies(load_object(path + ".proxies"))
+        redis_key = load_object(path + ".redis_key")
+        if redis_key:
+            self.load_redis(redis_key, host=load_object(path + ".redis_host"),
+                            port=load_object(path + ".redis_port"),
+                            db=load_object(path + ".redis_db"))
+
+    def load_redis(self, key, **kwargs):
+        """从redis的集合中加载代理
+            Args:
+                key: str, 集合的key
+                kwargs: dict, 连接redis的参数
+            Raises:
+                ProxyError: 当redis发生错误
+        """
+        try:
+            addresses = redis.Redis(**kwargs).smembers(key)
+        except Exception, e:
+            raise ProxyError("load proxy from redis error:%s" % e)
+        self.add_proxies(addresses)
+
+    def add_proxies(self, addresses):
+        """增加代理，已经存在的代理保持原有的状态
+            Args:
+                addresses: list, 代理地址列表
+        """
+        for address in addresses:
+            if not self._proxies.has_key(address):
+                try:
+                    self._proxies[address] = Proxy(address)
+                except ProxyError, e:
+                    logger.warn("add proxy failed:%s" % e)
+
+    def remove_proxy(self, address):
+        if self._proxies.has_key(address):
+            self._proxies.pop(address)
+
+    def choose(self):
+        """按照权重随机选择一个可用的代理
+            Returns:
+                proxy: Proxy, 没有可用代理时返回None
+        """
+        now = time.time()
+        candidates = []
+        for proxy in self._proxies.itervalues():
+            if not proxy.is_available(now):
+                continue
+            if proxy.quarantine_until > 0:
+                # 隔离结束，重新给一次机会
+                proxy.quarantine_until = 0
+                proxy.success_rate = RECOVER_SUCCESS_RATE
+                proxy.continuous_fail_count = 0
+            candidates.append(proxy)
+
+        total_weight = sum(proxy.weight for proxy in candidates)
+        if total_weight <= 0:
+            return random.choice(candidates) if candidates else None
+
+        point = random.uniform(0, total_weight)
+        for proxy in candidates:
+            point -= proxy.weight
+            if point <= 0:
+                return proxy
+        return candidates[-1]
+
+    def report(self, proxy, is_success, latency):
+        """汇报一次请求的结果
+            Args:
+                proxy: Proxy, 使用的代理
+                is_success: bool, 是否成功
+                latency: float, 请求耗时，单位秒
+        """
+        proxy.success_rate = (1 - EWMA_ALPHA) * proxy.success_rate + \
+            EWMA_ALPHA * (1.0 if is_success else 0.0)
+        if is_success:
+            proxy.success_count += 1
+            proxy.continuous_fail_count = 0
+            proxy.latency = latency if proxy.success_count == 1 else \
+                (1 - EWMA_ALPHA) * proxy.latency + EWMA_ALPHA * latency
+        else:
+            proxy.fail_count += 1
+            proxy.continuous_fail_count += 1
+            if proxy.continuous_fail_count >= MAX_CONTINUOUS_FAIL or \
+                    proxy.success_rate < MIN_SUCCESS_RATE:
+                proxy.quarantine_until = time.time() + self._quarantine_seconds
+                logger.warn("quarantine proxy:%s, success rate:%s" %
+                            (proxy.address, proxy.success_rate))
+
+    def get_status(self):
+        """获取所有代理的状态
+            Returns:
+                status: list, [dict]
+        """
+        return [proxy.to_dict() for proxy in self._proxies.itervalues()]
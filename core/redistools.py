@@ -6,11 +6,13 @@
     RedisError: 表示redis内部错误
     RedisQueue: 使用redis创建的队列
     RedisDict: 使用redis创建的字典
+    RedisBucketDict: 按时间分桶、自动过期的字典
     RedisSet: 使用redis创建的集合
 """
 
 __author__ = ['"wuyadong" <wuyadong@tigerknows.com>']
 
+import time
 import redis
 from core.util import PickleDeocoder, PickleEncoder
 
@@ -189,6 +191,196 @@ class RedisDict(object):
             raise RedisError("redis error:%s" % e)
 
 
+class RedisBucketDict(object):
+    """按时间分桶、自动过期的字典
+        写入的数据放在当前时间段的hash中，每个hash在最后写入的数据超过ttl后由redis删除，
+        读取时一次查询所有还没有过期的hash，用于保存临时状态，长时间运行时不会无限增长
+    """
+    BUCKET_COUNT = 6  # ttl分成的时间段个数
+
+    def __init__(self, namespace, ttl, **kwargs):
+        """初始化
+            Args:
+                namespace: str, 名字空间，每个hash的名字是"名字空间:编号"
+                ttl: int, 数据保存的最短时间，单位秒
+                kwargs: 字典, 连接redis的参数表
+            Raises:
+                RedisError: 当发生错误的时候
+        """
+        try:
+            self._db = redis.Redis(**kwargs)
+            self.namespace = namespace
+            self._ttl = int(ttl)
+            self._bucket_seconds = max(self._ttl / self.BUCKET_COUNT, 1)
+            self._buckets_name = "%s:buckets" % namespace  # 记录所有hash的名字，用于清除
+        except Exception, e:
+            raise RedisError("connect to redis error:%s " % e)
+
+    def _bucket_name(self, index):
+        return "%s:%d" % (self.namespace, index)
+
+    def _live_buckets(self):
+        """还没有过期的hash，从早到晚排列
+        """
+        now = int(time.time())
+        current_index = now / self._bucket_seconds
+        oldest_index = (now - self._ttl) / self._bucket_seconds - 1
+        return [self._bucket_name(index) for index in xrange(oldest_index, current_index + 1)]
+
+    def set_many(self, key2value):
+        """一次设置多个key的值，放在当前时间段的hash中
+            Args:
+                key2value: dict, key到value的字典
+            Raises:
+                RedisError: 当发生错误的时候
+        """
+        if not key2value:
+            return
+        try:
+            encoder = PickleEncoder()
+            encoded_mapping = dict((key, encoder.encode(value))
+                                   for key, value in key2value.iteritems())
+        except Exception, e:
+            raise RedisError("encode error:%s" % e)
+        self._set_encoded(encoded_mapping)
+
+    def _set_encoded(self, encoded_mapping):
+        """把已经编码的数据写入当前时间段的hash
+        """
+        index = int(time.time()) / self._bucket_seconds
+        bucket_name = self._bucket_name(index)
+        expire_time = (index + 1) * self._bucket_seconds + self._ttl
+        try:
+            pipe = self._db.pipeline()
+            pipe.hmset(bucket_name, encoded_mapping)
+            pipe.expireat(bucket_name, expire_time)
+            pipe.sadd(self._buckets_name, bucket_name)
+            pipe.expireat(self._buckets_name, expire_time)
+            pipe.execute()
+        except Exception, e:
+            raise RedisError("redis error:%s" % e)
+
+    def pop_many(self, keys):
+        """一次获取并删除多个key，只有一次往返
+            同一个key在多个hash中时，使用最晚写入的
+            Args:
+                keys: list, key的列表
+            Returns:
+                key2value: dict, 存在的key到对象的字典
+            Raises:
+                RedisError: 当发生错误的时候
+        """
+        if not keys:
+            return {}
+        bucket_names = self._live_buckets()
+        try:
+            pipe = self._db.pipeline()
+            for bucket_name in bucket_names:
+                pipe.hmget(bucket_name, keys)
+            for bucket_name in bucket_names:
+                pipe.hdel(bucket_name, *keys)
+            results = pipe.execute()[:len(bucket_names)]
+        except Exception, e:
+            raise RedisError("redis error:%s" % e)
+
+        try:
+            decoder = PickleDeocoder()
+            key2value = {}
+            for items in results:
+                for key, item in zip(keys, items):
+                    if item is not None:
+                        key2value[key] = decoder.decode(item)
+            return key2value
+        except Exception, e:
+            raise RedisError("decode error:%s" % e)
+
+    def drain_hash(self, hash_name):
+        """把一个普通hash中的数据移入当前时间段的hash，并删除这个hash
+            用于迁移不分桶时写入的数据，取出和删除在一个事务中，多个进程同时迁移时只有一个取到
+            Args:
+                hash_name: str, hash的名字
+            Returns:
+                count: int, 移入的个数，hash不存在时为0
+            Raises:
+                RedisError: 当发生错误的时候
+        """
+        try:
+            if self._db.type(hash_name) != "hash":
+                return 0
+            pipe = self._db.pipeline()
+            pipe.hgetall(hash_name)
+            pipe.delete(hash_name)
+            encoded_mapping, _ = pipe.execute()
+        except Exception, e:
+            raise RedisError("redis error:%s" % e)
+        if encoded_mapping:
+            self._set_encoded(encoded_mapping)
+        return len(encoded_mapping)
+
+    def bucket_sizes(self):
+        """获取还没有过期的每个hash的大小
+            Returns:
+                sizes: list, [(hash的名字, 大小)]，从早到晚排列
+            Raises:
+                RedisError: 当发生错误的时候
+        """
+        bucket_names = self._live_buckets()
+        try:
+            pipe = self._db.pipeline()
+            for bucket_name in bucket_names:
+                pipe.hlen(bucket_name)
+            return zip(bucket_names, pipe.execute())
+        except Exception, e:
+            raise RedisError("redis error:%s" % e)
+
+    def size(self):
+        """返回大小
+            Returns:
+                size: int, 所有还没有过期的数据的个数
+            Raises:
+                RedisError: 当发生错误的时候
+        """
+        return sum(size for _, size in self.bucket_sizes())
+
+    def trim(self, max_size):
+        """个数超过max_size时，从最早的hash开始整个删除，当前时间段的hash不删除
+            Args:
+                max_size: int, 最大个数
+            Returns:
+                size, dropped_count: 删除后的个数和删除的个数
+            Raises:
+                RedisError: 当发生错误的时候
+        """
+        sizes = self.bucket_sizes()
+        size = sum(bucket_size for _, bucket_size in sizes)
+        dropped_names, dropped_count = [], 0
+        for bucket_name, bucket_size in sizes[:-1]:
+            if size <= max_size:
+                break
+            if bucket_size:
+                dropped_names.append(bucket_name)
+                dropped_count += bucket_size
+                size -= bucket_size
+        if dropped_names:
+            try:
+                self._db.delete(*dropped_names)
+                self._db.srem(self._buckets_name, *dropped_names)
+            except Exception, e:
+                raise RedisError("redis error:%s" % e)
+        return size, dropped_count
+
+    def clear(self):
+        """清除所有对象
+            Raises:
+                RedisError: redis出现错误
+        """
+        try:
+            bucket_names = list(self._db.smembers(self._buckets_name))
+            self._db.delete(self._buckets_name, *bucket_names)
+        except Exception, e:
+            raise RedisError("redis error: %s" % e)
+
+
 class RedisSet(object):
     """使用redis构造的结合
 
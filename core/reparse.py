@@ -0,0 +1,184 @@
+#!/usr/bin/python2.7
+#-*- coding=utf-8 -*-
+
+
+"""离线批量重新解析
+    从保存页面的目录或者归档中读取页面，在进程池中并行运行spider的parser，
+    归档中的页面交给下载时task的callback对应的parser，task的kwargs还原为下载时的kwargs，
+    没有记录callback的页面和目录中的文件使用指定的parser，解析出的item按批交给主进程中spider的pipeline处理，新的task不再抓取
+    ReparseError: 重新解析的错误
+    list_inputs(): 列出目录或者归档中所有的输入
+    reparse(): 批量重新解析
+"""
+
+__authors__ = ['"wuyadong" <wuyadong@tigerknows.com>']
+
+import os
+import glob
+import mmap
+import logging
+import datetime
+import StringIO
+import multiprocessing
+
+from core.util import get_class_path, load_object
+from core.archive import ArchiveReader, INDEX_SUFFIX, read_record
+from core.datastruct import FileTask, HttpTask, Item
+from core.spider.pipeline import PipelineError
+from core.statistic import WorkerStatistic
+
+DEFAULT_CHUNK_SIZE = 50  # 每次交给子进程的输入个数
+
+INPUT_FILE = "file"
+INPUT_ARCHIVE = "archive"
+
+logger = logging.getLogger(__name__)
+
+_parsers = {}  # 子进程中的parser
+
+
+class ReparseError(Exception):
+    """重新解析的错误
+    """
+
+
+def list_inputs(source):
+    """列出目录或者归档中所有的输入
+        含有归档索引的目录作为归档处理，否则处理目录下的所有文件
+        Args:
+            source: str, 目录
+        Returns:
+            inputs: list, [(类型, 路径, 偏移, 长度)]
+        Raises:
+            ReparseError: 目录不存在
+    """
+    if not os.path.isdir(source):
+        raise ReparseError("not exists directory:%s" % source)
+
+    if glob.glob(os.path.join(source, "*" + INDEX_SUFFIX)):
+        return [(INPUT_ARCHIVE, segment_path, offset, length) for segment_path, offset, length
+                in ArchiveReader(source).iter_locations()]
+
+    inputs = []
+    for dir_path, _, file_names in os.walk(source):
+        for file_name in file_names:
+            inputs.append((INPUT_FILE, os.path.join(dir_path, file_name), 0, 0))
+    return inputs
+
+
+def _init_parsers(spider_class_path, namespace, spider_kwargs):
+    """子进程的初始化函数，创建parser
+    """
+    global _parsers
+    _parsers = load_object(spider_class_path).create_parsers(namespace, spider_kwargs)
+
+
+def _open_input(input_type, path, offset, length):
+    """打开一个输入
+        文件使用mmap映射，不需要完整地读入内存
+        Returns:
+            input_file, kwargs, callback: 文件对象，task的参数和归档中记录的callback，
+                归档中没有记录kwargs时参数只有url
+    """
+    if input_type == INPUT_ARCHIVE:
+        url, _, _, body, callback, kwargs = read_record(path, offset, length)
+        kwargs = dict(kwargs or {})
+        kwargs.setdefault("url", url)
+        return StringIO.StringIO(body), kwargs, callback
+
+    with open(path, "rb") as in_file:
+        if os.fstat(in_file.fileno()).st_size == 0:
+            return StringIO.StringIO(""), {"file_path": path}, None
+        return (mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_READ), {"file_path": path},
+                None)
+
+
+def _parse_chunk(args):
+    """在子进程中解析一批输入
+        每个输入使用归档中记录的callback，没有记录时使用默认的callback
+        Args:
+            args: tuple, (默认的callback, inputs)
+        Returns:
+            items, callback2parsed, callback2task, fails: 解析出的item，每个callback成功解析的
+                输入个数，忽略的task个数，失败的列表[(路径, callback, 原因)]
+    """
+    default_callback, inputs = args
+    items, callback2parsed, callback2task, fails = [], {}, {}, []
+    for input_type, path, offset, length in inputs:
+        input_file, callback = None, default_callback
+        try:
+            input_file, kwargs, record_callback = _open_input(input_type, path, offset, length)
+            if record_callback is not None:
+                callback = record_callback
+            if not _parsers.has_key(callback):
+                raise ReparseError("not exists callback:%s" % callback)
+            task = FileTask(path, callback, kwargs=kwargs)
+            for item_or_task in _parsers[callback].parse(task, input_file) or []:
+                if isinstance(item_or_task, Item):
+                    items.append((item_or_task, task.kwargs))
+                elif isinstance(item_or_task, (HttpTask, FileTask)):
+                    callback2task[callback] = callback2task.get(callback, 0) + 1
+            callback2parsed[callback] = callback2parsed.get(callback, 0) + 1
+        except Exception, e:
+            fails.append((path, callback, "%s" % e))
+        finally:
+            if input_file is not None:
+                input_file.close()
+    return items, callback2parsed, callback2task, fails
+
+
+def _chunks(inputs, chunk_size):
+    for start in xrange(0, len(inputs), chunk_size):
+        yield inputs[start:start + chunk_size]
+
+
+def reparse(spider, source, callback=None, processes=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """批量重新解析
+        Args:
+            spider: BaseSpider, spider实例，item交给它的pipeline处理
+            source: str, 保存页面的目录或者归档目录
+            callback: str, 默认的parser名字，用于目录中的文件和没有记录callback的归档记录，
+                None表示没有默认的parser
+            processes: int, 进程数，None表示cpu个数
+            chunk_size: int, 每次交给子进程的输入个数
+        Returns:
+            statistic: WorkerStatistic, 统计信息
+        Raises:
+            ReparseError: 输入或者callback错误
+    """
+    if callback is not None and not spider.parsers.has_key(callback):
+        raise ReparseError("not exists callback:%s" % callback)
+    inputs = list_inputs(source)
+    statistic = WorkerStatistic()
+    statistic.start_time = datetime.datetime.now()
+    logger.info("reparse %s inputs from %s" % (len(inputs), source))
+
+    pool = multiprocessing.Pool(processes, _init_parsers,
+                                (get_class_path(spider.__class__), spider.spider_kwargs.get("namespace"),
+                                 spider.spider_kwargs))
+    try:
+        for items, callback2parsed, callback2task, fails in pool.imap_unordered(
+                _parse_chunk, ((callback, chunk) for chunk in _chunks(inputs, chunk_size))):
+            for path, fail_callback, reason in fails:
+                logger.warn("reparse %s error:%s" % (path, reason))
+                statistic.add_spider_fail("parser-%s" % fail_callback, reason)
+            for parser_name, parsed_count in callback2parsed.iteritems():
+                statistic.add_spider_success(parser_name + "-extract", parsed_count)
+            for parser_name, task_count in callback2task.iteritems():
+                statistic.add_spider_success(parser_name + "-ignoretask", task_count)
+            # 每批按item类名分组，交给pipeline批量处理
+            name2items = {}
+            for item, kwargs in items:
+                name2items.setdefault(item.__class__.__name__, []).append((item, kwargs))
+            for item_name, named_items in name2items.iteritems():
+                try:
+                    spider.handle_items(item_name, named_items)
+                except PipelineError, e:
+                    statistic.add_spider_fail("handle-" + item_name, "%s" % e)
+                else:
+                    statistic.add_spider_success("%s-%s" % (item_name, "handle"), len(named_items))
+    finally:
+        pool.close()
+        pool.join()
+        statistic.end_time = datetime.datetime.now()
+    return statistic
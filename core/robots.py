@@ -0,0 +1,328 @@
+#!/usr/bin/python2.7
+#-*- coding=utf-8 -*-
+
+
+"""robots.txt的缓存
+    每个host的robots.txt只异步下载一次，解析后的规则缓存一段时间，
+    规则还没有下载下来之前的url都允许，下载时再检查一次，
+    robots.txt和普通请求一样占用host和client的请求名额
+    RobotsDisallowedError: url被robots.txt禁止
+    CrawlDelayError: 需要等待Crawl-delay，task稍后再抓取
+    RobotsRules: 一个host的规则
+    RobotsCache: 所有host规则的缓存
+    is_allowed_by_robots(): task是否被robots.txt允许
+"""
+
+__authors__ = ['"wuyadong" <wuyadong@tigerknows.com>']
+
+import re
+import time
+import logging
+import urlparse
+import threading
+
+import pycurl
+from tornado import gen
+from tornado.httpclient import HTTPRequest
+
+from core.datastruct import HttpTask
+from core.fetcher import FetcherSettings, HostLimiter, SlotArbiter, get_client, \
+    set_curl_progress
+
+ROBOTS_AGENT = "tigerspider"  # 匹配robots.txt中User-agent的名字
+ROBOTS_TTL = 24 * 60 * 60  # 规则缓存的时间
+ROBOTS_ERROR_TTL = 10 * 60  # 下载robots.txt失败时，允许所有url的时间
+ROBOTS_TIMEOUT = 10
+ROBOTS_SLOT_OWNER = "robots"  # 下载robots.txt时向SlotArbiter申请名额的owner
+
+logger = logging.getLogger(__name__)
+
+
+class RobotsDisallowedError(Exception):
+    """url被robots.txt禁止
+    """
+
+
+class CrawlDelayError(Exception):
+    """需要等待Crawl-delay，task稍后再抓取
+        Attributes:
+            retry_after: float, 距离host下一个可以预约的时间的秒数
+    """
+
+    def __init__(self, message, retry_after=0):
+        Exception.__init__(self, message)
+        self.retry_after = retry_after
+
+
+def _compile_pattern(pattern):
+    """把带有*和$的规则编译成正则表达式
+    """
+    regex = re.escape(pattern).replace(r"\*", ".*")
+    if regex.endswith(r"\$"):
+        regex = regex[:-2] + "$"
+    return re.compile(regex)
+
+
+class RobotsRules(object):
+    """一个host的规则
+        普通的规则按长度从长到短排列，做前缀匹配，最长的匹配生效，
+        带有通配符的规则编译为正则表达式
+    """
+
+    def __init__(self, rules=None, crawl_delay=None):
+        """初始化
+            Args:
+                rules: list, [(path, is_allowed)]
+                crawl_delay: float, 抓取间隔，单位秒
+        """
+        self.crawl_delay = crawl_delay
+        self._rules = []
+        for path, is_allowed in rules or []:
+            if "*" in path or path.endswith("$"):
+                self._rules.append((len(path), _compile_pattern(path), is_allowed))
+            else:
+                self._rules.append((len(path), path, is_allowed))
+        # 同样长度时allow优先
+        self._rules.sort(key=lambda rule: (rule[0], rule[2]), reverse=True)
+
+    @staticmethod
+    def parse(content, agent=ROBOTS_AGENT):
+        """解析robots.txt
+            使用名字匹配agent的组，没有的话使用"*"组
+            Args:
+                content: str, robots.txt的内容
+                agent: str, 名字
+            Returns:
+                rules: RobotsRules
+        """
+        groups = {}
+        agents, is_agent_line = [], False
+        for line in content.splitlines():
+            line = line.split("#", 1)[0].strip()
+            if ":" not in line:
+                continue
+            key, value = line.split(":", 1)
+            key, value = key.strip().lower(), value.strip()
+            if key == "user-agent":
+                if not is_agent_line:
+                    agents = []
+                agents.append(value.lower())
+                for name in agents:
+                    groups.setdefault(name, ([], []))
+                is_agent_line = True
+                continue
+            is_agent_line = False
+            for name in agents:
+                rules, delays = groups[name]
+                if key in ("allow", "disallow") and value:
+                    rules.append((value, key == "allow"))
+                elif key == "crawl-delay":
+                    try:
+                        delays.append(float(value))
+                    except ValueError:
+                        pass
+
+        agent = agent.lower()
+        group = None
+        for name in groups.iterkeys():
+            if name != "*" and name in agent:
+                group = groups[name]
+                break
+        if group is None:
+            group = groups.get("*", ([], []))
+        rules, delays = group
+        return RobotsRules(rules, delays[0] if delays else None)
+
+    @property
+    def rule_count(self):
+        return len(self._rules)
+
+    def is_allowed(self, path):
+        """path是否允许抓取
+            Args:
+                path: str, url的path和query
+            Returns:
+                is_allowed: bool
+        """
+        for _, rule, is_allowed in self._rules:
+            if isinstance(rule, basestring):
+                if path.startswith(rule):
+                    return is_allowed
+            elif rule.match(path):
+                return is_allowed
+        return True
+
+
+class RobotsCache(object):
+    """所有host规则的缓存
+        抓取时间的预约只在当前进程中有效，多进程模式下每个子进程的Crawl-delay
+    乘以crawl_delay_factor(子进程个数)，所有子进程加起来不超过host允许的频率
+    """
+    _lock = threading.Lock()
+    crawl_delay_factor = 1
+
+    def __init__(self):
+        self._host2rules = {}  # host到(规则, 过期时间)
+        self._fetching_hosts = set()
+        self._host2next_time = {}
+
+    @staticmethod
+    def instance():
+        """获取robots缓存
+            单例模式
+            Returns:
+                cache: RobotsCache 实例
+        """
+        if not hasattr(RobotsCache, "_instance"):
+            with RobotsCache._lock:
+                setattr(RobotsCache, "_instance", RobotsCache())
+        return getattr(RobotsCache, "_instance")
+
+    def get_rules(self, url):
+        """获取url所在host的规则
+            没有缓存或者已经过期时，异步下载robots.txt，并返回None
+            Args:
+                url: str, url
+            Returns:
+                rules: RobotsRules, 或者None
+        """
+        scheme, host = urlparse.urlsplit(url)[:2]
+        rules, expire_time = self._host2rules.get(host, (None, 0))
+        if expire_time < time.time():
+            self._fetch_robots(scheme, host)
+        return rules
+
+    def is_allowed(self, url):
+        """url是否允许抓取
+            Args:
+                url: str, url
+            Returns:
+                is_allowed: bool, 规则还没有下载时返回True
+        """
+        rules = self.get_rules(url)
+        if rules is None:
+            return True
+        _, _, path, query, _ = urlparse.urlsplit(url)
+        return rules.is_allowed((path or "/") + ("?" + query if query else ""))
+
+    def reserve(self, url):
+        """按照Crawl-delay为url所在host预约一个抓取时间
+            Args:
+                url: str, url
+            Returns:
+                wait: float, 需要等待的秒数，等待超过一个Crawl-delay时返回None，
+                    这时不预约，task应该稍后再抓取
+        """
+        crawl_delay = self.get_crawl_delay(url)
+        if not crawl_delay:
+            return 0
+        host = urlparse.urlsplit(url).netloc
+        now = time.time()
+        start_time = max(now, self._host2next_time.get(host, 0))
+        if start_time - now > crawl_delay:
+            return None
+        self._host2next_time[host] = start_time + crawl_delay
+        return start_time - now
+
+    def get_retry_after(self, url):
+        """获取距离url所在host可以预约抓取时间还有多少秒
+            Args:
+                url: str, url
+            Returns:
+                seconds: float, 现在就可以预约时为0
+        """
+        crawl_delay = self.get_crawl_delay(url)
+        if not crawl_delay:
+            return 0
+        host = urlparse.urlsplit(url).netloc
+        return max(self._host2next_time.get(host, 0) - crawl_delay - time.time(), 0)
+
+    def get_crawl_delay(self, url):
+        """获取url所在host在当前进程中的抓取间隔
+            Args:
+                url: str, url
+            Returns:
+                crawl_delay: float, 单位秒，没有限制时为None
+        """
+        rules = self.get_rules(url)
+        if rules is None or not rules.crawl_delay:
+            return None
+        return rules.crawl_delay * self.crawl_delay_factor
+
+    @gen.coroutine
+    def _fetch_robots(self, scheme, host):
+        """异步下载robots.txt
+            和普通请求一样等待host和client的名额，使用同一个client
+        """
+        if host in self._fetching_hosts:
+            return
+        self._fetching_hosts.add(host)
+        request = HTTPRequest("%s://%s/robots.txt" % (scheme or "http", host),
+                              connect_timeout=ROBOTS_TIMEOUT, request_timeout=ROBOTS_TIMEOUT,
+                              prepare_curl_callback=_prepare_robots_curl)
+        host_limiter, slot_arbiter = HostLimiter.instance(), SlotArbiter.instance()
+        try:
+            yield host_limiter.acquire(host)
+            yield slot_arbiter.acquire(ROBOTS_SLOT_OWNER)
+            try:
+                resp = yield gen.Task(get_client().fetch, request)
+            finally:
+                slot_arbiter.release(ROBOTS_SLOT_OWNER)
+                host_limiter.release(host)
+        except Exception, e:
+            self._fetching_hosts.discard(host)
+            logger.error("fetch robots of host:%s error:%s" % (host, e))
+        else:
+            self._handle_robots(host, resp)
+
+    def _handle_robots(self, host, resp):
+        """处理下载的robots.txt
+            4xx表示没有限制，连接失败和5xx时暂时允许所有url，稍后重试
+        """
+        self._fetching_hosts.discard(host)
+        if resp.code == 200:
+            try:
+                rules, ttl = RobotsRules.parse(resp.body or ""), ROBOTS_TTL
+            except Exception, e:
+                logger.warn("parse robots of host:%s error:%s" % (host, e))
+                rules, ttl = RobotsRules(), ROBOTS_ERROR_TTL
+        elif 400 <= resp.code < 500:
+            rules, ttl = RobotsRules(), ROBOTS_TTL
+        else:
+            logger.warn("fetch robots of host:%s failed code:%s" % (host, resp.code))
+            rules, ttl = RobotsRules(), ROBOTS_ERROR_TTL
+        self._host2rules[host] = (rules, time.time() + ttl)
+
+    def get_status(self):
+        """获取每个host规则的状态
+            Returns:
+                status: dict, host到{"rule_count", "crawl_delay", "expire_time"}的字典
+        """
+        status = {}
+        for host, (rules, expire_time) in self._host2rules.iteritems():
+            status[host] = {"rule_count": rules.rule_count,
+                            "crawl_delay": rules.crawl_delay,
+                            "expire_time": expire_time}
+        return status
+
+
+def _prepare_robots_curl(curl):
+    """设置下载robots.txt的curl handle
+        curl handle会被复用，要清除之前的请求留下的MAXFILESIZE和进度回调
+    """
+    FetcherSettings.instance().prepare_curl(curl)
+    curl.setopt(pycurl.MAXFILESIZE, 0)
+    set_curl_progress(curl, None)
+
+
+def is_allowed_by_robots(task):
+    """task是否被robots.txt允许
+        只检查robots_need为True的HttpTask
+        Args:
+            task: Task, 任务
+        Returns:
+            is_allowed: bool
+    """
+    if not isinstance(task, HttpTask) or not task.robots_need:
+        return True
+    return RobotsCache.instance().is_allowed(task.request.url)
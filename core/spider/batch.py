@@ -0,0 +1,90 @@
+#!/usr/bin/python2.7
+#-*- coding=utf-8 -*-
+
+
+"""worker中按pipeline攒批的item
+    batch_size大于1的pipeline的item先放入对应的批，个数达到batch_size
+    或者最早的item等待超过max_linger时，整批交给flush_callback处理，
+    同时交出这批item计入内存预算的字节数，由flush_callback在处理完成后释放
+    ItemBatcher: 按item类名分组的批
+"""
+
+__authors__ = ['"wuyadong" <wuyadong@tigerknows.com>']
+
+import time
+
+from tornado import ioloop
+
+BATCH_CHECK_INTERVAL = 100  # 检查等待时间的间隔，单位毫秒
+
+
+class ItemBatcher(object):
+    """按item类名分组的批
+    """
+
+    def __init__(self, flush_callback):
+        """初始化
+            Args:
+                flush_callback: function, flush_callback(item_name, batch, batch_bytes)，
+                    batch是[(task, item)]，batch_bytes是这批item的字节数
+        """
+        self._flush_callback = flush_callback
+        self._name2batch = {}  # item类名到[(task, item)]
+        self._name2bytes = {}
+        self._name2first_time = {}
+        self._name2linger = {}
+        self._check_callback = ioloop.PeriodicCallback(self._flush_timeout, BATCH_CHECK_INTERVAL,
+                                                       io_loop=ioloop.IOLoop.instance())
+        self._check_callback.start()
+
+    def __len__(self):
+        return sum(len(batch) for batch in self._name2batch.itervalues())
+
+    @property
+    def bytes(self):
+        """等待中的item的字节数
+        """
+        return sum(self._name2bytes.itervalues())
+
+    def add(self, task, item, batch_size, max_linger, size=0):
+        """加入一个item，批满时处理
+            Args:
+                task: HttpTask or FileTask, 解析出item的task
+                item: Item, item
+                batch_size: int, 批的大小
+                max_linger: float, 最长等待时间，单位秒
+                size: int, item计入内存预算的字节数
+        """
+        item_name = item.__class__.__name__
+        batch = self._name2batch.setdefault(item_name, [])
+        if not batch:
+            self._name2first_time[item_name] = time.time()
+            self._name2linger[item_name] = max_linger
+        batch.append((task, item))
+        self._name2bytes[item_name] = self._name2bytes.get(item_name, 0) + size
+        if len(batch) >= batch_size:
+            self.flush(item_name)
+
+    def _flush_timeout(self):
+        now = time.time()
+        for item_name, batch in self._name2batch.items():
+            if batch and now - self._name2first_time[item_name] >= self._name2linger[item_name]:
+                self.flush(item_name)
+
+    def flush(self, item_name=None):
+        """处理等待中的item
+            Args:
+                item_name: str, 只处理这种item，None表示全部
+        """
+        item_names = self._name2batch.keys() if item_name is None else [item_name]
+        for name in item_names:
+            batch = self._name2batch.pop(name, None)
+            batch_bytes = self._name2bytes.pop(name, 0)
+            if batch:
+                self._flush_callback(name, batch, batch_bytes)
+
+    def close(self):
+        """处理所有等待中的item，停止定时检查
+        """
+        self._check_callback.stop()
+        self.flush()
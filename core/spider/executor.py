@@ -0,0 +1,138 @@
+#!/usr/bin/python2.7
+#-*- coding=utf-8 -*-
+
+
+"""在线程池中执行pipeline
+    item或者item的批放入队列，由多个线程调用spider.handle_item或handle_items处理，
+    结果通过IOLoop设置到Future中，
+    慢的pipeline(文件、数据库、redis)不再阻塞下载，只有spider设置了pipeline_thread_number时使用，
+    这时spider的所有pipeline都必须声明thread_safe，否则不创建线程池
+    PipelineExecutor: 执行pipeline的线程池
+    create_pipeline_executor(): 按spider的配置创建线程池
+"""
+
+__authors__ = ['"wuyadong" <wuyadong@tigerknows.com>']
+
+import Queue
+import logging
+import threading
+
+from tornado import ioloop
+from tornado.concurrent import Future
+
+logger = logging.getLogger(__name__)
+
+
+class PipelineExecutor(object):
+    """执行pipeline的线程池
+        队列的长度超过max_queue_size时is_full返回True，worker暂停获取新的任务，
+        已经解析出的item仍然放入队列，不会丢弃
+    """
+
+    def __init__(self, spider, thread_number, max_queue_size):
+        """初始化
+            Args:
+                spider: BaseSpider, spider实例
+                thread_number: int, 线程的个数
+                max_queue_size: int, 等待处理的item的最大个数
+        """
+        self._spider = spider
+        self._max_queue_size = max_queue_size
+        self._io_loop = ioloop.IOLoop.instance()
+        self._queue = Queue.Queue()
+        self._threads = []
+        for index in xrange(thread_number):
+            thread = threading.Thread(target=self._run, name="pipeline-%s" % index)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, item, kwargs):
+        """放入一个item
+            Args:
+                item: Item, 解析出的结果
+                kwargs: dict, 额外的参数字典
+            Returns:
+                future: Future, 处理失败时设置为PipelineError
+        """
+        return self._submit(self._spider.handle_item, item, kwargs)
+
+    def submit_items(self, item_name, items):
+        """放入一批同一种item
+            Args:
+                item_name: str, item的类名
+                items: list, [(item, kwargs)]
+            Returns:
+                future: Future, 处理失败时设置为PipelineError
+        """
+        return self._submit(self._spider.handle_items, item_name, items)
+
+    def _submit(self, method, *args):
+        future = Future()
+        self._queue.put((future, method, args))
+        return future
+
+    def _run(self):
+        while True:
+            operation = self._queue.get()
+            if operation is None:
+                break
+            future, method, args = operation
+            try:
+                result = method(*args)
+            except Exception, e:
+                self._io_loop.add_callback(future.set_exception, e)
+            else:
+                self._io_loop.add_callback(_set_result, future, result)
+
+    @property
+    def queue_size(self):
+        return self._queue.qsize()
+
+    def is_full(self):
+        """等待处理的item是否超过了队列的长度
+            Returns:
+                is_full: bool
+        """
+        return self._queue.qsize() >= self._max_queue_size
+
+    def close(self):
+        """等待队列中的item处理完，结束所有线程
+        """
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+
+def _set_result(future, result):
+    """设置结果，pipeline返回Future时等待它完成
+    """
+    if isinstance(result, Future):
+        result.add_done_callback(lambda done: future.set_exception(done.exception())
+                                 if done.exception() is not None
+                                 else future.set_result(done.result()))
+    else:
+        future.set_result(result)
+
+
+def create_pipeline_executor(spider):
+    """按spider的pipeline_thread_number和pipeline_queue_size创建线程池
+        Args:
+            spider: BaseSpider, spider实例
+        Returns:
+            executor: PipelineExecutor, 没有设置线程个数或者有pipeline不是线程安全的时候返回None，
+                item在IOLoop中同步处理
+    """
+    thread_number = getattr(spider, "pipeline_thread_number", 0)
+    if thread_number <= 0:
+        return None
+    unsafe_names = [name for name, pipeline_claz in spider.pipelines.iteritems()
+                    if not getattr(pipeline_claz, "thread_safe", False)]
+    if unsafe_names:
+        logger.error("pipelines:%s of %s are not thread safe, handle items in ioloop" %
+                     (", ".join(sorted(unsafe_names)), spider.__class__.__name__))
+        return None
+    logger.info("start %s pipeline threads for %s" % (thread_number, spider.__class__.__name__))
+    return PipelineExecutor(spider, thread_number, spider.pipeline_queue_size)
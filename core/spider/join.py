@@ -0,0 +1,256 @@
+#!/usr/bin/python2.7
+#-*- coding=utf-8 -*-
+
+
+"""pipeline之间按key关联的数据
+    先到的一半(例如列表页的ActivityItem)放在进程内的字典中，后到的一半按key取出，
+    超过内存预算或者等待超过ttl的数据批量写入redis，本地没有时再批量从redis中取，
+    同一个进程中的关联不再访问redis，多进程模式下两半可能在不同的进程中，
+    子进程会设置force_write_through，所有缓存的ttl都是0，先到的一半直接写入redis，
+    redis中的数据按时间分桶，超过redis_ttl后自动删除，个数超过max_redis_count时删除最早的桶，
+    创建时把以前不分桶写入的同名hash移入桶中
+    JoinBuffer: 按key关联的缓存
+"""
+
+__authors__ = ['"wuyadong" <wuyadong@tigerknows.com>']
+
+import time
+import logging
+import threading
+import collections
+
+from tornado import ioloop
+
+from core.util import estimate_size
+from core.redistools import RedisBucketDict
+
+DEFAULT_JOIN_MAX_BYTES = 64 * 1024 * 1024
+DEFAULT_JOIN_TTL = 10 * 60  # 本地保存的最长时间，单位秒
+DEFAULT_JOIN_REDIS_TTL = 24 * 60 * 60  # redis中保存的最短时间，单位秒
+DEFAULT_JOIN_MAX_REDIS_COUNT = 1000000  # redis中的最大个数
+JOIN_CHECK_INTERVAL = 1000  # 检查过期数据的间隔，单位毫秒
+REDIS_CHECK_INTERVAL = 60  # 检查redis中个数的间隔，单位秒
+
+logger = logging.getLogger(__name__)
+
+
+class JoinBuffer(object):
+    """按key关联的缓存
+        同一个名字空间在进程中只有一个实例，由关联的两个pipeline共享，
+        pipeline在线程池中执行时也可以使用
+        Attributes:
+            force_write_through: bool, 为True时忽略ttl，全部直接写入redis，
+                多进程模式的子进程中设置，之后创建的缓存生效
+    """
+    _buffers = {}  # 名字空间到JoinBuffer
+    _lock = threading.Lock()
+    force_write_through = False
+
+    def __init__(self, namespace, max_bytes=DEFAULT_JOIN_MAX_BYTES, ttl=DEFAULT_JOIN_TTL,
+                 redis_ttl=DEFAULT_JOIN_REDIS_TTL, max_redis_count=DEFAULT_JOIN_MAX_REDIS_COUNT,
+                 **kwargs):
+        """初始化
+            Args:
+                namespace: str, redis中的名字空间
+                max_bytes: int, 本地数据的内存预算
+                ttl: float, 本地保存的最长时间，单位秒，0表示不在本地保存，
+                    force_write_through为True时总是0
+                redis_ttl: int, redis中保存的最短时间，单位秒
+                max_redis_count: int, redis中的最大个数
+                kwargs: dict, 连接redis的参数
+            Raises:
+                RedisError: 连接失败
+        """
+        if JoinBuffer.force_write_through:
+            ttl = 0
+        self._redis_dict = RedisBucketDict(namespace, redis_ttl, **kwargs)
+        drained_count = self._redis_dict.drain_hash(namespace)
+        if drained_count:
+            logger.info("move %s entries of old hash:%s into buckets" % (drained_count, namespace))
+        self._max_bytes = max_bytes
+        self._ttl = ttl
+        self._max_redis_count = max_redis_count
+        self._redis_check_time = 0
+        self.redis_count = 0
+        self.dropped_count = 0
+        # key到(value, 放入时间, 字节数)，按放入时间排序
+        self._key2entry = collections.OrderedDict()
+        self._local_bytes = 0
+        self._entry_lock = threading.Lock()
+        self.local_hit_count = 0
+        self.redis_hit_count = 0
+        self.miss_count = 0
+        self.spill_count = 0
+        self._check_callback = ioloop.PeriodicCallback(self._spill_expired, JOIN_CHECK_INTERVAL,
+                                                       io_loop=ioloop.IOLoop.instance())
+        self._check_callback.start()
+
+    @staticmethod
+    def get_buffer(namespace, max_bytes=DEFAULT_JOIN_MAX_BYTES, ttl=DEFAULT_JOIN_TTL,
+                   redis_ttl=DEFAULT_JOIN_REDIS_TTL, max_redis_count=DEFAULT_JOIN_MAX_REDIS_COUNT,
+                   **kwargs):
+        """获取名字空间对应的缓存，不存在时创建
+            Args:
+                namespace: str, redis中的名字空间
+                max_bytes: int, 本地数据的内存预算
+                ttl: float, 本地保存的最长时间，单位秒
+                redis_ttl: int, redis中保存的最短时间，单位秒
+                max_redis_count: int, redis中的最大个数
+                kwargs: dict, 连接redis的参数
+            Returns:
+                join_buffer: JoinBuffer
+            Raises:
+                RedisError: 连接失败
+        """
+        with JoinBuffer._lock:
+            if namespace not in JoinBuffer._buffers:
+                JoinBuffer._buffers[namespace] = JoinBuffer(namespace, max_bytes, ttl, redis_ttl,
+                                                            max_redis_count, **kwargs)
+            return JoinBuffer._buffers[namespace]
+
+    @staticmethod
+    def get_all_status():
+        """获取进程中所有缓存的状态
+            Returns:
+                status: dict, 名字空间到get_status()的字典
+        """
+        with JoinBuffer._lock:
+            buffers = JoinBuffer._buffers.items()
+        return dict((namespace, join_buffer.get_status()) for namespace, join_buffer in buffers)
+
+    def __len__(self):
+        return len(self._key2entry)
+
+    def put(self, key, value):
+        """放入先到的一半
+            超过内存预算时，最早放入的数据写入redis
+            Args:
+                key: str, 关联的key
+                value: object, 可以pickle的对象
+            Raises:
+                RedisError: 写入redis失败
+        """
+        if self._ttl <= 0:
+            self._spill({key: value})
+            return
+        size = estimate_size(value)
+        with self._entry_lock:
+            self._remove(key)
+            self._key2entry[key] = (value, time.time(), size)
+            self._local_bytes += size
+            spilled = {}
+            while self._local_bytes > self._max_bytes and len(self._key2entry) > 1:
+                old_key = next(iter(self._key2entry))
+                spilled[old_key] = self._remove(old_key)
+        self._spill(spilled)
+
+    def pop_many(self, keys):
+        """取出后到的一半对应的数据
+            本地没有的key一次从redis中取出
+            Args:
+                keys: list, 关联的key
+            Returns:
+                key2value: dict, 找到的key到对象的字典
+            Raises:
+                RedisError: 读取redis失败
+        """
+        key2value, missing_keys = {}, []
+        with self._entry_lock:
+            for key in keys:
+                if key in self._key2entry:
+                    key2value[key] = self._remove(key)
+                else:
+                    missing_keys.append(key)
+        self.local_hit_count += len(key2value)
+        if missing_keys:
+            redis_key2value = self._redis_dict.pop_many(missing_keys)
+            self.redis_hit_count += len(redis_key2value)
+            self.miss_count += len(missing_keys) - len(redis_key2value)
+            key2value.update(redis_key2value)
+        return key2value
+
+    def _remove(self, key):
+        """删除本地的数据，调用前需要获得_entry_lock
+            Returns:
+                value: object, 不存在时返回None
+        """
+        entry = self._key2entry.pop(key, None)
+        if entry is None:
+            return None
+        value, _, size = entry
+        self._local_bytes -= size
+        return value
+
+    def _spill(self, key2value):
+        if key2value:
+            self._redis_dict.set_many(key2value)
+            self.spill_count += len(key2value)
+
+    def _spill_expired(self):
+        """把等待超过ttl的数据写入redis，另一半可能在其它进程中
+        """
+        expire_time = time.time() - self._ttl
+        spilled = {}
+        with self._entry_lock:
+            for key, (_, put_time, _) in self._key2entry.iteritems():
+                if put_time > expire_time:
+                    break
+                spilled[key] = None
+            for key in spilled:
+                spilled[key] = self._remove(key)
+        try:
+            self._spill(spilled)
+        except Exception, e:
+            logger.error("spill join buffer error:%s" % e)
+
+        if time.time() - self._redis_check_time >= REDIS_CHECK_INTERVAL:
+            self._redis_check_time = time.time()
+            self._trim_redis()
+
+    def _trim_redis(self):
+        """redis中的个数超过max_redis_count时删除最早的桶
+        """
+        try:
+            self.redis_count, dropped_count = self._redis_dict.trim(self._max_redis_count)
+        except Exception, e:
+            logger.error("trim join buffer error:%s" % e)
+        else:
+            if dropped_count:
+                self.dropped_count += dropped_count
+                logger.warn("drop %s join entries over max redis count:%s" %
+                            (dropped_count, self._max_redis_count))
+
+    def get_status(self):
+        """获取缓存的状态
+            Returns:
+                status: dict, 本地的个数和字节数，redis中的个数(最近一次检查时)，
+                    以及命中、写入redis和超过上限删除的次数
+        """
+        return {"local_count": len(self._key2entry), "local_bytes": self._local_bytes,
+                "redis_count": self.redis_count, "local_hit_count": self.local_hit_count,
+                "redis_hit_count": self.redis_hit_count, "miss_count": self.miss_count,
+                "spill_count": self.spill_count, "dropped_count": self.dropped_count}
+
+    def spill_all(self):
+        """把本地的所有数据写入redis，停止定时检查
+            进程退出之前调用，另一半可能在其它进程中或者之后才被抓取
+            Raises:
+                RedisError: 写入redis失败
+        """
+        self._check_callback.stop()
+        with self._entry_lock:
+            spilled = dict((key, self._remove(key)) for key in self._key2entry.keys())
+        self._spill(spilled)
+
+    def clear(self):
+        """清除本地和redis中的所有数据，停止定时检查
+        """
+        self._check_callback.stop()
+        with self._entry_lock:
+            self._key2entry.clear()
+            self._local_bytes = 0
+        with JoinBuffer._lock:
+            for namespace, join_buffer in JoinBuffer._buffers.items():
+                if join_buffer is self:
+                    del JoinBuffer._buffers[namespace]
+        self._redis_dict.clear()
@@ -11,6 +11,8 @@ __authors__ = ['"wuyadong" <wuyadong@tigerknows.com>']
 
 import logging
 
+from core.stream import BufferStream
+
 
 class ParserError(Exception):
     """Parser error
@@ -32,6 +34,17 @@ class BaseParser(object):
         """
         raise NotImplementedError
 
+    def create_stream(self, task):
+        """为流式下载的task创建接收body的stream
+            只有task.stream_need为True时才会调用，
+            可以增量处理输入的parser可以重写这个方法
+            Args:
+                task:HttpTask, 描述任务的对象
+            Returns:
+                stream: BaseStream, 接收body的stream
+        """
+        return BufferStream(task.max_body_size)
+
     def clear_all(self):
         """释放资源的操作
         """
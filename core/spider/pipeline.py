@@ -6,12 +6,15 @@
     PipelineError: 与pipeline有关的错误
     BasePipeline: 处理item的基类
     EmptyPipeline: 不做任何处理的pipeline
+    wait_all(): 等待多个Future全部完成
 """
 
 __authors__ = ['"wuyadong" <wuyadong@tigerknows.com>']
 
 import logging
 
+from tornado.concurrent import Future
+
 
 class PipelineError(Exception):
     """Pipeline error
@@ -20,7 +23,16 @@ class PipelineError(Exception):
 
 class BasePipeline(object):
     """处理item的基类
+        Attributes:
+            batch_size: int, 大于1时worker把item攒成批调用process_items，
+                个数达到batch_size或者最早的item等待超过max_linger时处理
+            max_linger: float, item在批中等待的最长时间，单位秒
+            thread_safe: bool, 是否可以在多个线程中同时调用，spider的所有pipeline都是线程安全的
+                才会在线程池中执行
     """
+    batch_size = 1
+    max_linger = 1.0
+    thread_safe = False
 
     def __init__(self, namespace):
         self.logger = logging.getLogger(self.__class__.__name__)
@@ -30,9 +42,33 @@ class BasePipeline(object):
             Args:
                 item: Item, 被处理的item对象
                 kwargs: dict, 额外需要的参数字典
+            Returns:
+                result: None, 或者异步处理时返回Future，失败时设置异常
         """
         raise NotImplementedError
 
+    def process_items(self, items):
+        """批量处理的方法，默认逐个调用process_item
+            需要批量写入redis或者数据库的pipeline覆盖这个方法
+            Args:
+                items: list, [(item, kwargs)]
+            Returns:
+                result: None, 或者异步处理时返回Future，失败时设置异常，整批都算失败
+        """
+        futures = []
+        for item, kwargs in items:
+            result = self.process_item(item, kwargs)
+            if isinstance(result, Future):
+                futures.append(result)
+        if futures:
+            return wait_all(futures)
+
+    def close(self):
+        """关闭的方法，写入缓存中的数据，释放连接
+            与clear_all不同，不清除与其它进程共享的数据，离线解析结束和子进程退出时调用
+        """
+        pass
+
     def clear_all(self):
         """资源释放的方法
         """
@@ -42,9 +78,32 @@ class BasePipeline(object):
 class EmptyPipeline(BasePipeline):
     """什么也不做的pipeline
     """
+    thread_safe = True
 
     def process_item(self, item, kwargs):
         pass
 
     def clear_all(self):
         pass
+
+
+def wait_all(futures):
+    """等待多个Future全部完成
+        Args:
+            futures: list, Future列表
+        Returns:
+            future: Future, 全部完成后设置，有失败时设置为第一个异常
+    """
+    result = Future()
+    pending = [len(futures)]
+
+    def done(future):
+        pending[0] -= 1
+        if future.exception() is not None and not result.done():
+            result.set_exception(future.exception())
+        elif pending[0] == 0 and not result.done():
+            result.set_result(None)
+
+    for future in futures:
+        future.add_done_callback(done)
+    return result
@@ -31,11 +31,16 @@ class BaseSpider(object):
             parsers: dict, 表示spider对应的所有解析组件
             pipelines: dict, 表示spider对应的所有处理组件
             spider_classes: dict, 表示所有的注册的spider class
+            pipeline_thread_number: int, 处理item的线程个数，0表示在IOLoop中同步处理，
+                大于0时所有pipeline必须声明thread_safe，否则仍然同步处理
+            pipeline_queue_size: int, 等待处理的item超过这个个数时暂停获取新的任务
     """
     start_tasks = []
     parsers = {}
     pipelines = {}
     spider_classes = {}
+    pipeline_thread_number = 0
+    pipeline_queue_size = 1000
 
     def __init__(self, crawl_schedule, namespace=None, **kwargs):
         """初始化spider
@@ -47,17 +52,9 @@ class BaseSpider(object):
         self._crawl_schedule = crawl_schedule
         self._is_cleared = False
         self._kwargs = kwargs
-        self._clone_parsers = {}
+        self._clone_parsers = self.create_parsers(self._namespace, kwargs)
         self._clone_pipelines = {}
 
-        for parser_name, parser_claz in self.parsers.iteritems():
-            parser_kwargs =  dict([(arg_name[len(parser_name) + 1:], arg_value)
-                              for arg_name, arg_value
-                              in kwargs.iteritems()
-                              if arg_name.startswith(parser_name + "_")])
-
-            self._clone_parsers[parser_name] = parser_claz(self._namespace, **parser_kwargs)
-
         for pipeline_name, pipeline_claz in self.pipelines.iteritems():
             pipeline_kwargs =  dict([(arg_name[len(pipeline_name) + 1:], arg_value)
                               for arg_name, arg_value
@@ -65,6 +62,26 @@ class BaseSpider(object):
                               if arg_name.startswith(pipeline_name + "_")])
             self._clone_pipelines[pipeline_name] = pipeline_claz(self._namespace, **pipeline_kwargs)
 
+    @classmethod
+    def create_parsers(cls, namespace, kwargs):
+        """创建spider对应的所有parser
+            不需要schedule和pipeline，离线解析时可以在子进程中单独创建
+            Args:
+                namespace: str, 名字空间
+                kwargs: dict, spider的参数，以parser名字加"_"开头的参数传给对应的parser
+            Returns:
+                parsers: dict, parser名字到parser实例的字典
+        """
+        parsers = {}
+        for parser_name, parser_claz in cls.parsers.iteritems():
+            parser_kwargs =  dict([(arg_name[len(parser_name) + 1:], arg_value)
+                              for arg_name, arg_value
+                              in kwargs.iteritems()
+                              if arg_name.startswith(parser_name + "_")])
+
+            parsers[parser_name] = parser_claz(namespace, **parser_kwargs)
+        return parsers
+
     @property
     def spider_kwargs(self):
         kwargs = self._kwargs
@@ -101,11 +118,27 @@ class BaseSpider(object):
             self.logger.error("has no callback:%s" % task.callback)
             raise Exception("parser error:%s, callback:%s" % ("not exists callback", task.callback))
 
+    def create_stream(self, task):
+        """为流式下载的task创建stream，交给callback对应的parser创建
+            Args:
+                task: HttpTask, 任务的描述
+            Returns:
+                stream: BaseStream
+            Raises:
+                error: SpiderError, 当callback不存在
+        """
+        if not self._clone_parsers.has_key(task.callback):
+            raise SpiderError("create stream error:%s, callback:%s" %
+                              ("not exists callback", task.callback))
+        return self._clone_parsers[task.callback].create_stream(task)
+
     def handle_item(self, item, kwargs):
         """处理item的函数
             Args:
                 item: Item, 表示解析出的结果
                 kwargs: dict, 表示额外带的参数字典
+            Returns:
+                result: pipeline的返回值，异步处理时是Future
             Raises:
                 error: PipelineError
         """
@@ -114,7 +147,7 @@ class BaseSpider(object):
 
         if self._clone_pipelines.has_key(item.__class__.__name__):
             try:
-                self._clone_pipelines[item.__class__.__name__].process_item(item, kwargs)
+                return self._clone_pipelines[item.__class__.__name__].process_item(item, kwargs)
             except Exception, e:
                 self.logger.error("process item error, %s" % e)
                 raise PipelineError("process item error:%s, item:%s" % (e, item))
@@ -122,6 +155,49 @@ class BaseSpider(object):
             self.logger.error("has not this pipeline:%s" % item.__class__.__name__)
             raise PipelineError("process item error:%s, item:%s" % ("not exists pipeline", item))
 
+    def get_pipeline(self, item_name):
+        """获取处理某一种item的pipeline
+            Args:
+                item_name: str, item的类名
+            Returns:
+                pipeline: BasePipeline, 不存在时返回None
+        """
+        return self._clone_pipelines.get(item_name)
+
+    def handle_items(self, item_name, items):
+        """批量处理同一种item
+            Args:
+                item_name: str, item的类名
+                items: list, [(item, kwargs)]
+            Returns:
+                result: pipeline的返回值，异步处理时是Future
+            Raises:
+                error: PipelineError
+        """
+        if self._is_cleared or not items:
+            return
+
+        if self._clone_pipelines.has_key(item_name):
+            try:
+                return self._clone_pipelines[item_name].process_items(items)
+            except Exception, e:
+                self.logger.error("process items error, %s" % e)
+                raise PipelineError("process items error:%s, item:%s, count:%s" %
+                                    (e, item_name, len(items)))
+        else:
+            self.logger.error("has not this pipeline:%s" % item_name)
+            raise PipelineError("process items error:%s, item:%s" % ("not exists pipeline", item_name))
+
+    def close_pipelines(self):
+        """关闭所有pipeline，写入缓存中的数据
+            不清除schedule和pipeline中与其它进程共享的数据
+        """
+        for _, pipeline in self._clone_pipelines.iteritems():
+            try:
+                pipeline.close()
+            except Exception, e:
+                self.logger.warn("close pipeline:%s error:%s" % (pipeline.__class__.__name__, e))
+
     def clear_all(self):
         """释放spider中的资源
         """
@@ -3,6 +3,7 @@
 
 
 """
+    Histogram: 按固定区间统计耗时分布的直方图
     WorkerStatistic: 用于记录worker的统计信息的类
     output_statistic_file(): 用于将统计信息输出到文件里
     output_statistic_dict(): 用于以json格式导出统计数据
@@ -19,6 +20,109 @@ WORKER_FAIL_PATH = "data/fails/"
 
 logger = logging.getLogger("statistic")
 
+# 直方图区间的上界，单位毫秒
+DEFAULT_HISTOGRAM_BOUNDS = (10, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000)
+
+# curl下载各个阶段的名字
+FETCH_PHASES = ("queue", "dns", "connect", "wait", "transfer", "total")
+
+
+class Histogram(object):
+    """按固定区间统计耗时分布的直方图
+    """
+
+    def __init__(self, bounds=DEFAULT_HISTOGRAM_BOUNDS):
+        """初始化
+            Args:
+                bounds: tuple, 升序的区间上界，单位毫秒，最后一个区间没有上界
+        """
+        self._bounds = bounds
+        self._counts = [0] * (len(bounds) + 1)
+        self._count = 0
+        self._sum = 0.0
+        self._max = 0.0
+
+    def add(self, value):
+        """增加一个值
+            Args:
+                value: float, 耗时，单位毫秒
+        """
+        index = len(self._bounds)
+        for bound_index, bound in enumerate(self._bounds):
+            if value <= bound:
+                index = bound_index
+                break
+        self._counts[index] += 1
+        self._count += 1
+        self._sum += value
+        self._max = max(self._max, value)
+
+    @property
+    def count(self):
+        return self._count
+
+    def merge(self, other):
+        """合并另一个区间相同的直方图
+            Args:
+                other: Histogram, 直方图
+        """
+        self._counts = [count + other_count for count, other_count
+                        in zip(self._counts, other._counts)]
+        self._count += other._count
+        self._sum += other._sum
+        self._max = max(self._max, other._max)
+
+    def to_dict(self):
+        """导出为字典
+            Returns:
+                histogram: dict, {'count', 'average', 'max', 'buckets': [(上界, 个数)]}
+        """
+        buckets = []
+        for index, count in enumerate(self._counts):
+            bound = "+inf" if index >= len(self._bounds) else self._bounds[index]
+            buckets.append((bound, count))
+        return {'count': self._count,
+                'average': 0 if self._count == 0 else self._sum / self._count,
+                'max': self._max,
+                'buckets': buckets}
+
+
+def split_fetch_phases(time_info):
+    """将curl的time_info转换为各个阶段的耗时
+        curl给出的时间是累计的，这里转换为每个阶段自身的耗时:
+        dns: 域名解析, connect: 建立连接, wait: 从连接建立到收到第一个字节,
+        transfer: 传输body, queue: 在client中排队, total: 总耗时
+        Args:
+            time_info: dict, resp.time_info, 单位秒
+        Returns:
+            phases: dict, 阶段名到耗时的字典，单位毫秒
+    """
+    namelookup = time_info.get('namelookup', 0)
+    connect = time_info.get('connect', 0)
+    starttransfer = time_info.get('starttransfer', 0)
+    total = time_info.get('total', 0)
+    return {"queue": time_info.get('queue', 0) * 1000,
+            "dns": namelookup * 1000,
+            "connect": max(connect - namelookup, 0) * 1000,
+            "wait": max(starttransfer - connect, 0) * 1000,
+            "transfer": max(total - starttransfer, 0) * 1000,
+            "total": total * 1000}
+
+
+def _merge_average(time2count, time2interval, other_time2count, other_time2interval):
+    """合并按时间段统计的平均耗时，同一时间段按个数加权
+    """
+    for start_time, count in other_time2count.iteritems():
+        interval = other_time2interval[start_time]
+        if time2count.has_key(start_time):
+            total_count = time2count[start_time] + count
+            time2interval[start_time] = (time2interval[start_time] * time2count[start_time]
+                                         + interval * count) / total_count
+            time2count[start_time] = total_count
+        else:
+            time2count[start_time] = count
+            time2interval[start_time] = interval
+
 
 class WorkerStatistic(object):
     """用于统计worker的信息的类
@@ -28,6 +132,11 @@ class WorkerStatistic(object):
         self._start_time = None
         self._end_time = None
         self._processing_number = 0
+        self._inflight_bytes = 0
+        self._peak_inflight_bytes = 0
+        self._memory_budget = None
+        self._memory_pause_count = 0
+        self._pipeline_pause_count = 0
         self._parser2success = {}
         self._parser2fail = {}
         self._parser2retry = {}
@@ -37,6 +146,9 @@ class WorkerStatistic(object):
         self._parser2extractinterval = {}
         self._parser2handlecount = {}
         self._parser2handleinterval = {}
+        self._parser2fetchphase = {}
+        self._host2fetchphase = {}
+        self._parser2slotwait = {}
 
     @property
     def processing_number(self):
@@ -52,6 +164,114 @@ class WorkerStatistic(object):
         """
         self._processing_number -= 1
 
+    @property
+    def inflight_bytes(self):
+        return self._inflight_bytes
+
+    @property
+    def peak_inflight_bytes(self):
+        return self._peak_inflight_bytes
+
+    @property
+    def memory_budget(self):
+        return self._memory_budget
+
+    @memory_budget.setter
+    def memory_budget(self, value):
+        self._memory_budget = value
+
+    @property
+    def memory_pause_count(self):
+        return self._memory_pause_count
+
+    def incre_inflight_bytes(self, count):
+        """增加正在处理的字节数(正在接收和解析的response body，以及还没有处理完成的item)
+            Args:
+                count: int, 字节数
+        """
+        self._inflight_bytes += count
+        self._peak_inflight_bytes = max(self._peak_inflight_bytes, self._inflight_bytes)
+
+    def decre_inflight_bytes(self, count):
+        """减少正在处理的字节数
+            Args:
+                count: int, 字节数
+        """
+        self._inflight_bytes -= count
+
+    def is_over_memory_budget(self):
+        """正在处理的字节数是否超过了内存预算
+            Returns:
+                is_over: bool, 没有预算时返回False
+        """
+        return self._memory_budget is not None and self._inflight_bytes >= self._memory_budget
+
+    def incre_memory_pause_count(self):
+        """增加因为超过内存预算暂停获取任务的次数
+        """
+        self._memory_pause_count += 1
+
+    @property
+    def pipeline_pause_count(self):
+        return self._pipeline_pause_count
+
+    def incre_pipeline_pause_count(self):
+        """增加因为pipeline队列已满暂停获取任务的次数
+        """
+        self._pipeline_pause_count += 1
+
+    def merge(self, other, is_live=True):
+        """合并另一个worker(多进程模式下的子进程)的统计信息
+            Args:
+                other: WorkerStatistic, 统计信息
+                is_live: bool, 对应的worker是否还在运行，已经退出的不合并正在处理的个数和字节数
+        """
+        if other.start_time is not None:
+            self._start_time = other.start_time if self._start_time is None \
+                else min(self._start_time, other.start_time)
+        if other.end_time is not None:
+            self._end_time = other.end_time if self._end_time is None \
+                else max(self._end_time, other.end_time)
+        if is_live:
+            self._processing_number += other.processing_number
+            self._inflight_bytes += other.inflight_bytes
+        self._peak_inflight_bytes = max(self._peak_inflight_bytes, other.peak_inflight_bytes)
+        self._memory_budget = other.memory_budget
+        self._memory_pause_count += other.memory_pause_count
+        self._pipeline_pause_count += other.pipeline_pause_count
+
+        for key, count in other.parser2success.iteritems():
+            self.add_spider_success(key, count)
+        for key2reason, other_key2reason in ((self._parser2fail, other.parser2fail),
+                                             (self._parser2retry, other.parser2retry)):
+            for key, reason2count in other_key2reason.iteritems():
+                merged_reason2count = key2reason.setdefault(key, {})
+                for reason, count in reason2count.iteritems():
+                    merged_reason2count[reason] = merged_reason2count.get(reason, 0) + count
+
+        for key2count, key2interval, other_key2count, other_key2interval in (
+                (self._parser2fetchcount, self._parser2fetchinterval,
+                 other._parser2fetchcount, other._parser2fetchinterval),
+                (self._parser2extractcount, self._parser2extractinterval,
+                 other._parser2extractcount, other._parser2extractinterval),
+                (self._parser2handlecount, self._parser2handleinterval,
+                 other._parser2handlecount, other._parser2handleinterval)):
+            for key, time2count in other_key2count.iteritems():
+                _merge_average(key2count.setdefault(key, {}), key2interval.setdefault(key, {}),
+                               time2count, other_key2interval[key])
+
+        for key2phase, other_key2phase in ((self._parser2fetchphase, other.parser2fetchphase),
+                                           (self._host2fetchphase, other.host2fetchphase)):
+            for key, phase2histogram in other_key2phase.iteritems():
+                if not key2phase.has_key(key):
+                    key2phase[key] = dict((phase, Histogram()) for phase in FETCH_PHASES)
+                for phase, histogram in phase2histogram.iteritems():
+                    key2phase[key][phase].merge(histogram)
+        for key, histogram in other.parser2slotwait.iteritems():
+            if not self._parser2slotwait.has_key(key):
+                self._parser2slotwait[key] = Histogram()
+            self._parser2slotwait[key].merge(histogram)
+
     @property
     def start_time(self):
         return self._start_time
@@ -68,13 +288,14 @@ class WorkerStatistic(object):
     def end_time(self, value):
         self._end_time = value
 
-    def add_spider_success(self, key_name):
+    def add_spider_success(self, key_name, count=1):
         """增加某一key的成功次数
             Args：
                 key_name: str, 对应的key
+                count: int, 增加的次数
         """
-        self._parser2success[key_name] = 1 if not self._parser2success.has_key(key_name) \
-            else self._parser2success[key_name] + 1
+        self._parser2success[key_name] = count if not self._parser2success.has_key(key_name) \
+            else self._parser2success[key_name] + count
 
     @property
     def parser2success(self):
@@ -177,6 +398,52 @@ class WorkerStatistic(object):
                 * time2count[latest_handle_time] + handle_interval) / (time2count[latest_handle_time] + 1)
             time2count[latest_handle_time] += 1
 
+    def count_fetch_phase(self, parser_name, host, time_info):
+        """统计一次下载在各个阶段的耗时，按callback和host分别记录
+            Args:
+                parser_name: str, callback name
+                host: str, 请求的host
+                time_info: dict, resp.time_info
+        """
+        phases = split_fetch_phases(time_info)
+        for key, key2phase in ((parser_name, self._parser2fetchphase),
+                               (host, self._host2fetchphase)):
+            if not key2phase.has_key(key):
+                key2phase[key] = dict((phase, Histogram()) for phase in FETCH_PHASES)
+            for phase, histogram in key2phase[key].iteritems():
+                histogram.add(phases[phase])
+
+    def count_slot_wait(self, parser_name, wait_time):
+        """统计等待请求名额的时间，与下载时间分开统计
+            Args:
+                parser_name: str, callback name
+                wait_time: float, 等待时间，单位毫秒
+        """
+        if not self._parser2slotwait.has_key(parser_name):
+            self._parser2slotwait[parser_name] = Histogram()
+        self._parser2slotwait[parser_name].add(wait_time)
+
+    @property
+    def parser2slotwait(self):
+        """
+        don't modify
+        """
+        return self._parser2slotwait
+
+    @property
+    def parser2fetchphase(self):
+        """
+        don't modify
+        """
+        return self._parser2fetchphase
+
+    @property
+    def host2fetchphase(self):
+        """
+        don't modify
+        """
+        return self._host2fetchphase
+
     def get_average_fetch_interval(self, parser_name=""):
         """
         don't modify
@@ -257,6 +524,33 @@ def output_statistic_file(file_path, work_statistic, worker_name, spider_name):
                 out_file.write("%s: %s\n" % (start_time, interval_dict.get(start_time)))
             out_file.write("\n")
         out_file.write("\n\n")
+
+        out_file.write("spider fetch phase:\n")
+        for title, key2phase in (("spider name", work_statistic.parser2fetchphase),
+                                 ("host", work_statistic.host2fetchphase)):
+            for key, phase2histogram in key2phase.iteritems():
+                out_file.write("%s: %s\n" % (title, key))
+                for phase in FETCH_PHASES:
+                    out_file.write("%s: %s\n" % (phase, phase2histogram[phase].to_dict()))
+                out_file.write("\n")
+        out_file.write("\n\n")
+
+        out_file.write("spider slot wait:\n")
+        for parser_name, histogram in work_statistic.parser2slotwait.iteritems():
+            out_file.write("spider name: %s\n" % parser_name)
+            out_file.write("wait: %s\n" % histogram.to_dict())
+            out_file.write("\n")
+        out_file.write("\n\n")
+
+        out_file.write("memory budget:\n")
+        out_file.write("budget: %s\n" % work_statistic.memory_budget)
+        out_file.write("peak inflight bytes: %s\n" % work_statistic.peak_inflight_bytes)
+        out_file.write("pause count: %s\n" % work_statistic.memory_pause_count)
+        out_file.write("\n\n")
+
+        out_file.write("pipeline queue:\n")
+        out_file.write("pause count: %s\n" % work_statistic.pipeline_pause_count)
+        out_file.write("\n\n")
         out_file.write("---------------------------------------------------------------------------------------\n")
 
 
@@ -270,6 +564,11 @@ def output_statistic_dict(worker_statistic):
     statistic_dict['retry_count'] = worker_statistic.parser2retry
     statistic_dict['fail_count'] = worker_statistic.parser2fail
     statistic_dict['processing_number'] = worker_statistic.processing_number
+    statistic_dict['memory'] = {"budget": worker_statistic.memory_budget,
+                                "inflight_bytes": worker_statistic.inflight_bytes,
+                                "peak_inflight_bytes": worker_statistic.peak_inflight_bytes,
+                                "pause_count": worker_statistic.memory_pause_count}
+    statistic_dict['pipeline'] = {"pause_count": worker_statistic.pipeline_pause_count}
 
     temp_fetch_interval_dict = {}
     for parser_name, value in worker_statistic.get_average_fetch_interval().items():
@@ -295,6 +594,18 @@ def output_statistic_dict(worker_statistic):
         temp_handle_interval_dict[item_name] = temp_dict
     statistic_dict['item_interval'] = temp_handle_interval_dict
 
+    temp_fetch_phase_dict = {}
+    for name, key2phase in (("parser", worker_statistic.parser2fetchphase),
+                            ("host", worker_statistic.host2fetchphase)):
+        temp_dict = {}
+        for key, phase2histogram in key2phase.items():
+            temp_dict[key] = dict((phase, histogram.to_dict())
+                                  for phase, histogram in phase2histogram.items())
+        temp_fetch_phase_dict[name] = temp_dict
+    statistic_dict['fetch_phase'] = temp_fetch_phase_dict
+    statistic_dict['slot_wait'] = dict((parser_name, histogram.to_dict()) for parser_name, histogram
+                                       in worker_statistic.parser2slotwait.items())
+
     return statistic_dict
 
 
@@ -0,0 +1,190 @@
+#!/usr/bin/python2.7
+#-*- coding=utf-8 -*-
+
+
+"""用于流式接收response body的组件
+    BodyTooLargeError: body超过最大长度时的错误
+    BaseStream: 流式接收的基类
+    BufferStream: 接收到内存中的stream
+    FileStream: 直接写入磁盘文件的stream
+"""
+
+__authors__ = ['"wuyadong" <wuyadong@tigerknows.com>']
+
+import os
+import cStringIO
+
+
+class BodyTooLargeError(Exception):
+    """response body超过了task允许的最大长度
+    """
+
+
+class BaseStream(object):
+    """流式接收response body的基类
+        作为HTTPRequest的streaming_callback使用，body分块到达时调用write
+    """
+
+    def __init__(self, max_body_size=None):
+        """初始化
+            Args:
+                max_body_size: int, 最大的body长度，None表示不限制
+        """
+        self._max_body_size = max_body_size
+        self._size = 0
+        self._is_overflowed = False
+        self.copy_size = 0  # 录制或者归档时另外复制在内存中的字节数
+
+    @property
+    def size(self):
+        return self._size
+
+    @property
+    def max_body_size(self):
+        return self._max_body_size
+
+    @property
+    def is_overflowed(self):
+        return self._is_overflowed
+
+    @property
+    def share_key(self):
+        """相同share_key的stream接收的结果可以共享，None表示不能共享
+        """
+        return None
+
+    @property
+    def memory_size(self):
+        """接收的数据占用的内存，写入磁盘的stream为0
+        """
+        return 0
+
+    def write(self, chunk):
+        """接收一个数据块
+            超过最大长度后，后面的数据块都会被丢弃
+            Args:
+                chunk: str, 数据块
+        """
+        if self._is_overflowed:
+            return
+        if self._max_body_size is not None and \
+                self._size + len(chunk) > self._max_body_size:
+            self._is_overflowed = True
+            return
+        self._size += len(chunk)
+        self._write(chunk)
+
+    def _write(self, chunk):
+        """实际写入数据块
+        """
+        raise NotImplementedError
+
+    def finish(self):
+        """body成功接收完成时调用
+        """
+        pass
+
+    def get_file(self):
+        """接收完成后，获取供parser读取的文件对象
+            Returns:
+                input_file: File, 文件对象
+            Raises:
+                BodyTooLargeError: 当body超过最大长度
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """释放资源
+        """
+        pass
+
+
+class BufferStream(BaseStream):
+    """将body接收到内存中的stream
+        与先拿到resp.body再包装成StringIO相比，少一次完整的拷贝
+    """
+
+    def __init__(self, max_body_size=None):
+        BaseStream.__init__(self, max_body_size)
+        self._buffer = cStringIO.StringIO()
+
+    @property
+    def memory_size(self):
+        return self._size
+
+    def _write(self, chunk):
+        self._buffer.write(chunk)
+
+    def get_file(self):
+        if self._is_overflowed:
+            raise BodyTooLargeError("body larger than %s" % self._max_body_size)
+        self._buffer.seek(0)
+        return self._buffer
+
+    def close(self):
+        self._buffer.close()
+
+
+class FileStream(BaseStream):
+    """将body直接写入磁盘的stream
+        先写入临时文件，完整接收后再重命名为目标文件
+    """
+
+    def __init__(self, path, max_body_size=None, suffix=".part"):
+        """初始化
+            Args:
+                path: str, 目标文件路径
+                max_body_size: int, 最大的body长度
+                suffix: str, 临时文件的后缀
+        """
+        BaseStream.__init__(self, max_body_size)
+        self._path = path
+        self._temp_path = path + suffix
+        self._out_file = None
+        self._in_file = None
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def share_key(self):
+        return self._path
+
+    def _write(self, chunk):
+        if self._out_file is None:
+            directory = os.path.dirname(self._temp_path)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            self._out_file = open(self._temp_path, "wb")
+        self._out_file.write(chunk)
+
+    def finish(self):
+        """完成写入，将临时文件重命名为目标文件
+        """
+        if self._out_file is not None and not self._is_overflowed:
+            self._out_file.close()
+            self._out_file = None
+            os.rename(self._temp_path, self._path)
+
+    def get_file(self):
+        """获取目标文件
+            Returns:
+                input_file: File, 以只读方式打开的目标文件
+        """
+        if self._is_overflowed:
+            raise BodyTooLargeError("body larger than %s" % self._max_body_size)
+        self._in_file = open(self._path, "rb")
+        return self._in_file
+
+    def close(self):
+        if self._out_file is not None:
+            self._out_file.close()
+            self._out_file = None
+            try:
+                os.remove(self._temp_path)
+            except OSError:
+                pass
+        if self._in_file is not None:
+            self._in_file.close()
+            self._in_file = None
@@ -248,6 +248,31 @@ def walk_settings(path='settings.registersettings'):
             else:
                 add_schedule_class(schedule_path, schedule)
 
+def estimate_size(obj, depth=3):
+    """粗略估计对象中字符串数据占用的字节数
+        只统计字符串、容器和对象属性中的字符串，用于内存预算
+        Args:
+            obj: object, 对象，通常是item或者task
+            depth: int, 最大递归深度
+        Returns:
+            size: int, 字节数
+    """
+    if isinstance(obj, str):
+        return len(obj)
+    elif isinstance(obj, unicode):
+        return len(obj) * 4
+    elif depth <= 0:
+        return 0
+    elif isinstance(obj, (list, tuple, set)):
+        return sum(estimate_size(value, depth - 1) for value in obj)
+    elif isinstance(obj, dict):
+        return sum(estimate_size(key, depth - 1) + estimate_size(value, depth - 1)
+                   for key, value in obj.iteritems())
+    elif hasattr(obj, "__dict__"):
+        return estimate_size(obj.__dict__, depth - 1)
+    return 0
+
+
 # lambda
 flist = lambda elems, default="": default if len(elems) <= 0 else elems[0]
 
@@ -17,23 +17,39 @@
 
 __authors__ = ['"wuyadong" <wuyadong@tigerknows.com>']
 
+import time
 import datetime
 import uuid
 import StringIO
+import urlparse
 import logging
+import functools
 from tornado import ioloop, gen
+from tornado.concurrent import Future
 
-from core.util import get_class_path, log_exception_wrap
+from core.util import get_class_path, log_exception_wrap, load_object, estimate_size
 from core.spider.parser import ParserError
 from core.schedule import ScheduleError
 from core.spider.pipeline import PipelineError
+from core.spider.executor import create_pipeline_executor
+from core.spider.batch import ItemBatcher
 from core.download import fetch
+from core.stream import BodyTooLargeError
+from core.breaker import BreakerManager, CircuitOpenError
+from core.robots import is_allowed_by_robots, RobotsDisallowedError, CrawlDelayError
+from core.archive import ArchiveReader
+from core.fetcher import FetcherSettings
 from core.datastruct import HttpTask, FileTask, Item
 from core.statistic import (WorkerStatistic, output_statistic_file, WORKER_STATISTIC_PATH,
                             output_fail_http_task_file, WORKER_FAIL_PATH)
 from core.record import record, RecorderManager
 
 MAX_EMPTY_TASK_COUNT = 10  # worker最大能够获取的空Task个数
+MIN_DEFER_SECONDS = 1  # 熔断或者等待Crawl-delay的task放回队列之前最少等待的时间，单位秒
+
+DEFAULT_WORKER_SETTINGS = "settings.workersettings"
+
+_archive_readers = {}  # 归档目录到ArchiveReader的字典
 
 
 class WorkerError(Exception):
@@ -66,9 +82,15 @@ class Worker(object):
         self.spider = spider
         self._worker_name = worker_name
         self.worker_statistic = WorkerStatistic()
+        self.worker_statistic.memory_budget = load_memory_budget()
+        self._slot_weight = FetcherSettings.instance().get_spider_weight(
+            spider.__class__.__name__)
         self.is_started = False
         self.is_suspended = False
         self._empty_task_count = 0
+        self._deferred_number = 0  # 等待放回队列的task个数
+        self._pipeline_executor = None
+        self._item_batcher = None
 
     def start(self):
         """启动这个worker
@@ -92,11 +114,7 @@ class Worker(object):
 
             _move_start_tasks_to_crawl_schedule(self.spider.start_tasks,
                                             self.spider.crawl_schedule)
-
-            ioloop.IOLoop.instance().add_timeout(
-                datetime.timedelta(milliseconds=self.spider.crawl_schedule.interval),
-                self.loop_get_and_execute)
-            self.logger.info("start worker")
+            self.run()
 
     def recover(self):
         """以恢复模式启动这个worker
@@ -113,10 +131,17 @@ class Worker(object):
                    get_class_path(self.spider.__class__), self.spider.spider_kwargs))
 
             self.is_started = True
-            ioloop.IOLoop.instance().add_timeout(
-                datetime.timedelta(milliseconds=self.spider.crawl_schedule.interval),
-                self.loop_get_and_execute)
-            self.logger.info("start worker")
+            self.run()
+
+    def run(self):
+        """开始循环获取任务并执行
+        """
+        self._pipeline_executor = create_pipeline_executor(self.spider)
+        self._item_batcher = ItemBatcher(self.handle_batch)
+        ioloop.IOLoop.instance().add_timeout(
+            datetime.timedelta(milliseconds=self.spider.crawl_schedule.interval),
+            self.loop_get_and_execute)
+        self.logger.info("start worker")
 
     def stop(self):
         """关闭这个worker，并保存统计信息, store fail task
@@ -127,6 +152,9 @@ class Worker(object):
             self.logger.warn("duplicate stop")
         else:
             self.is_started = False
+            self.close_item_batcher()
+            self.close_pipeline_executor()
+            # 归档写入者由进程中的所有worker共享，在写入线程中继续写完，进程退出时关闭
             self.worker_statistic.end_time = datetime.datetime.now()
             fail_task_file_name = self.spider.__class__.__name__ + "-" + \
                 self.worker_statistic.start_time.strftime("%Y-%m-%d %H:%M:%S")
@@ -159,6 +187,9 @@ class Worker(object):
                 self.logger.warn("duplicate suspend")
             else:
                 self.is_suspended = True
+                # 暂停时不再有新的item，等待中的批直接处理
+                if self._item_batcher is not None:
+                    self._item_batcher.flush()
                 self.logger.info("suspend worker")
         else:
             self.logger.warn("stopped worker not permit to suspend")
@@ -191,7 +222,10 @@ class Worker(object):
         try:
             input_file = None
             try:
-                input_file = open(task.file_path, "rb")
+                if task.archive_url is None:
+                    input_file = open(task.file_path, "rb")
+                else:
+                    input_file = open_archive_file(task.file_path, task.archive_url)
             except Exception, e:
                 self.logger.error("open file： %s failed" % e)
                 task.reason = "open file failed"
@@ -222,20 +256,71 @@ class Worker(object):
             raise gen.Return
 
         self.worker_statistic.incre_processing_number()
+        stream = None
+        # body从开始接收到解析完成一直占用内存，知道Content-Length时一开始就按它计入，
+        # 流式接收时按stream实际占用的内存计入，下载结束后不再接受进度回调
+        body = {"bytes": 0, "is_fetched": False}
+
+        def count_body_bytes(size):
+            if size > body["bytes"]:
+                self.worker_statistic.incre_inflight_bytes(size - body["bytes"])
+                body["bytes"] = size
+
+        def count_progress(download_total, downloaded):
+            if not body["is_fetched"]:
+                count_body_bytes(max(download_total, downloaded) if stream is None
+                                 else stream.memory_size + stream.copy_size)
         try:
+            if task.stream_need:
+                stream = self.spider.create_stream(task)
+            # 同一进程中的worker共享client，下载时按权重申请名额，
+            # 等待名额的时间单独统计，下载时间不包含发出请求之前的排队时间
+            # dns解析会把url中的host替换为ip，统计和熔断都使用下载之前的host
+            host = urlparse.urlsplit(task.request.url).netloc
             fetch_start_time = datetime.datetime.now()
-            resp = yield fetch(task)
-            fetch_time = datetime.datetime.now() - fetch_start_time
-            self.worker_statistic.count_average_fetch_time(
-                task.callback, fetch_start_time,fetch_time)
-            if isinstance(resp, Exception):
+            resp = yield fetch(task, stream, self._worker_name, self._slot_weight,
+                               count_progress)
+            body["is_fetched"] = True
+            if not isinstance(resp, Exception):
+                # 没有发出请求的结果不计入下载时间
+                if getattr(resp, "slot_wait", None) is not None:
+                    self.worker_statistic.count_slot_wait(task.callback, resp.slot_wait * 1000)
+                fetch_time = max(datetime.datetime.now() - fetch_start_time -
+                                 datetime.timedelta(seconds=getattr(resp, "queue_time", 0)),
+                                 datetime.timedelta(0))
+                self.worker_statistic.count_average_fetch_time(
+                    task.callback, fetch_start_time,fetch_time)
+                if getattr(resp, "time_info", None):
+                    self.worker_statistic.count_fetch_phase(task.callback, host, resp.time_info)
+            if isinstance(resp, CircuitOpenError):
+                # host熔断，不计入失败次数，等到熔断器进入half-open再放回队列
+                self.logger.debug("defer task:%s, url:%s" % (resp, task.request.url))
+                self.worker_statistic.add_spider_retry("fetch-" + task.callback, "circuit open")
+                retry_after = BreakerManager.instance().get_retry_after(host)
+                self.defer_task(task, max(retry_after, MIN_DEFER_SECONDS))
+            elif isinstance(resp, CrawlDelayError):
+                # host的Crawl-delay已经排满，等到可以预约时再放回队列
+                self.logger.debug("defer task:%s, url:%s" % (resp, task.request.url))
+                self.worker_statistic.add_spider_retry("fetch-" + task.callback, "crawl delay")
+                self.defer_task(task, max(resp.retry_after, MIN_DEFER_SECONDS))
+            elif isinstance(resp, RobotsDisallowedError):
+                # robots.txt禁止的url直接丢弃，不重试
+                self.logger.debug("drop task:%s" % resp)
+                self.worker_statistic.add_spider_fail("robots-" + task.callback, "disallowed")
+            elif isinstance(resp, Exception):
                 self.logger.error("down loader error:%s, url:%s" % (resp, task.request.url))
             else:
+                # 解压后的body可能比接收的字节数大，共享结果和回放缓存时没有进度回调
+                count_body_bytes(len(resp.body or "") if stream is None
+                                 else stream.memory_size + stream.copy_size)
                 if resp.code == 200 and resp.error is None:
                     self.logger.debug("fetch success")
                     self.worker_statistic.add_spider_success(task.callback + "-fetch")
                     self.spider.crawl_schedule.flag_url_haven_done(task.request.url)
-                    self.extract(task, StringIO.StringIO(resp.body))
+                    if stream is None:
+                        self.extract(task, StringIO.StringIO(resp.body))
+                    else:
+                        self.extract_stream(task, stream)
                 else:
                     self.logger.error("fetch request failed, code:%s error:%s url:%s" %
                                     (resp.code, resp.error, task.request.url))
@@ -245,8 +330,50 @@ class Worker(object):
             self.logger.error("fetch and extract error:%s" % e)
             raise e
         finally:
+            body["is_fetched"] = True
+            if stream is not None:
+                stream.close()
+            self.worker_statistic.decre_inflight_bytes(body["bytes"])
             self.worker_statistic.decre_processing_number()
 
+    def defer_task(self, task, delay):
+        """等待一段时间后把task放回队列
+            Args:
+                task: HttpTask, 任务
+                delay: float, 等待的秒数
+        """
+        self._deferred_number += 1
+        ioloop.IOLoop.instance().add_timeout(time.time() + delay,
+                                             functools.partial(self._push_deferred_task, task))
+
+    def _push_deferred_task(self, task):
+        self._deferred_number -= 1
+        if not self.is_started:
+            return
+        try:
+            self.spider.crawl_schedule.push_new_task(task)
+        except ScheduleError, e:
+            self.logger.warn("push deferred task error:%s" % e)
+
+    def extract_stream(self, task, stream):
+        """解析流式接收的数据
+            Args:
+                task: HttpTask, 任务的描述
+                stream: BaseStream, 已经接收完成的stream
+        """
+        try:
+            input_file = stream.get_file()
+        except BodyTooLargeError, e:
+            # 每次下载的body都会超过限制，直接算作失败，不重试
+            self.logger.error("stream error:%s, url:%s" % (e, task.request.url))
+            self.worker_statistic.add_spider_fail("fetch-" + task.callback, "body too large")
+        except Exception, e:
+            self.logger.error("stream error:%s, url:%s" % (e, task.request.url))
+            task.reason = "stream error"
+            self.handle_fail_task(task, "fetch-" + task.callback)
+        else:
+            self.extract(task, input_file)
+
     def extract(self, task, string_file):
         """解析数据
             同步技术
@@ -274,24 +401,52 @@ class Worker(object):
                     for item_or_task in hrefs:
                         # 处理new_task
                         if isinstance(item_or_task, HttpTask) or isinstance(item_or_task, FileTask):
+                            if not is_allowed_by_robots(item_or_task):
+                                self.worker_statistic.add_spider_fail(
+                                    "robots-" + item_or_task.callback, "disallowed")
+                                continue
                             try:
                                 self.spider.crawl_schedule.push_new_task(item_or_task)
                             except ScheduleError, e:
                                 self.logger.warn("push new task error:%s" % e)
                             # 处理item
                         if isinstance(item_or_task, Item):
+                            # item从解析出来到pipeline处理完成一直占用内存，
+                            # parser是生成器时逐个计入
+                            item_bytes = estimate_size(item_or_task)
+                            self.worker_statistic.incre_inflight_bytes(item_bytes)
+                            pipeline = self.spider.get_pipeline(item_or_task.__class__.__name__)
+                            if self._item_batcher is not None and pipeline is not None \
+                                    and pipeline.batch_size > 1:
+                                self._item_batcher.add(task, item_or_task, pipeline.batch_size,
+                                                       pipeline.max_linger, item_bytes)
+                                continue
                             handle_start_time = datetime.datetime.now()
+                            is_async = False
                             try:
-                                self.spider.handle_item(item_or_task, task.kwargs)
+                                if self._pipeline_executor is not None:
+                                    result = self._pipeline_executor.submit(item_or_task,
+                                                                            task.kwargs)
+                                else:
+                                    result = self.spider.handle_item(item_or_task, task.kwargs)
                             except PipelineError, e:
                                 self.logger.error("handle error:%s" % e)
                                 task.reason = "handle error"
                                 self.handle_fail_task(task,
                                       "handle-" + item_or_task.__class__.__name__,)
                             else:
-                                self.worker_statistic.add_spider_success(
+                                if isinstance(result, Future):
+                                    # 异步处理的pipeline，完成后再统计和释放内存
+                                    is_async = True
+                                    result.add_done_callback(functools.partial(
+                                        self.handle_item_done, task,
+                                        item_or_task.__class__.__name__, item_bytes))
+                                else:
+                                    self.worker_statistic.add_spider_success(
                                         "%s-%s" % (item_or_task.__class__.__name__, "handle"))
                             finally:
+                                if not is_async:
+                                    self.worker_statistic.decre_inflight_bytes(item_bytes)
                                 handle_interval = datetime.datetime.now() - handle_start_time
                                 self.worker_statistic.count_average_handle_item_time(
                                     item_or_task.__class__.__name__, handle_start_time, handle_interval)
@@ -317,7 +472,19 @@ class Worker(object):
             异步技术
         """
         if self.is_started:
-            if not self.is_suspended and self.worker_statistic.processing_number \
+            if self.worker_statistic.is_over_memory_budget():
+                # 正在处理的数据超过内存预算，等待已有的任务完成
+                self.worker_statistic.incre_memory_pause_count()
+                ioloop.IOLoop.instance().add_timeout(
+                    datetime.timedelta(milliseconds=self.spider.crawl_schedule.interval * 2),
+                    self.loop_get_and_execute)
+            elif self._pipeline_executor is not None and self._pipeline_executor.is_full():
+                # 等待处理的item太多，等待pipeline线程处理
+                self.worker_statistic.incre_pipeline_pause_count()
+                ioloop.IOLoop.instance().add_timeout(
+                    datetime.timedelta(milliseconds=self.spider.crawl_schedule.interval * 2),
+                    self.loop_get_and_execute)
+            elif not self.is_suspended and self.worker_statistic.processing_number \
                     < self.spider.crawl_schedule.max_number:
                 # 获取新的任务
                 try:
@@ -339,6 +506,8 @@ class Worker(object):
                             datetime.timedelta(milliseconds=self.spider.crawl_schedule.interval),
                             self.loop_get_and_execute)
 
+                        if self._empty_task_count > MAX_EMPTY_TASK_COUNT:
+                            self.handle_busy()
                         self._empty_task_count = 0
 
                         if isinstance(task, HttpTask):
@@ -349,10 +518,11 @@ class Worker(object):
                             yield self.load_and_extract(task)
                     # 任务如果是空
                     else:
-                        if self.worker_statistic.processing_number <= 0:
+                        if self.worker_statistic.processing_number <= 0 and \
+                                self._deferred_number <= 0:
                             self._empty_task_count += 1
                         if self._empty_task_count > MAX_EMPTY_TASK_COUNT:
-                            self.stop()
+                            self.handle_idle()
                         self.logger.debug("empty request")
                         ioloop.IOLoop.instance().add_timeout(
                             datetime.timedelta(milliseconds=
@@ -363,6 +533,111 @@ class Worker(object):
                     datetime.timedelta(milliseconds=self.spider.crawl_schedule.interval * 2),
                     self.loop_get_and_execute)
 
+    def handle_idle(self):
+        """连续获取到空的task，并且没有正在处理的task时调用
+            单进程的worker直接停止
+        """
+        self.stop()
+
+    def handle_busy(self):
+        """空闲之后重新获取到task时调用
+        """
+        pass
+
+    def handle_batch(self, item_name, batch, batch_bytes=0):
+        """批量处理同一种item，ItemBatcher的回调
+            Args:
+                item_name: str, item的类名
+                batch: list, [(task, item)]
+                batch_bytes: int, 这批item计入内存预算的字节数，处理完成后释放
+        """
+        handle_start_time = datetime.datetime.now()
+        items = [(item, task.kwargs) for task, item in batch]
+        is_async = False
+        try:
+            if self._pipeline_executor is not None:
+                result = self._pipeline_executor.submit_items(item_name, items)
+            else:
+                result = self.spider.handle_items(item_name, items)
+        except PipelineError, e:
+            self.logger.error("handle error:%s" % e)
+            self._handle_batch_fail(item_name, batch)
+        else:
+            if isinstance(result, Future):
+                is_async = True
+                result.add_done_callback(functools.partial(self.handle_batch_done,
+                                                           item_name, batch, batch_bytes))
+            else:
+                self.worker_statistic.add_spider_success("%s-%s" % (item_name, "handle"),
+                                                         len(batch))
+        finally:
+            if not is_async:
+                self.worker_statistic.decre_inflight_bytes(batch_bytes)
+            handle_interval = datetime.datetime.now() - handle_start_time
+            self.worker_statistic.count_average_handle_item_time(
+                item_name, handle_start_time, handle_interval)
+
+    def handle_batch_done(self, item_name, batch, batch_bytes, future):
+        """异步处理的批完成后的回调
+            Args:
+                item_name: str, item的类名
+                batch: list, [(task, item)]
+                batch_bytes: int, 这批item计入内存预算的字节数
+                future: Future, pipeline返回的Future
+        """
+        self.worker_statistic.decre_inflight_bytes(batch_bytes)
+        if future.exception() is not None:
+            self.logger.error("handle error:%s" % future.exception())
+            self._handle_batch_fail(item_name, batch)
+        else:
+            self.worker_statistic.add_spider_success("%s-%s" % (item_name, "handle"), len(batch))
+
+    def _handle_batch_fail(self, item_name, batch):
+        """整批失败时，每个task只处理一次
+        """
+        tasks = {}
+        for task, _ in batch:
+            tasks[id(task)] = task
+        for task in tasks.itervalues():
+            task.reason = "handle error"
+            self.handle_fail_task(task, "handle-" + item_name)
+
+    def close_item_batcher(self):
+        """处理所有等待中的批，停止定时检查
+        """
+        if self._item_batcher is not None:
+            try:
+                self._item_batcher.close()
+            except Exception, e:
+                self.logger.warn("close item batcher error:%s" % e)
+            self._item_batcher = None
+
+    def close_pipeline_executor(self):
+        """等待pipeline线程处理完队列中的item，结束线程
+        """
+        if self._pipeline_executor is not None:
+            try:
+                self._pipeline_executor.close()
+            except Exception, e:
+                self.logger.warn("close pipeline executor error:%s" % e)
+            self._pipeline_executor = None
+
+    def handle_item_done(self, task, item_name, item_bytes, future):
+        """异步处理的item完成后的回调
+            Args:
+                task: HttpTask or FileTask, 解析出item的task
+                item_name: str, item的类名
+                item_bytes: int, item计入内存预算的字节数
+                future: Future, pipeline返回的Future
+        """
+        self.worker_statistic.decre_inflight_bytes(item_bytes)
+        if future.exception() is not None:
+            self.logger.error("handle error:%s" % future.exception())
+            task.reason = "handle error"
+            self.handle_fail_task(task, "handle-" + item_name)
+        else:
+            self.worker_statistic.add_spider_success("%s-%s" % (item_name, "handle"))
+
     def handle_fail_task(self, task, key):
         """handle fail task
 
@@ -371,12 +646,7 @@ class Worker(object):
                 key: str, key words
         """
 
-        ## 如果task需要代理，失败了就不要用代理了
-        #try:
-        #    if task.proxy_need:
-        #        # do nothing
-        #except Exception, e:
-        #    self.logger.error("flag proxy failed error:%s" % e)
+        # 代理的失败已经在download中汇报给了代理池，重试时会重新选择代理
         try:
             is_failed = self.spider.crawl_schedule.handle_error_task(task)
             if is_failed:
@@ -387,6 +657,34 @@ class Worker(object):
             self.logger.error("handle fail task error:%s" % e)
 
 
+def open_archive_file(archive_path, url):
+    """从归档中读取url对应的body
+        Args:
+            archive_path: str, 归档目录
+            url: str, url
+        Returns:
+            input_file: StringIO, body
+        Raises:
+            ArchiveError: 读取失败
+    """
+    if not _archive_readers.has_key(archive_path):
+        _archive_readers[archive_path] = ArchiveReader(archive_path)
+    _, _, _, body, _, _ = _archive_readers[archive_path].read(url)
+    return StringIO.StringIO(body)
+
+
+def load_memory_budget():
+    """从settings.workersettings加载worker的内存预算
+        Returns:
+            budget: int, 字节数，None表示不限制
+    """
+    try:
+        return load_object(DEFAULT_WORKER_SETTINGS + ".max_inflight_bytes")
+    except Exception, e:
+        logging.getLogger(__name__).warn("load worker settings failed error:%s" % e)
+        return None
+
+
 def _move_start_tasks_to_crawl_schedule(start_tasks, crawl_schedule):
     """将种子任务转移到crawl_schedule中的待抓取队列
         Args:
@@ -394,7 +692,8 @@ def _move_start_tasks_to_crawl_schedule(start_tasks, crawl_schedule):
             crawl_schedule: CrawlSchedule的实例
     """
     for task in start_tasks:
-        crawl_schedule.push_new_task(task)
+        if is_allowed_by_robots(task):
+            crawl_schedule.push_new_task(task)
 
 
 def recover_worker(spider):
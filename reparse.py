@@ -0,0 +1,54 @@
+#!/usr/bin/python2.7
+#-*- coding=utf-8 -*-
+
+
+"""离线批量重新解析的入口程序
+    python reparse.py --spider_path=spiders.com228.spider.Com228Spider
+        --callback=ActivityParser --source=data/archive/ --processes=8
+    归档中的页面使用下载时的parser，callback只用于目录中的文件和没有记录callback的归档记录，
+    结束时只关闭pipeline，不清除schedule和与正在运行的抓取共享的数据
+"""
+
+__author__ = ['"wuyadong" <wuyadong@tigerknows.com>']
+
+import sys
+import json
+import logging.config
+from tornado.options import define, parse_command_line, options
+
+from core.util import walk_settings, unicode2str_for_dict
+from core.spider.spider import get_spider_class
+from core.schedule import get_schedule_class
+from core.reparse import reparse
+from core.statistic import output_statistic_file, WORKER_STATISTIC_PATH
+
+logging.config.fileConfig(sys.path[0] + "/logging.conf")
+logger = logging.getLogger("reparse")
+
+define('spider_path', default=None, type=str, help="spider class path")
+define('schedule_path', default='schedules.schedules.RedisSchedule', type=str,
+       help="schedule class path")
+define('spider_kwargs', default='{}', type=str, help="spider kwargs, json")
+define('schedule_kwargs', default='{}', type=str, help="schedule kwargs, json")
+define('source', default=None, type=str, help="directory of pages or archive")
+define('callback', default=None, type=str,
+       help="default parser name, for files and archive records without callback")
+define('processes', default=None, type=int, help="process number, default cpu count")
+
+
+if __name__ == "__main__":
+    parse_command_line()
+    walk_settings()
+
+    schedule = get_schedule_class(options.schedule_path)(
+        **unicode2str_for_dict(json.loads(options.schedule_kwargs)))
+    spider = get_spider_class(options.spider_path)(
+        schedule, **unicode2str_for_dict(json.loads(options.spider_kwargs)))
+    try:
+        statistic = reparse(spider, options.source, options.callback, options.processes)
+        output_statistic_file(WORKER_STATISTIC_PATH, statistic, "reparse",
+                              spider.__class__.__name__)
+        logger.info("reparse success:%s" % statistic.parser2success)
+        logger.info("reparse fail:%s" % statistic.parser2fail)
+    finally:
+        spider.close_pipelines()
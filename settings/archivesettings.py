@@ -0,0 +1,15 @@
+#!/usr/bin/python2.7
+#-*- coding=utf-8 -*-
+
+"""
+response归档的配置，归档后的页面可以通过FileTask重新解析
+"""
+
+__author__ = ['"wuyadong" <wuyadong@tigerknows.com>']
+
+
+# 归档目录，相对于项目路径，None表示不归档
+path = None
+
+# segment文件的最大长度
+segment_size = 256 * 1024 * 1024
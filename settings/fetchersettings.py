@@ -0,0 +1,36 @@
+#!/usr/bin/python2.7
+#-*- coding=utf-8 -*-
+
+"""
+下载器(CurlAsyncHTTPClient)的配置
+"""
+
+__author__ = ['"wuyadong" <wuyadong@tigerknows.com>']
+
+
+# client同时处理的最大请求数
+max_clients = 50
+
+# 每个host同时处理的最大请求数，超过的请求在本地排队，None表示不限制,
+# 设置时不要小于schedule中的并发数(max_number)，否则多出的task只是在本地排队
+max_host_connections = None
+
+# 单独设置某些host的最大请求数, 如{"www.228.com.cn": 20}
+host_connections = {
+}
+
+# TCP keep-alive, 单位秒
+tcp_keepalive = True
+tcp_keepidle = 60
+tcp_keepintvl = 30
+
+# 同一个进程中所有请求共享的连接缓存的最大连接数(multi handle的M_MAXCONNECTS)
+max_connects = 50
+
+# curl的dns缓存时间，单位秒
+dns_cache_timeout = 600
+
+# 同一个进程中的worker按spider的权重分配max_clients个请求名额，默认权重为1,
+# 如{"Com228Spider": 2}
+spider_weights = {
+}
@@ -0,0 +1,17 @@
+#!/usr/bin/python2.7
+#-*- coding=utf-8 -*-
+
+"""
+http缓存的配置，用于离线开发和性能测试
+"""
+
+__author__ = ['"wuyadong" <wuyadong@tigerknows.com>']
+
+
+# None: 不使用缓存
+# "record": 正常下载，并把结果写入缓存
+# "replay": 只从缓存中读取结果，不访问网络，缓存中没有的请求返回599
+mode = None
+
+# 缓存目录，相对于项目路径
+path = "data/httpcache/"
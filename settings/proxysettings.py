@@ -0,0 +1,23 @@
+#!/usr/bin/python2.7
+#-*- coding=utf-8 -*-
+
+"""
+代理池的配置，HttpTask的proxy_need为True时使用
+"""
+
+__author__ = ['"wuyadong" <wuyadong@tigerknows.com>']
+
+
+# 代理列表, 格式为host:port或者user:password@host:port
+# contribute/proxyserver 启动后也可以作为其中一个代理, 如"127.0.0.1:2345"
+proxies = [
+]
+
+# 从redis的集合中加载代理，集合中的每个元素格式与proxies相同，key为None时不加载
+redis_key = None
+redis_host = "localhost"
+redis_port = 6379
+redis_db = 0
+
+# 被隔离的代理多少秒以后重新启用
+quarantine_seconds = 300
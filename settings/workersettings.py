@@ -0,0 +1,14 @@
+#!/usr/bin/python2.7
+#-*- coding=utf-8 -*-
+
+"""
+worker的配置
+"""
+
+__author__ = ['"wuyadong" <wuyadong@tigerknows.com>']
+
+
+# 每个worker正在处理的数据(从开始接收到解析完成的response body，
+# 以及攒批、排队和异步处理中还没有完成的item)的内存预算，单位字节，
+# 超过后暂停获取新的任务，None表示不限制
+max_inflight_bytes = 256 * 1024 * 1024
@@ -40,7 +40,7 @@ class PictureItem(Item):
     def __init__(self, picture, path):
         """初始化函数
             Args:
-                picture: 二进制，图片内容
+                picture: 二进制，图片内容，如果图片已经写入path则为None
                 path: str, 图片路径
         """
         self.picture = picture
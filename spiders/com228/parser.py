@@ -12,6 +12,7 @@ from tornado.httpclient import HTTPRequest
 from core.util import flist
 from core.datastruct import HttpTask
 from core.spider.parser import BaseParser
+from core.stream import FileStream
 from spiders.com228.items import ActivityItem, WebItem, PictureItem
 from spiders.com228.util import create_product_url, create_city_type_task
 
@@ -19,6 +20,8 @@ from spiders.com228.util import create_product_url, create_city_type_task
 DEFAULT_PICTURE_DIR = u"/home/wuyadong/swift_crawler/"
 DEFAULT_PICTURE_HOST = u"fruit-pictures/"
 COM228_HOST = u"http://www.228.com.cn"
+MAX_PICTURE_SIZE = 5 * 1024 * 1024
+ACTIVITY_HEDGE_PERCENTILE = 95
 
 
 class DealParser(BaseParser):
@@ -64,6 +67,8 @@ class DealParser(BaseParser):
                     request = HTTPRequest(url, connect_timeout=10, request_timeout=15)
                     task = HttpTask(request, callback="ActivityParser",
                                     cookie_host=cookie_host, cookie_count=cookie_count,
+                                    hedge_percentile=ACTIVITY_HEDGE_PERCENTILE,
+                                    adaptive_timeout=True,
                                     max_fail_count=3, kwargs={"url": url, "cookie_host": cookie_host,
                                                               "cookie_count": cookie_count})
                     yield task
@@ -189,7 +194,9 @@ class ActivityParser(BaseParser):
                                           request_timeout=60)
             picture_task = HttpTask(picture_request, callback='PictureParser',
                                     cookie_host=cookie_host, cookie_count=cookie_count,
-                                    max_fail_count=2,
+                                    max_fail_count=2, stream_need=True,
+                                    adaptive_timeout=True,
+                                    max_body_size=MAX_PICTURE_SIZE,
                                     kwargs={'picturepath': self._picture_dir + picture_path})
             return picture_path, picture_task
         else:
@@ -217,6 +224,18 @@ class PictureParser(BaseParser):
         BaseParser.__init__(self, namespace)
         self.logger.info("init PictureParser finished")
 
+    def create_stream(self, task):
+        """图片直接写入磁盘，不经过内存
+            Args:
+                task: HttpTask, 任务
+            Returns:
+                stream: BaseStream
+        """
+        if 'picturepath' in task.kwargs:
+            return FileStream(task.kwargs.get('picturepath'), task.max_body_size)
+        else:
+            return BaseParser.create_stream(self, task)
+
     def parse(self, task, input_file):
         """解析函数
             Args:
@@ -224,5 +243,9 @@ class PictureParser(BaseParser):
                 input_file: StringIO, 网页文件
         """
         if 'picturepath' in task.kwargs:
-            picture_item = PictureItem(input_file.read(), task.kwargs.get('picturepath'))
+            if task.stream_need:
+                # 下载时已经写入磁盘
+                picture_item = PictureItem(None, task.kwargs.get('picturepath'))
+            else:
+                picture_item = PictureItem(input_file.read(), task.kwargs.get('picturepath'))
             yield picture_item
\ No newline at end of file
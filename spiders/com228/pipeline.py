@@ -6,22 +6,39 @@ __author__ = ['"wuyadong" <wuyadong@tigerknows.com>']
 import os
 import json
 import datetime
-from core.redistools import RedisDict, RedisError
-from core.db import DB, DBError
-from core.spider.pipeline import BasePipeline
+import functools
+from core.redistools import RedisError
+from core.db import AsyncDB, DBError, BatchUpserter, KnownKeyIndex, digest_sql
+from core.spider.pipeline import BasePipeline, wait_all
+from core.spider.join import (JoinBuffer, DEFAULT_JOIN_MAX_BYTES, DEFAULT_JOIN_TTL,
+                              DEFAULT_JOIN_REDIS_TTL, DEFAULT_JOIN_MAX_REDIS_COUNT)
 from spiders.com228.items import PictureItem, ActivityItem, WebItem
 
+# rt_crawl中写入的列，url和source相同的行已经存在时，只更新STORE_UPDATE_COLUMNS
+STORE_COLUMNS = ("city_code", "type", "start_time", "end_time", "info", "url", "source",
+                 "update_time", "add_time")
+STORE_KEY_COLUMNS = ("url", "source")
+STORE_UPDATE_COLUMNS = ("city_code", "type", "start_time", "end_time", "info", "update_time")
+# 这些列都没有变化时不再写入，info必须是json或text类型，jsonb会重新格式化，摘要不一致
+STORE_DIGEST_COLUMNS = tuple(column for column in STORE_UPDATE_COLUMNS if column != "update_time")
+
 
 class ActivityItemPipeline(BasePipeline):
     """用于处理ActivityItem的pipeline
     """
-    def __init__(self, namesapce, redis_host='192.168.11.108', redis_port=6379, redis_db=0):
+    def __init__(self, namesapce, redis_host='192.168.11.108', redis_port=6379, redis_db=0,
+                 join_max_bytes=DEFAULT_JOIN_MAX_BYTES, join_ttl=DEFAULT_JOIN_TTL,
+                 join_redis_ttl=DEFAULT_JOIN_REDIS_TTL,
+                 join_max_redis_count=DEFAULT_JOIN_MAX_REDIS_COUNT):
         BasePipeline.__init__(self, namesapce)
         self.logger.info("init activity item pipline finished")
         try:
             redis_namespace = "%s:%s" % (namesapce, "temp")
-            self.temp_item_dict = RedisDict(redis_namespace, host=redis_host,
-                                            port=redis_port, db=redis_db)
+            # 与WebItemPipeline共享，本地放不下或者等待太久的才写入redis
+            self._join_buffer = JoinBuffer.get_buffer(redis_namespace, int(join_max_bytes),
+                                                      float(join_ttl), int(join_redis_ttl),
+                                                      int(join_max_redis_count), host=redis_host,
+                                                      port=redis_port, db=redis_db)
         except RedisError, e:
             self.logger.error("redis error %s" % e)
             raise e
@@ -33,7 +50,15 @@ class ActivityItemPipeline(BasePipeline):
                 kwargs: dict, 参数字典
         """
         if isinstance(item, ActivityItem):
-            self.temp_item_dict.set(item.url, item)
+            self._join_buffer.put(item.url, item)
+
+    def close(self):
+        """把关联缓存中本地的数据写入redis，对应的WebItem可能在其它进程中
+        """
+        try:
+            self._join_buffer.spill_all()
+        except Exception, ignore:
+            self.logger.warn("spill join buffer failed:%s" % ignore)
 
     def clear_all(self):
         pass
@@ -41,15 +66,38 @@ class ActivityItemPipeline(BasePipeline):
 
 class WebItemPipeline(BasePipeline):
     """WebItem处理器
+        按批从JoinBuffer中取出对应的ActivityItem，合并后写入数据库，
+        返回写入的Future，写入失败时ActivityItem放回JoinBuffer，task重试时还能关联
     """
+    batch_size = 50
+    max_linger = 1.0
+
     def __init__(self, namespace, redis_host='192.168.11.108', redis_port=6379,
                  redis_db=0, db_host='192.168.11.195', db_port=5432, db_user='postgres',
-                 db_password='titps4gg', db_base='test'):
+                 db_password='titps4gg', db_base='test', db_flush_size=500, db_flush_interval=1,
+                 db_pool_size=5, db_warm_index=True, join_max_bytes=DEFAULT_JOIN_MAX_BYTES,
+                 join_ttl=DEFAULT_JOIN_TTL, join_redis_ttl=DEFAULT_JOIN_REDIS_TTL,
+                 join_max_redis_count=DEFAULT_JOIN_MAX_REDIS_COUNT):
         BasePipeline.__init__(self, namespace)
+        self._is_closed = False
         try:
             redis_namespace = "%s:%s" % (namespace, "temp")
-            self._temp_redis_dict = RedisDict(redis_namespace, host=redis_host, port=redis_port, db=redis_db)
-            self._db = DB(host=db_host, port=db_port, user=db_user, password=db_password, database=db_base)
+            self._join_buffer = JoinBuffer.get_buffer(redis_namespace, int(join_max_bytes),
+                                                      float(join_ttl), int(join_redis_ttl),
+                                                      int(join_max_redis_count), host=redis_host,
+                                                      port=redis_port, db=redis_db)
+            # 批量写入在单独的线程中执行，不阻塞IOLoop
+            self._db = AsyncDB(pool_size=int(db_pool_size), host=db_host, port=db_port,
+                               user=db_user, password=db_password, database=db_base)
+            # 已经写入的url和内容的摘要，批量写入时已存在的先更新，新的先插入，
+            # 除了update_time之外的更新列都没有变化的不再写入
+            self._key_index = KnownKeyIndex()
+            if db_warm_index:
+                self._warm_key_index()
+            self._upserter = BatchUpserter(self._db, "rt_crawl", STORE_COLUMNS, STORE_KEY_COLUMNS,
+                                           STORE_UPDATE_COLUMNS, int(db_flush_size),
+                                           float(db_flush_interval), self._key_index,
+                                           STORE_DIGEST_COLUMNS)
         except RedisError, e:
             self.logger.error("init redis dict failed error:%s" % e)
             raise e
@@ -59,43 +107,101 @@ class WebItemPipeline(BasePipeline):
 
         self.logger.info("init web item pipeline finished")
 
+    def _warm_key_index(self):
+        """从数据库中加载已经写入的url和内容的摘要
+            info是jsonb时数据库中的文本与写入的不同，只加载url，内容在第一次写入后才能比较
+            Raise:
+                DBError
+        """
+        info_types = [row["data_type"] for row in self._db.iter_query(
+            "SELECT data_type FROM information_schema.columns "
+            "WHERE table_name='rt_crawl' AND column_name='info'")]
+        if "jsonb" in info_types:
+            self.logger.warn("info of rt_crawl is jsonb, load known urls without digest")
+            count = self._key_index.load(
+                self._db.iter_query("SELECT url, source FROM rt_crawl WHERE source=%(source)s",
+                                    {"source": "228com"}), STORE_KEY_COLUMNS)
+        else:
+            count = self._key_index.load(
+                self._db.iter_query("SELECT url, source, %s AS content_digest FROM rt_crawl "
+                                    "WHERE source=%%(source)s" % digest_sql(STORE_DIGEST_COLUMNS),
+                                    {"source": "228com"}), STORE_KEY_COLUMNS, "content_digest")
+        self.logger.info("load %s known urls" % count)
+
     def process_item(self, item, kwargs):
         """处理item的函数
             Args:
                 item: WebItem, 解析后的结果
                 kwargs: dict, 参数字典
+            Returns:
+                future: Future, 写入完成后设置，失败时设置为DBError，没有写入时为None
         """
-        if isinstance(item, WebItem):
-            if self._temp_redis_dict.has_key(item.url):
-                # 合并数据，并保存到数据库中
-                activity_item = self._temp_redis_dict.get(item.url)
-                if activity_item is not None:
-                    self._temp_redis_dict.delete(item.url)
-                    self._store_complete_item(activity_item, item)
+        return self.process_items([(item, kwargs)])
 
+    def process_items(self, items):
+        """批量处理item，一批只访问一次redis
+            Args:
+                items: list, [(WebItem, kwargs)]
+            Returns:
+                future: Future, 所有写入完成后设置，有失败时设置为DBError，没有写入时为None
+        """
+        web_items = [item for item, _ in items if isinstance(item, WebItem)]
+        url2activity_item = self._join_buffer.pop_many([item.url for item in web_items])
+        futures = []
+        for web_item in web_items:
+            activity_item = url2activity_item.get(web_item.url)
+            if activity_item is not None:
+                # 合并数据，并保存到数据库中
+                future = self._store_complete_item(activity_item, web_item)
+                if future is not None:
+                    future.add_done_callback(functools.partial(self._handle_stored,
+                                                               activity_item))
+                    futures.append(future)
             else:
-                self.logger.warn("redis dict not has activity item url:%s" % item.url)
+                self.logger.warn("join buffer not has activity item url:%s" % web_item.url)
+        if futures:
+            return wait_all(futures)
 
     def _store_complete_item(self, activity_item, web_item):
         """用于保存完整的item到数据库中
             Args:
                 activity_item: ActivityItem, 活动内容
                 web_item: WebItem: 活动详情内容
+            Returns:
+                future: Future, 写入的结果，数据不完整时为None
         """
         #  转换格式
         start_time, end_time, city_code, info, _type, url = _convert(activity_item, web_item)
         #  完整性验证
         if _check(info, start_time, url):
             # 存储
-            try:
-                self._store(url, city_code, start_time, end_time, info, _type)
-            except DBError, e:
-                self.logger.error("db error:%s" % e)
+            return self._store(url, city_code, start_time, end_time, info, _type)
         else:
             self.logger.warn("invalidate item info:%s, start_time:%s, url:%s" % (info, start_time, url))
 
+    def _handle_stored(self, activity_item, future):
+        """写入完成后的回调，失败时把ActivityItem放回关联缓存
+            Args:
+                activity_item: ActivityItem, 从关联缓存中取出的一半
+                future: Future, 写入的结果
+        """
+        if future.exception() is None:
+            return
+        self.logger.error("db error:%s, url:%s" % (future.exception(), activity_item.url))
+        try:
+            self._join_buffer.put(activity_item.url, activity_item)
+            if self._is_closed:
+                # 关闭之后才完成的写入，不再有定时检查，直接写入redis
+                self._join_buffer.spill_all()
+        except RedisError, e:
+            self.logger.error("put back activity item failed url:%s error:%s" %
+                              (activity_item.url, e))
+
     def _store(self, url, city_code, start_time, end_time, info, _type):
         """保存数据
+            数据先缓存在BatchUpserter中，批量写入，已经存在的url更新，不存在的插入，
+            url是否存在由本地的索引判断，不需要先查询数据库，
+            除了update_time之外的更新列与上次写入的相同时跳过，不更新update_time
             Args:
                 url: str, url
                 city_code: int, city code
@@ -103,47 +209,42 @@ class WebItemPipeline(BasePipeline):
                 end_time: datetime
                 info: dict
                 _type: str
-            Raise:
-                DBError
+            Returns:
+                future: Future, 这一行所在的批写入完成后设置，失败时设置为DBError
         """
-        selectsql = "SELECT * FROM rt_crawl WHERE url=%(url)s and source=%(source)s LIMIT 1"
-        info_str = json.dumps(info, ensure_ascii=False)
-        if len(self._db.execute_query(selectsql, {'url': url, 'source': '228com'})) >= 1:
-            # update
-            updatesql = "UPDATE rt_crawl SET city_code=%(city_code)s, type=%(type)s," \
-                        " start_time=%(start_time)s, end_time=%(end_time)s, info=%(info)s," \
-                        " source=%(source)s, update_time=%(update_time)s WHERE url=%(url)s"
-
-            self._db.execute_update(updatesql, {'city_code': city_code, 'type': _type,
-                                                'start_time': start_time,
-                                                'end_time': end_time,
-                                                'info': info_str, 'source': '228com',
-                                                'update_time': datetime.datetime.now(),
-                                                'url': url})
-        else:
-            insertsql = "INSERT INTO rt_crawl \
-            (city_code, type, start_time, end_time, \
-            info, url, source, update_time, add_time) \
-            VALUES(%(city_code)s, %(type)s, %(start_time)s, %(end_time)s, " \
-                        "%(info)s, %(url)s, %(source)s, %(update_time)s, %(add_time)s)"
-
-            self._db.execute_update(insertsql,
-                                    {'city_code': city_code, 'type': _type,
-                                     'start_time': start_time,
-                                     'end_time': end_time,
-                                     'info': info_str, 'url': url,
-                                     'source': '228com', 'update_time': datetime.datetime.now(),
-                                     'add_time': datetime.datetime.now()})
+        now = datetime.datetime.now()
+        return self._upserter.add({'city_code': city_code, 'type': _type,
+                            'start_time': start_time, 'end_time': end_time,
+                            'info': json.dumps(info, ensure_ascii=False), 'url': url,
+                            'source': '228com', 'update_time': now, 'add_time': now})
+
+    def close(self):
+        """写入剩余的数据，等待写入完成后关闭数据库连接，关联缓存中本地的数据写入redis
+            关联缓存由其它pipeline和进程共享，不清除，不会重复关闭
+        """
+        if self._is_closed:
+            return
+        self._is_closed = True
+        try:
+            self._upserter.close()
+        except DBError, e:
+            self.logger.error("flush db error:%s" % e)
+        try:
+            self._db.close()
+            self._join_buffer.spill_all()
+            self.logger.info("join buffer status:%s" % self._join_buffer.get_status())
+        except Exception, ignore:
+            self.logger.warn("close failed:%s" % ignore)
 
     def clear_all(self):
         """释放资源
-            关闭数据库连接，清空redis中的数据
+            先清空关联缓存和redis中的数据，关闭时不再需要写入redis
         """
         try:
-            self._db.close()
-            self._temp_redis_dict.clear()
+            self._join_buffer.clear()
         except Exception, ignore:
             self.logger.warn("clear failed:%s" % ignore)
+        self.close()
 
 
 def _convert(activity_item, web_item):
@@ -214,7 +315,7 @@ class PictureItemPipeline(BasePipeline):
         """生成目录，保存图片文件
         """
         if isinstance(item, PictureItem):
-            if not os.path.exists(item.path):
+            if item.picture is not None and not os.path.exists(item.path):
                 _check_and_create(item.path)
                 with open(item.path, "wb") as picture_file:
                     picture_file.write(item.picture)
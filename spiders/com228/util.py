@@ -96,7 +96,7 @@ def create_city_type_task(city_name, city_code, abbreviation, _type, tag, page=1
     url = "http://www.228.com.cn/s/%s-%s/?j=%s&p=%s" % (abbreviation, _type, j, page)
     cookie_host = "http://www.228.com.cn/%s/" % abbreviation
     http_request = HTTPRequest(url=url, connect_timeout=10, request_timeout=25)
-    task = HttpTask(http_request, callback="DealParser", max_fail_count=8,
+    task = HttpTask(http_request, callback="DealParser", max_fail_count=8, adaptive_timeout=True,
                     cookie_host=cookie_host, cookie_count=20, kwargs={'type': _type,
                                                                       'abbreviation': abbreviation,
                                                                       'city_code': city_code,
@@ -17,6 +17,13 @@
     api_get_worker_statistic: 返回worker对应的统计信息
     api_get_all_worker: 返回所有的worker
     api_recover_worker: 以恢复模式启动worker
+    api_get_proxy_status: 返回代理池中所有代理的状态
+    api_get_breaker_status: 返回所有host熔断器的状态
+    api_get_hedge_status: 返回对冲请求预算的状态
+    api_get_fetcher_status: 返回下载器的配置，每个host和每个worker的请求数
+    api_get_robots_status: 返回每个host的robots.txt规则的状态
+    api_get_db_status: 返回所有数据库连接池的状态
+    api_get_join_status: 返回所有关联缓存的状态
 """
 
 __author__ = ['"wuyadong" <wuyadong@tigerknows.com>']
@@ -27,8 +34,16 @@ from core.spider.spider import get_all_spider_class, get_spider_class, SpiderErr
 from core.schedule import get_all_schedule_class, get_schedule_class, ScheduleError
 from core.worker import (start_worker, stop_worker, suspend_worker, WorkerError,rouse_worker,
                          get_worker_statistic, get_all_workers, recover_worker)
+from core.multiworker import start_multi_process_worker
 from core.statistic import output_statistic_dict
 from core.record import RecorderManager
+from core.proxy import ProxyPool
+from core.breaker import BreakerManager
+from core.hedge import HedgeBudget
+from core.fetcher import FetcherSettings, HostLimiter, SlotArbiter
+from core.robots import RobotsCache
+from core.db import ConnectionPool
+from core.spider.join import JoinBuffer
 
 
 class api_route(object):
@@ -137,6 +152,7 @@ def api_start_worker(params):
     spider_path,
     spider_..,...,...., 这里为已spider_开头的参数
     schedule_..,...,...,这里为以schedule_开头的参数
+    process_number: 可选，大于1时以多进程模式启动，子进程共享同一个schedule
     '''
     is_ok, errors = check_params(params, 'schedule_path', 'spider_path')
     if not is_ok:
@@ -145,13 +161,17 @@ def api_start_worker(params):
         try:
             schedule_path = params.pop('schedule_path')
             spider_path = params.pop('spider_path')
+            process_number = int(params.pop('process_number', 1))
             schedule_params = dict([(key[9:], value) for key, value in params.items()
                                if key.startswith('schedule_')])
             spider_params = dict([(key[8:], value) for key, value in params.items()
                              if key.startswith('spider_')])
             schedule = get_schedule_class(schedule_path)(**schedule_params)
             spider = get_spider_class(spider_path)(schedule, **spider_params)
-            start_worker(spider)
+            if process_number > 1:
+                start_multi_process_worker(spider, process_number)
+            else:
+                start_worker(spider)
         except ScheduleError, e:
             return result(400, message="init schedule failed", result=str(e))
         except SpiderError, e:
@@ -348,3 +368,76 @@ def api_remove_fail_worker(params):
                 return result(500, "unsupported exception", result=str(e))
             else:
                 return result(200, "success", "remove success")
+
+@api_route(r"/api/get_proxy_status")
+def api_get_proxy_status(params):
+    """获取代理池中所有代理的状态
+        Args:
+            params: 字典，参数字典，不包含任何数据
+    """
+    try:
+        proxy_status_str = json.dumps(ProxyPool.instance().get_status(),
+                                      ensure_ascii=False, encoding="utf-8")
+    except Exception, e:
+        return result(500, "get proxy status failed", str(e))
+    else:
+        return result(200, "success", proxy_status_str)
+
+@api_route(r"/api/get_breaker_status")
+def api_get_breaker_status(params):
+    """获取所有host熔断器的状态
+        Args:
+            params: 字典，参数字典，不包含任何数据
+    """
+    try:
+        breaker_status_str = json.dumps(BreakerManager.instance().get_status(),
+                                        ensure_ascii=False, encoding="utf-8")
+    except Exception, e:
+        return result(500, "get breaker status failed", str(e))
+    else:
+        return result(200, "success", breaker_status_str)
+
+@api_route(r"/api/get_hedge_status")
+def api_get_hedge_status(params):
+    """获取对冲请求预算的状态
+        Args:
+            params: 字典，参数字典，不包含任何数据
+    """
+    return result(200, "success", HedgeBudget.instance().to_dict())
+
+@api_route(r"/api/get_fetcher_status")
+def api_get_fetcher_status(params):
+    """获取下载器的配置，每个host和每个worker正在处理、排队的请求数
+        Args:
+            params: 字典，参数字典，不包含任何数据
+    """
+    return result(200, "success", {"settings": FetcherSettings.instance().to_dict(),
+                                   "hosts": HostLimiter.instance().get_status(),
+                                   "slots": SlotArbiter.instance().get_status()})
+
+
+@api_route(r"/api/get_robots_status")
+def api_get_robots_status(params):
+    """获取每个host的robots.txt规则数、Crawl-delay和过期时间
+        Args:
+            params: 字典，参数字典，不包含任何数据
+    """
+    return result(200, "success", RobotsCache.instance().get_status())
+
+
+@api_route(r"/api/get_db_status")
+def api_get_db_status(params):
+    """获取所有数据库连接池的连接数和空闲连接数
+        Args:
+            params: 字典，参数字典，不包含任何数据
+    """
+    return result(200, "success", ConnectionPool.get_all_status())
+
+
+@api_route(r"/api/get_join_status")
+def api_get_join_status(params):
+    """获取所有关联缓存本地和redis中的个数，命中、写入redis和超过上限删除的次数
+        Args:
+            params: 字典，参数字典，不包含任何数据
+    """
+    return result(200, "success", JoinBuffer.get_all_status())
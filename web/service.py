@@ -7,9 +7,10 @@ __authors__ = ['"wuyadong" <wuyadong@tigerknows.com>']
 import threading
 import json
 import os
-from tornado import ioloop, web
+from tornado import ioloop, web, netutil, httpserver
 
 from core.util import unicode2str_for_dict
+from core.multiworker import add_listening_sockets
 
 from web import pages, apis
 
@@ -32,7 +33,11 @@ class WebService(object):
 
     def start(self, port=3333):
         self.application = web.Application(self._handlers, **self._settings)
-        self.application.listen(port)
+        # 多进程模式的子进程是fork出来的，需要关闭继承的监听socket
+        sockets = netutil.bind_sockets(port)
+        add_listening_sockets(sockets)
+        server = httpserver.HTTPServer(self.application)
+        server.add_sockets(sockets)
         ioloop.IOLoop.instance().start()
 
 class WebHandler(web.RequestHandler):